@@ -1,18 +1,304 @@
 from pwnagotchi import plugins
 from pwnagotchi.utils import StatusFile
+import io
 import os
+import re
+import gzip
+import json
+import stat
+import time
+import shutil
+import hashlib
 import logging
+import tarfile
+import contextlib
 import subprocess
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_SUFFIX = '.manifest.json'
+ARCHIVE_SUFFIXES = {'gz': '.tar.gz', 'zstd': '.tar.zst'}
+# backup-<serial>-<full|incr>; the serial counts up with every backup, units without a
+# real time clock can't order backups by the time they were taken
+SERIAL_NAME = re.compile(r'^backup-(\d{8})-(?:full|incr)' + re.escape(MANIFEST_SUFFIX) + '$')
+
+
+def _walk(paths, exclude=None):
+    """
+    Yields (path, stat) of every regular file in paths, descending into directories
+    """
+    for path in paths:
+        try:
+            path_stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(path_stat.st_mode):
+            yield os.path.normpath(path), path_stat
+            continue
+        if not stat.S_ISDIR(path_stat.st_mode):
+            continue
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            if exclude and os.path.normpath(directory) == exclude:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield os.path.normpath(entry.path), entry.stat(follow_symlinks=False)
+            except OSError as os_e:
+                logging.debug(f"[autobackup] can't read {directory}: {os_e}")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _HashingReader:
+    """
+    File wrapper that hashes what tarfile copies out of it
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+
+@contextlib.contextmanager
+def _stream_tar(path, mode):
+    """
+    Opens a tar stream ('r' or 'w') compressed with gzip or, for .tar.zst(.tmp), zstd
+    """
+    name = path[:-len('.tmp')] if path.endswith('.tmp') else path
+    with open(path, mode + 'b') as raw:
+        if name.endswith(ARCHIVE_SUFFIXES['zstd']):
+            if mode == 'w':
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+            else:
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode=mode + 'b', compresslevel=6)
+        try:
+            with tarfile.open(fileobj=stream, mode=mode + '|') as tar:
+                yield tar
+        finally:
+            stream.close()
+
+
+def _serial(name):
+    """
+    Returns the serial of a manifest name
+    """
+    return int(SERIAL_NAME.match(name).group(1))
+
+
+def _manifests(backup_dir):
+    """
+    Returns the manifest names in backup_dir, oldest first
+    """
+    try:
+        names = [name for name in os.listdir(backup_dir) if SERIAL_NAME.match(name)]
+    except FileNotFoundError:
+        return list()
+    return sorted(names, key=_serial)
+
+
+def _load_manifest(path):
+    with open(path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def backup(paths, backup_dir, compression='gz', full_every=7, keep=2):
+    """
+    Archives the files in paths that changed since the last backup to backup_dir
+
+    files are compared by (size, mtime) with the last manifest and only read if those changed;
+    content the chain already holds (by sha256) is not stored again. every full_every backups
+    a full archive starts a new chain, only the newest keep chains are kept.
+
+    returns the paths of the new (archive, manifest), or None if nothing changed
+    """
+    backup_dir = os.path.normpath(backup_dir)
+    os.makedirs(backup_dir, exist_ok=True)
+    if compression == 'zstd' and zstandard is None:
+        logging.warning("[autobackup] zstandard isn't installed, using gzip")
+        compression = 'gz'
+
+    for name in os.listdir(backup_dir):
+        if name.startswith('backup-') and name.endswith('.tmp'):
+            os.remove(os.path.join(backup_dir, name))  # left over from an aborted backup
+
+    manifests = _manifests(backup_dir)
+    previous = _load_manifest(os.path.join(backup_dir, manifests[-1])) if manifests else None
+    full = previous is None or previous['sequence'] + 1 >= full_every
+    if not full and not all(os.path.exists(os.path.join(backup_dir, archive))
+                            for archive in {entry['archive'] for entry in previous['files'].values()}):
+        logging.warning(f"[autobackup] the chain of {manifests[-1]} is incomplete, starting a full backup")
+        full = True
+    known = dict() if full else previous['files']
+    # sha256 -> (archive, member) of the content the chain holds already
+    objects = {entry['sha256']: (entry['archive'], entry['member']) for entry in known.values()}
+
+    serial = max([_serial(name) for name in manifests], default=0) + 1
+    base = f"backup-{serial:08d}-{'full' if full else 'incr'}"
+    archive = base + ARCHIVE_SUFFIXES[compression]
+    archive_path = os.path.join(backup_dir, archive)
+    files = dict()
+    stored = 0
+    with _stream_tar(archive_path + '.tmp', 'w') as tar:
+        for path, path_stat in _walk(paths, exclude=backup_dir):
+            entry = known.get(path)
+            if entry is not None and entry['size'] == path_stat.st_size and entry['mtime'] == path_stat.st_mtime_ns:
+                files[path] = entry
+                continue
+            try:
+                sha256 = _sha256(path)
+                file = open(path, 'rb')
+            except OSError as os_e:
+                logging.debug(f"[autobackup] skipping {path}: {os_e}")
+                continue
+            with file:
+                entry = {'sha256': sha256, 'size': path_stat.st_size, 'mtime': path_stat.st_mtime_ns,
+                         'mode': stat.S_IMODE(path_stat.st_mode)}
+                if sha256 not in objects:
+                    # errors from here on break the archive and abort the backup
+                    member = path.lstrip('/')
+                    tarinfo = tar.gettarinfo(arcname=member, fileobj=file)
+                    reader = _HashingReader(file)
+                    tar.addfile(tarinfo, reader)
+                    # the file may have changed since it was hashed, trust what went into the archive
+                    entry['sha256'] = sha256 = reader.digest.hexdigest()
+                    entry['size'] = tarinfo.size
+                    objects[sha256] = (archive, member)
+                    stored += 1
+            entry['archive'], entry['member'] = objects[sha256]
+            files[path] = entry
+
+        if not full and files == known:
+            changed = False
+        else:
+            changed = True
+            manifest = {
+                'version': 1,
+                'created': time.time(),
+                'archive': archive,
+                'parent': None if full else manifests[-1],
+                'serial': serial,
+                'sequence': 0 if full else previous['sequence'] + 1,
+                'stored': stored,
+                'files': files,
+            }
+            data = json.dumps(manifest).encode()
+            tarinfo = tarfile.TarInfo(base + MANIFEST_SUFFIX)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(manifest['created'])
+            tar.addfile(tarinfo, io.BytesIO(data))
+
+    if not changed:
+        os.remove(archive_path + '.tmp')
+        return None
+    os.replace(archive_path + '.tmp', archive_path)
+    # the manifest next to the archive marks the backup as complete
+    manifest_path = os.path.join(backup_dir, base + MANIFEST_SUFFIX)
+    with open(manifest_path + '.tmp', 'wb') as manifest_file:
+        manifest_file.write(data)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    logging.info(f"[autobackup] {archive}: {stored} of {len(files)} files stored")
+
+    _prune(backup_dir, keep, live={entry['archive'] for entry in files.values()})
+    return archive_path, manifest_path
+
+
+def _prune(backup_dir, keep, live=()):
+    """
+    Removes the chains older than the newest keep full backups, never the archives in live
+    """
+    manifests = _manifests(backup_dir)
+    fulls = [num for num, name in enumerate(manifests) if name.endswith('-full' + MANIFEST_SUFFIX)]
+    if keep < 1 or len(fulls) <= keep:
+        return
+    for name in manifests[:fulls[-keep]]:
+        base = name[:-len(MANIFEST_SUFFIX)]
+        if any(base + suffix in live for suffix in ARCHIVE_SUFFIXES.values()):
+            logging.warning(f"[autobackup] keeping {base}, the newest backup still uses it")
+            continue
+        for suffix in list(ARCHIVE_SUFFIXES.values()) + [MANIFEST_SUFFIX]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(backup_dir, base + suffix))
+        logging.debug(f"[autobackup] removed old backup {base}")
+
+
+def restore(backup_dir, target='/', manifest=None):
+    """
+    Restores the files of a manifest (the newest if None) below target, reading each archive
+    of its chain once; returns the number of restored files
+
+        python3 -c "import auto_backup; auto_backup.restore('/root/backups', '/')"
+    """
+    if manifest is None:
+        manifests = _manifests(backup_dir)
+        if not manifests:
+            raise FileNotFoundError(f"no backup to restore in {backup_dir}")
+        manifest = manifests[-1]
+    manifest = _load_manifest(os.path.join(backup_dir, manifest))
+    # archive -> member -> [(path, entry)]
+    wanted = dict()
+    for path, entry in manifest['files'].items():
+        wanted.setdefault(entry['archive'], dict()).setdefault(entry['member'], list()).append((path, entry))
+
+    restored = 0
+    for archive, members in wanted.items():
+        with _stream_tar(os.path.join(backup_dir, archive), 'r') as tar:
+            for tarinfo in tar:
+                targets = members.pop(tarinfo.name, None)
+                if not targets:
+                    continue
+                first = None
+                for path, entry in targets:
+                    destination = os.path.join(target, path.lstrip('/'))
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    if first is None:
+                        with open(destination, 'wb') as file:
+                            shutil.copyfileobj(tar.extractfile(tarinfo), file)
+                        first = destination
+                    else:
+                        shutil.copyfile(first, destination)
+                    os.chmod(destination, entry['mode'])
+                    os.utime(destination, ns=(entry['mtime'], entry['mtime']))
+                    restored += 1
+                if not members:
+                    break
+        if members:
+            logging.error(f"[autobackup] {archive} misses {len(members)} files")
+    return restored
+
 
 class AutoBackup(plugins.Plugin):
     __author__ = '33197631+dadav@users.noreply.github.com'
-    __version__ = '2.0.0'
+    __version__ = '2.1.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin backups files when internet is available.'
     __name__ = 'AutoBackup'
     __help__ = """
     This plugin backups files when internet is available.
+
+    mode = "native" writes incremental archives of the changed files to backup_dir instead of
+    running the commands; restore with auto_backup.restore(backup_dir, target).
     """
     __dependencies__ = {
         'apt': ['tar'],
@@ -32,6 +318,12 @@ class AutoBackup(plugins.Plugin):
         'commands': [
             'tar czf /root/pwnagotchi-backup.tar.gz {files}'
         ],
+        'mode': 'commands',
+        'backup_dir': '/root/backups',
+        'compression': 'gz',
+        'full_every': 7,
+        'keep': 2,
+        'upload_commands': [],
     }
 
     def __init__(self):
@@ -40,7 +332,13 @@ class AutoBackup(plugins.Plugin):
         self.status = StatusFile('/root/.auto-backup')
 
     def on_loaded(self):
-        for opt in ['files', 'interval', 'commands', 'max_tries']:
+        for opt in ['mode', 'backup_dir', 'compression', 'full_every', 'keep', 'upload_commands']:
+            self.options.setdefault(opt, self.__defaults__[opt])
+
+        required = ['files', 'interval', 'max_tries']
+        if self.options['mode'] != 'native':
+            required.append('commands')
+        for opt in required:
             if opt not in self.options or (opt in self.options and self.options[opt] is None):
                 logging.error(f"[autobackup] Option {opt} is not set.")
                 return
@@ -48,6 +346,15 @@ class AutoBackup(plugins.Plugin):
         self.ready = True
         logging.info('[autobackup] Successfully loaded.')
 
+    def _run(self, commands, **kwargs):
+        for cmd in commands:
+            logging.info(f"[autobackup] Running {cmd.format(**kwargs)}")
+            process = subprocess.Popen(cmd.format(**kwargs), shell=True, stdin=None,
+                                       stdout=open("/dev/null", "w"), stderr=None, executable="/bin/bash")
+            process.wait()
+            if process.returncode > 0:
+                raise OSError(f"Command failed (rc: {process.returncode})")
+
     def on_internet_available(self, agent):
         if not self.ready:
             return
@@ -69,13 +376,15 @@ class AutoBackup(plugins.Plugin):
             display.set('status', 'Backing up ...')
             display.update()
 
-            for cmd in self.options['commands']:
-                logging.info(f"[autobackup] Running {cmd.format(files=files_to_backup)}")
-                process = subprocess.Popen(cmd.format(files=files_to_backup), shell=True, stdin=None,
-                                           stdout=open("/dev/null", "w"), stderr=None, executable="/bin/bash")
-                process.wait()
-                if process.returncode > 0:
-                    raise OSError(f"Command failed (rc: {process.returncode})")
+            if self.options['mode'] == 'native':
+                written = backup(existing_files, self.options['backup_dir'], self.options['compression'],
+                                 self.options['full_every'], self.options['keep'])
+                if written is not None and self.options['upload_commands']:
+                    archive, manifest = written
+                    self._run(self.options['upload_commands'], archive=archive, manifest=manifest,
+                              backup_dir=self.options['backup_dir'])
+            else:
+                self._run(self.options['commands'], files=files_to_backup)
 
             logging.info('[autobackup] backup done')
             display.set('status', 'Backup done!')
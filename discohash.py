@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import logging
 import requests
@@ -6,12 +7,16 @@ import subprocess
 import pwnagotchi
 import pwnagotchi.plugins as plugins
 
-
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import hcx_convert
 
 
 class discohash(plugins.Plugin):
     __author__ = 'v0yager'
-    __version__ = '1.1.0'
+    __version__ = '1.2.0'
     __license__ = 'GPL3'
     __description__ = '''
                     DiscoHash extracts hashes from pcaps (hashcat mode 22000) using hcxpcapngtool,
@@ -29,6 +34,7 @@ class discohash(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'batch_size': 100,
     }
 
     def __init__(self):
@@ -60,14 +66,34 @@ class discohash(plugins.Plugin):
 
 
     def process_pcaps(self, handshake_dir):
-        handshakes_list = [os.path.join(handshake_dir, filename) for filename in os.listdir(handshake_dir) if filename.endswith('.pcap')]
+        index = handshake_index.get(handshake_dir)
+        handshakes_list = index.files('.pcap')
+        isfile = index.isfile
         failed_jobs = []
         successful_jobs = []
         lonely_pcaps = []
+        batch_size = self.options.get('batch_size', 100)
+        if batch_size > 1:
+            # one hcxpcapngtool run per chunk of pcaps instead of one per pcap
+            missing = [handshake for handshake in handshakes_list if not isfile(handshake.split('.')[0] + '.22000')]
+            converted = set()
+            for start in range(0, len(missing), batch_size):
+                converted.update(hcx_convert.batch_hcxpcapngtool(missing[start:start + batch_size]))
+            handshakes_list = missing
         for num, handshake in enumerate(handshakes_list):
             fullpathNoExt = handshake.split('.')[0]
             pcapFileName = handshake.split('/')[-1:][0]
-            if not os.path.isfile(fullpathNoExt + '.22000'):
+            if batch_size > 1:
+                if handshake in converted:
+                    logging.info('[+] DiscoHash EAPOL/PMKID Success: {}.22000 created'.format(fullpathNoExt.split('/')[-1]))
+                    self.get_coord(fullpathNoExt)
+                    self.post_hash(fullpathNoExt)
+                    successful_jobs.append('22000: ' + pcapFileName)
+                else:
+                    failed_jobs.append('22000: ' + pcapFileName)
+                    lonely_pcaps.append(handshake)
+                    logging.debug('[*] DiscoHash Batch job: added {} to lonely list'.format(pcapFileName))
+            elif not isfile(fullpathNoExt + '.22000'):
                 if self.write_hash(handshake):
                     successful_jobs.append('22000: ' + pcapFileName)
                 else:
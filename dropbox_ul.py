@@ -1,17 +1,26 @@
 import os
+import sys
 import logging
 import threading
 import requests
 import json
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pwnagotchi.utils import StatusFile
 from pwnagotchi import plugins
 from json.decoder import JSONDecodeError
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import upload_outbox
+
+OUTBOX = 'dropbox'
+
 
 class dropbox(plugins.Plugin):
     __author__ = 'menglish99@gmail.com'
-    __version__ = '0.0.1'
+    __version__ = '0.2.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin automatically uploads handshakes to a dropbox app'
     __name__ = 'dropbox'
@@ -23,6 +32,11 @@ class dropbox(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'content_url': 'https://content.dropboxapi.com',
+        'api_url': 'https://api.dropboxapi.com',
+        'chunk_size': 4 * 1024 * 1024,
+        'batch_size': 1000,
+        'workers': 4,
     }
 
     def __init__(self):
@@ -35,30 +49,122 @@ class dropbox(plugins.Plugin):
             self.report = StatusFile('/root/.dropbox_ul_uploads', data_format='json')
 
         self.options = dict()
-        self.skip = list()
+        self.session = None
+
+    def _content_call(self, endpoint, arg, data, timeout=30):
+        """
+        Posts data to a content endpoint of the files api, arguments go in the Dropbox-API-Arg header
+        """
+        headers = {
+            'Dropbox-API-Arg': json.dumps(arg),
+            'Content-Type': 'application/octet-stream',
+        }
+        response = self.session.post(f"{self.options['content_url']}/2/files/{endpoint}", headers=headers,
+                                     data=data, timeout=timeout)
+        response.raise_for_status()
+        return response
 
-    def _upload_to_dropbox(self, path, timeout=30):
+    def _upload_to_dropbox(self, path, timeout=30, budget=None):
         """
-        Uploads the file to dropbox
+        Uploads the file to a closed upload session, chunk_size bytes at a time, and returns
+        its finish_batch entry; nothing is visible in dropbox until the batch is finished
+
+        returns None if the file doesn't fit into the outbox budget
         """
         head, tail = os.path.split(path)
         destFile = self.options['path'] + '/' + tail
-        dbOpts = {'path': destFile, 'mode': 'add','autorename': True,'mute': False,'strict_conflict': False}
+        chunk_size = self.options['chunk_size']
 
-        headers = {
-            'Authorization': 'Bearer ' + self.options['app_token'],
-            'Dropbox-API-Arg': json.dumps(dbOpts),
-            'Content-Type': 'application/octet-stream',
+        try:
+            with open(path, 'rb') as fp:
+                # read one chunk ahead, so the last request can close the session
+                chunk = fp.read(chunk_size)
+                following = fp.read(chunk_size)
+                if budget is not None and not budget.consume(len(chunk)):
+                    return None
+                response = self._content_call('upload_session/start', {'close': not following}, chunk, timeout)
+                session_id = response.json()['session_id']
+                offset = len(chunk)
+                while following:
+                    chunk, following = following, fp.read(chunk_size)
+                    if budget is not None and not budget.consume(len(chunk)):
+                        return None  # the open session expires on the server
+                    cursor = {'session_id': session_id, 'offset': offset}
+                    self._content_call('upload_session/append_v2', {'cursor': cursor, 'close': not following},
+                                       chunk, timeout)
+                    offset += len(chunk)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"dropbox_ul: Got an exception while uploading {path} -> {e}")
+            raise e
+
+        return {
+            'cursor': {'session_id': session_id, 'offset': offset},
+            'commit': {'path': destFile, 'mode': 'add', 'autorename': True, 'mute': False, 'strict_conflict': False},
         }
-        data = open(path, 'rb').read()
 
+    def _finish_batch(self, entries, timeout=60):
+        """
+        Commits closed upload sessions in one call, returns a result per entry
+        """
         try:
-            response = requests.post('https://content.dropboxapi.com/2/files/upload', headers=headers, data=data)
-            logging.error(response)
+            response = self.session.post(f"{self.options['api_url']}/2/files/upload_session/finish_batch_v2",
+                                         json={'entries': entries}, timeout=timeout)
+            response.raise_for_status()
+            return response.json()['entries']
         except requests.exceptions.RequestException as e:
-            logging.error(f"OHC: Got an exception while uploading {path} -> {e}")
+            logging.error(f"dropbox_ul: Got an exception while committing {len(entries)} uploads -> {e}")
             raise e
 
+    def _upload_all(self, handshakes, reported, display, outbox):
+        """
+        Uploads the handshakes on a pool of workers and commits them batch_size at a time; the
+        results go to the outbox queue and the uploads draw from its budget
+        """
+        # finish_batch takes at most 1000 entries
+        batch_size = max(1, min(self.options['batch_size'], 1000))
+        done = 0
+        with outbox.budget() as budget, ThreadPoolExecutor(max_workers=self.options['workers']) as pool:
+            for start in range(0, len(handshakes), batch_size):
+                futures = {pool.submit(self._upload_to_dropbox, handshake, budget=budget): handshake
+                           for handshake in handshakes[start:start + batch_size]}
+                uploaded = list()
+                entries = list()
+                for future in as_completed(futures):
+                    handshake = futures[future]
+                    try:
+                        entry = future.result()
+                        if entry is not None:
+                            entries.append(entry)
+                            uploaded.append(handshake)
+                    except requests.exceptions.RequestException as req_e:
+                        outbox.failed(OUTBOX, [handshake], req_e)
+                        logging.error("dropbox_ul: %s", req_e)
+                    except FileNotFoundError as os_e:
+                        outbox.forget(OUTBOX, [handshake])
+                        logging.error("dropbox_ul: %s", os_e)
+                    except OSError as os_e:
+                        logging.error("dropbox_ul: %s", os_e)
+                if not entries:
+                    continue
+
+                # the sessions stay open on the server for days, uncommitted handshakes
+                # are simply uploaded again on the next run
+                results = self._finish_batch(entries)
+                committed = list()
+                for handshake, result in zip(uploaded, results):
+                    if result.get('.tag') == 'success':
+                        committed.append(handshake)
+                        logging.debug("dropbox_ul: Successfully uploaded %s", handshake)
+                    else:
+                        outbox.failed(OUTBOX, [handshake], result.get('failure'))
+                        logging.error("dropbox_ul: couldn't commit %s: %s", handshake, result.get('failure'))
+                reported.extend(committed)
+                self.report.update(data={'reported': reported})
+                outbox.done(OUTBOX, committed)
+
+                done += len(futures)
+                display.set('status', f"Uploading handshakes to dropbox ({done}/{len(handshakes)})")
+                display.update(force=True)
 
     def on_loaded(self):
         """
@@ -67,9 +173,26 @@ class dropbox(plugins.Plugin):
         if 'app_token' not in self.options or ('app_token' in self.options and self.options['app_token'] is None):
             logging.error("dropbox_ul: APP-TOKEN isn't set.")
             return
+
+        for opt in ('content_url', 'api_url', 'chunk_size', 'batch_size', 'workers'):
+            self.options.setdefault(opt, self.__defaults__[opt])
+
+        # one keep-alive session for all requests, the token goes with every one of them
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + self.options['app_token']
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.options['workers'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         logging.info(" [dropbox_ul] plugin loaded")
         self.ready = True
 
+    def on_handshake(self, agent, filename, access_point, client_station):
+        """
+        Queues the new handshake right away, so it is uploaded even after a restart
+        """
+        if self.ready:
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [filename])
+
     def on_internet_available(self, agent):
         """
         Called in manual mode when there's internet connectivity
@@ -81,27 +204,13 @@ class dropbox(plugins.Plugin):
                 reported = self.report.data_field_or('reported', default=list())
 
                 handshake_dir = config['bettercap']['handshakes']
-                handshake_filenames = os.listdir(handshake_dir)
-                handshake_paths = [os.path.join(handshake_dir, filename) for filename in handshake_filenames if
-                                   filename.endswith('.pcap')]
-                handshake_new = set(handshake_paths) - set(reported) - set(self.skip)
+                outbox = upload_outbox.get(config)
+                outbox.sync(OUTBOX, handshake_dir, ('.pcap',), done=reported)
+                handshake_new = outbox.due(OUTBOX)
 
                 if handshake_new:
                     logging.info("dropbox_ul: Internet connectivity detected. Uploading new handshakes")
-
-                    for idx, handshake in enumerate(handshake_new):
-                        display.set('status', f"Uploading handshake to dropbox ({idx + 1}/{len(handshake_new)})")
-                        display.update(force=True)
-                        try:
-                            self._upload_to_dropbox(handshake)
-                            reported.append(handshake)
-                            self.report.update(data={'reported': reported})
-                            logging.info("dropbox_ul: Successfully uploaded %s", handshake)
-                        except requests.exceptions.RequestException as req_e:
-                            self.skip.append(handshake)
-                            logging.error("dropbox_ul: %s", req_e)
-                            continue
-                        except OSError as os_e:
-                            logging.error("dropbox_ul: %s", os_e)
-                            continue
-
+                    try:
+                        self._upload_all(handshake_new, reported, display, outbox)
+                    except requests.exceptions.RequestException as req_e:
+                        logging.error("dropbox_ul: %s", req_e)
@@ -2,6 +2,7 @@ import pwnagotchi
 
 
 import pwnagotchi.plugins as plugins
+import pwnagotchi.ui.web as web
 
 import logging
 import traceback
@@ -18,7 +19,7 @@ import csv
 import _thread
 from pwnagotchi import restart
 from pwnagotchi.utils import save_config
-from flask import abort, render_template_string
+from flask import abort, render_template_string, Response
 
 
 import requests
@@ -277,12 +278,35 @@ class Fancygotchi(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'stream': True,
     }
 
     def __init__(self):
         self.ready = False
         self.mode = 'MANU'
 
+    def _frame_response(self, request, fmt, version, data):
+        """
+        Sends an encoded frame, or 304 if the client has this version already
+        """
+        etag = '"%s.%d.%s"' % (web.BOOT_ID, version, fmt)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'X-Frame-Version': str(version)}
+        if request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers=headers)
+        return Response(data, mimetype=web.FORMATS[fmt][1], headers=headers)
+
+    def _stream(self):
+        """
+        Yields the frames as a multipart mjpeg stream, the last one again while nothing changes
+        """
+        version = 0
+        while True:
+            version = web.wait_frame(version)
+            version, data = web.get_frame('jpeg')
+            if data is None:
+                continue
+            yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (len(data), data)
+
     def on_config_changed(self, config):
         self.config = config
         self.ready = True
@@ -295,6 +319,7 @@ class Fancygotchi(plugins.Plugin):
 
     def on_loaded(self):
         logging.info("[FANCYGOTCHI] Beginning Fancygotchi load")
+        self.options.setdefault('stream', self.__defaults__['stream'])
 
         custom_plugins_path = pwnagotchi.config['main']['custom_plugins']
         if not custom_plugins_path[-1] == '/': custom_plugins_path += '/'
@@ -425,10 +450,32 @@ class Fancygotchi(plugins.Plugin):
                 # send configuration
                 logging.info(type(self.config))
                 return json.dumps(self.config, default=serializer)
+            elif path in ("frame", "frame/next") and hasattr(web, 'get_frame'):
+                # the newest frame from memory, frame/next waits for the one after ?after=<version>
+                fmt = request.args.get('format', 'png')
+                if fmt not in web.FORMATS:
+                    abort(400)
+                if path == "frame/next":
+                    after = request.args.get('after', type=int, default=web.latest()[0])
+                    if web.wait_frame(after, request.args.get('timeout', type=float, default=web.MAX_WAIT)) <= after:
+                        return Response(status=304, headers={'X-Frame-Version': str(after)})
+                version, data = web.get_frame(fmt)
+                if data is None:
+                    abort(404)
+                return self._frame_response(request, fmt, version, data)
+            elif path == "stream" and hasattr(web, 'get_frame'):
+                if not self.options.get('stream', self.__defaults__['stream']):
+                    abort(404)
+                return Response(self._stream(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                                headers={'Cache-Control': 'no-cache'})
             elif path == "get-theme":
                 # Verifying the image size for resolution
-                with Image.open('/var/tmp/pwnagotchi/pwnagotchi.png') as img:
+                version, img = web.latest() if hasattr(web, 'latest') else (0, None)
+                if img is not None:
                     width, height = img.size
+                else:
+                    with Image.open('/var/tmp/pwnagotchi/pwnagotchi.png') as img:
+                        width, height = img.size
                 # Filling the system/theme config
                 theme = {
                     'is_display': self.config['ui']['display']['enabled'],
@@ -1,13 +1,10 @@
 import logging
+import functools
 import pwnagotchi
 from PIL import Image, ImageDraw, ImageOps
 from textwrap import TextWrapper
 
-def text_to_rgb(text, tfont, color, width, height):
-    if color == 'white' : color = (254, 254, 254, 255)
-    #logging.warning(color)
-    #logging.info('text length: %s; text font: %s; text: %s' % (len(text), tfont, text))
-    #logging.info(str(tfont.getbbox(text)))
+def text_size(text, tfont):
     w,h = tfont.getsize(text)
     nb_lines = text.count('\n') + 1
     #logging.info(nb_lines)
@@ -23,31 +20,55 @@ def text_to_rgb(text, tfont, color, width, height):
         #logging.info('total: %d; max per line: %d' % (tot_char, max_char))
         #logging.info(int(w / (tot_char / max_char)))
         w = int(w / (tot_char / max_char))
-        
+    return int(w), int(h)
+
+# rendered texts kept by (text, font, color), wrapped texts are keyed with their line breaks
+TEXT_CACHE_SIZE = 256
+
+def text_to_rgb(text, tfont, color, width, height):
+    """
+    Returns text rendered in color on white; the image comes from a cache and is shared, it is
+    only to be pasted, not changed
+    """
+    if isinstance(color, list): color = tuple(color)
+    return _render_text(text, tfont, color)
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _render_text(text, tfont, color):
+    if color == 'white' : color = (254, 254, 254, 255)
+    #logging.warning(color)
+    #logging.info('text length: %s; text font: %s; text: %s' % (len(text), tfont, text))
+    #logging.info(str(tfont.getbbox(text)))
+    w,h = text_size(text, tfont)
 
     #logging.info(str(tfont.getsize()))
     #logging.info('width: %d; height; %d;' % (w, h))
     imgtext = Image.new('1', (int(w), int(h)), 0xff)
     dt = ImageDraw.Draw(imgtext)
     dt.text((0,0), text, font=tfont, fill=0x00)
-    nonwhite_positions = [(x,y) for x in range(imgtext.size[0]) for y in range(imgtext.size[1]) if imgtext.getdata()[x+y*imgtext.size[0]] != (255,255,255)]
-    #logging.info(str(nonwhite_positions))
-    #if not nonwhite_positions == []:
-    #    rect = (min([x for x,y in nonwhite_positions]), min([y for x,y in nonwhite_positions]), max([x for x,y in nonwhite_positions]), max([y for x,y in nonwhite_positions]))
-    #    imgtext = imgtext.crop(rect)
     if color == 0: color = 'black'
     imgtext = ImageOps.colorize(imgtext.convert('L'), black = color, white = 'white')
     imgtext = imgtext.convert('RGB')
-    #datas = imgtext.getdata()
-    #newData = []
-    #for item in datas:
-    #    if item[0] == 255 and item[1] == 255 and item[2] == 255:
-    #        newData.append((255, 255, 255, 0))
-    #    else:
-    #        newData.append(item)
-    #imgtext.putdata(newData)
     return imgtext
 
+def _image_box(xy, image):
+    """
+    Box of an image pasted at xy, a corner or a box
+    """
+    if len(xy) >= 4:
+        return tuple(xy[:4])
+    return (xy[0], xy[1], xy[0] + image.size[0], xy[1] + image.size[1])
+
+def _points_box(xy, width=1):
+    """
+    Box around a sequence of points, flat (x0, y0, x1, y1, ...) or as pairs, with a margin for width
+    """
+    if len(xy) and isinstance(xy[0], (tuple, list)):
+        xy = [c for point in xy for c in point]
+    xs, ys = xy[0::2], xy[1::2]
+    margin = width // 2 + 1
+    return (min(xs) - margin, min(ys) - margin, max(xs) + margin + 1, max(ys) + margin + 1)
+
 class Widget(object):
     def __init__(self, xy, color=0):
         self.xy = xy
@@ -56,6 +77,13 @@ class Widget(object):
     def draw(self, canvas, drawer):
         raise Exception("not implemented")
 
+    def bbox(self, size):
+        """
+        Returns the (left, top, right, bottom) box the widget draws into on a canvas of size, or
+        None if it draws nothing; widgets that can't tell may draw anywhere
+        """
+        return (0, 0) + tuple(size)
+
 
 class Bitmap(Widget):
     def __init__(self, path, xy, color=0):
@@ -65,6 +93,9 @@ class Bitmap(Widget):
     def draw(self, canvas, drawer):
         canvas.paste(self.image, self.xy)
 
+    def bbox(self, size):
+        return _image_box(self.xy, self.image)
+
 
 class Line(Widget):
     def __init__(self, xy, color=0, width=1):
@@ -74,16 +105,26 @@ class Line(Widget):
     def draw(self, canvas, drawer):
         drawer.line(self.xy, fill=self.color, width=self.width)
 
+    def bbox(self, size):
+        # wide lines are centered on xy
+        return _points_box(self.xy, self.width)
+
 
 class Rect(Widget):
     def draw(self, canvas, drawer):
         drawer.rectangle(self.xy, outline=self.color)
 
+    def bbox(self, size):
+        return _points_box(self.xy)
+
 
 class FilledRect(Widget):
     def draw(self, canvas, drawer):
         drawer.rectangle(self.xy, fill=self.color)
 
+    def bbox(self, size):
+        return _points_box(self.xy)
+
 
 #class Text(Widget):
 #    def __init__(self, value="", position=(0, 0), font=None, color=0, wrap=False, max_length=0):
@@ -115,13 +156,23 @@ class Text(Widget):
         if icon:
             self.image = Image.open(value)
 
+    def _text(self):
+        if self.wrap:
+            return '\n'.join(self.wrapper.wrap(self.value))
+        return self.value
+
+    def bbox(self, size):
+        if self.value is None:
+            return None
+        if self.icon:
+            return _image_box(self.xy, self.image)
+        w, h = text_size(self._text(), self.font)
+        return (self.xy[0], self.xy[1], self.xy[0] + w, self.xy[1] + h)
+
     def draw(self, canvas, drawer):
         if self.value is not None:
             if not self.icon:
-                if self.wrap:
-                    text = '\n'.join(self.wrapper.wrap(self.value))
-                else:
-                    text = self.value
+                text = self._text()
                 width, height = canvas.size
                 imgtext = text_to_rgb(text, self.font, self.color, width, height)
                 #logging.info("canvas: %s" % canvas.mode)
@@ -147,6 +198,21 @@ class LabeledValue(Widget):
         self.text_font = text_font
         self.label_spacing = label_spacing
 
+    def _positions(self):
+        pos_label = [int(self.xy[0]), int(self.xy[1])]
+        pos_value = (pos_label[0] + self.label_spacing + 5 * len(self.label), pos_label[1])
+        return pos_label, pos_value
+
+    def bbox(self, size):
+        if self.label is None:
+            w, h = text_size(self.value, self.label_font)
+            return (self.xy[0], self.xy[1], self.xy[0] + w, self.xy[1] + h)
+        pos_label, pos_value = self._positions()
+        label_w, label_h = text_size(self.label, self.label_font)
+        value_w, value_h = text_size(self.value, self.label_font)
+        return (min(pos_label[0], pos_value[0]), pos_label[1],
+                max(pos_label[0] + label_w, pos_value[0] + value_w), pos_label[1] + max(label_h, value_h))
+
     def draw(self, canvas, drawer):
         width, height = canvas.size
         if self.label is None:
@@ -156,8 +222,7 @@ class LabeledValue(Widget):
 
             #drawer.text(self.xy, self.value, font=self.label_font, fill=self.color)
         else:
-            pos_label = [int(self.xy[0]), int(self.xy[1])]
-            pos_value = (pos_label[0] + self.label_spacing + 5 * len(self.label), pos_label[1])
+            pos_label, pos_value = self._positions()
             #logging.info('%s   --   %s' % (str(pos_label), str(pos_value)))
 
             imgtext = text_to_rgb(self.label, self.label_font, self.color, width, height)
@@ -1,12 +1,13 @@
 import _thread
 import logging
+import os
 import traceback
 import random
 import toml
 import time
 from threading import Lock
 
-from PIL import ImageDraw, Image
+from PIL import ImageDraw, Image, ImageChops
 
 import pwnagotchi
 import pwnagotchi.plugins as plugins
@@ -22,6 +23,108 @@ WHITE = 0xff
 BLACK = 0x00
 ROOT = None
 
+# lookup tables for Image.point: drawn (not pure white) pixels, and the dark ones of the 'auto'
+# text color, r + g + b < 500, which is a mean below 167 once rounded
+NOT_WHITE = [255] * 255 + [0]
+DARK = [255] * 167 + [0] * 89
+MEAN = (1 / 3, 1 / 3, 1 / 3, 0)
+
+
+def _drawn_mask(canvas):
+    """
+    Returns an 'L' mask of the pixels of canvas that aren't pure white
+    """
+    r, g, b = canvas.split()
+    return ImageChops.darker(ImageChops.darker(r, g), b).point(NOT_WHITE)
+
+
+def _paste_text(bg, canvas, mask, color_text):
+    """
+    Pastes the drawn pixels of canvas on the grayscale bg in the low color text color: black,
+    white, or for auto black for dark pixels and white for pale ones
+    """
+    if color_text == 'black':
+        bg.paste(BLACK, (0, 0), mask)
+    elif color_text == 'white':
+        bg.paste(WHITE, (0, 0), mask)
+    elif color_text == 'auto':
+        bg.paste(WHITE, (0, 0), mask)
+        # dark pixels are never white, no need to combine with mask
+        bg.paste(BLACK, (0, 0), canvas.convert('L', MEAN).point(DARK))
+    else:
+        bg.paste(canvas, (0, 0), mask)
+    return bg
+
+
+def _clip(box, size):
+    """
+    Returns box cut to a canvas of size, or None if nothing of it is left
+    """
+    if box is None:
+        return None
+    box = (max(0, int(box[0])), max(0, int(box[1])), min(size[0], int(box[2])), min(size[1], int(box[3])))
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+
+def _overlaps(box, other):
+    return box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+
+
+def _merge(boxes):
+    """
+    Merges overlapping boxes into their union, drops the None ones
+    """
+    merged = []
+    for box in boxes:
+        if box is None:
+            continue
+        overlapping = [other for other in merged if _overlaps(box, other)]
+        while overlapping:
+            for other in overlapping:
+                merged.remove(other)
+                box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+            overlapping = [other for other in merged if _overlaps(box, other)]
+        merged.append(box)
+    return merged
+
+
+class Background(object):
+    """
+    The theme background, decoded once and kept converted for the full color ('RGB') and the
+    low color ('L') frames; it is loaded again when the theme points to another image or the
+    file changes
+    """
+
+    def __init__(self):
+        self._key = None
+        self._variants = {}
+
+    def load(self, path, size):
+        """
+        Decodes the background for a display of size if it is new or changed, returns True if it did
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, size)
+        if key == self._key:
+            return False
+        with Image.open(path) as bg:
+            bga = bg.convert('RGBA')
+        if bga.size != size:
+            logging.debug('background %s is %dx%d, the display %dx%d' % ((path,) + bga.size + size))
+            fitted = Image.new('RGBA', size, (255, 255, 255, 255))
+            fitted.paste(bga, (0, 0))
+            bga = fitted
+        self._variants = {'RGB': bga.convert('RGB'), 'L': bga.convert('L')}
+        self._key = key
+        return True
+
+    def get(self, mode, box):
+        """
+        Returns a copy of box of the background in mode 'RGB' or 'L'
+        """
+        return self._variants[mode].crop(box)
+
+
 class View(object):
     def __init__(self, config, impl, state=None):
         global ROOT
@@ -49,6 +152,15 @@ class View(object):
         self._config = config
         self._canvas = None
         self._canvas_l = None
+        self._canvas_2 = None
+        self._canvas_3 = None
+        self._background = Background()
+        # the widgets drawn on white, and a scratch canvas to draw them again one box at a time
+        self._drawn = None
+        self._scratch = None
+        self._boxes = {}
+        self._modes = None
+        self._partial_cbs = []
         self._frozen = False
         self._lock = Lock()
         self._voice = Voice(lang=config['main']['lang'])
@@ -135,9 +247,22 @@ class View(object):
     def on_state_change(self, key, cb):
         self._state.add_listener(key, cb)
 
-    def on_render(self, cb):
+    def on_render(self, cb, partial=False):
+        """
+        Registers cb(canvas) to get every new frame; with partial, cb(canvas, box) also gets the
+        box around what changed since the last frame, for displays that can refresh part of it
+        """
         if cb not in self._render_cbs:
             self._render_cbs.append(cb)
+        if partial and cb not in self._partial_cbs:
+            self._partial_cbs.append(cb)
+
+    def _render(self, canvas, box):
+        for cb in self._render_cbs:
+            if cb in self._partial_cbs:
+                cb(canvas, box)
+            else:
+                cb(canvas)
 
     def _refresh_handler(self):
         th_opt = pwnagotchi._theme['theme']['options']
@@ -399,78 +524,43 @@ class View(object):
             state = self._state
             changes = state.changes(ignore=self._ignore_changes)
             if force or len(changes):
-                self._canvas = Image.new('RGB', (self._width, self._height), 'white')
-                
-                drawer = ImageDraw.Draw(self._canvas)
-
                 plugins.on('ui_update', self)
-                
+
+                size = (self._width, self._height)
+                bg_path = '%s/fancygotchi/img/%s' % (pwnagotchi.fancy_root, th_opt['bg_image'])
+                modes = (th_opt['color_web'], th_opt['color_display'], th_opt['color_text'])
+                reloaded = self._background.load(bg_path, size)
+
                 copy_state = list(state.items())#way to avoid [WARNING] non fatal error while updating view: dictionary changed size during iteration
-                for key, lv in copy_state:
-                    lv.draw(self._canvas, drawer)
-
-                #-------------------------------------------------------------------------
-                bg = Image.open('%s/fancygotchi/img/%s' % (pwnagotchi.fancy_root, th_opt['bg_image']))
-
-                datas = self._canvas.getdata()
-                newData = []
-                newData_l = []
-                if th_opt['color_web']  == 'full' or th_opt['color_display'] == 'full':
-                    bga = bg.convert('RGBA')
-                    #logging.warning('A full color image is created')
-                    for item in datas:
-                        #logging.info(item)
-                        if item[0] == 255 and item[1] == 255 and item[2] == 255:
-                            newData.append((255, 255, 255, 0))
-                        else:
-                            newData.append(item) #version for color mode
-                    #RGBA image for the full color 
-                    rgba_im = Image.new('RGBA', (self._width, self._height), (255, 255, 255, 0))
-                    rgba_im.putdata(newData)
-                    bga.paste(rgba_im, (0,0), rgba_im)
-                    self._canvas = bga.convert('RGB')
-
-                if th_opt['color_web'] != 'full' or th_opt['color_display'] != 'full':
-                    # convert white to transparent & switch text if not into full color
-                    for item in datas:
-                        #logging.info(item)
-                        if item[0] == 255 and item[1] == 255 and item[2] == 255:
-                            # white to transparent
-                            newData_l.append((255, 255, 255, 0))
-                        else:
-                            if th_opt['color_text'] == 'black':
-                                #logging.warning('text is black')
-                                newData_l.append((0, 0, 0, 255))
-                            if th_opt['color_text'] == 'white':
-                                #logging.warning('text is white')
-                                newData_l.append((255, 255, 255, 255))
-                            if th_opt['color_text'] == 'auto':
-                                #logging.warning('pale text is white and dark text is black')
-                                color_sum = item[0] + item[1] + item[2]
-                                if color_sum < 500:
-                                    # color is dark
-                                    newData.append((0, 0, 0, 255))
-                                else:
-                                    # color is pale
-                                    newData_l.append((255, 255, 255, 255))
-                    #RGBA image for the low color 
-                    
-                    if th_opt['color_web'] == '2' or th_opt['color_display'] == '2':
-                        bga = bg.convert('RGBA')
-                        #logging.warning('A 1bit image is created')
-                        rgba_im_2 = Image.new('RGBA', (self._width, self._height), (255, 255, 255, 0))
-                        rgba_im_2.putdata(newData_l)
-                        bga.paste(rgba_im_2, (0,0), rgba_im_2)
-                        self._canvas_2 = bga.convert('1')
-                        
-                    if th_opt['color_web'] == '3' or th_opt['color_display'] == '3':
-                        bga = bg.convert('RGBA')
-                        #logging.warning('A grayscale image is created')
-                        rgba_im_3 = Image.new('RGBA', (self._width, self._height), (255, 255, 255, 0))
-                        rgba_im_3.putdata(newData_l)
-                        bga.paste(rgba_im_3, (0,0), rgba_im_3)
-                        self._canvas_3 = bga.convert('L')
+                full = force or reloaded or modes != self._modes or self._drawn is None
+                if full:
+                    self._drawn = Image.new('RGB', size, 'white')
+                    self._scratch = Image.new('RGB', size, 'white')
+                    self._boxes = {key: _clip(lv.bbox(size), size) for key, lv in copy_state}
+                    self._modes = modes
+                    damage = [(0, 0) + size]
+                else:
+                    # where the changed widgets were and where they are now, with what the
+                    # ui_update plugins just set; ignored elements are no damage of their own
+                    changes = state.changes(ignore=self._ignore_changes)
+                    damage = [self._boxes.pop(key, None) for key in changes]
+                    for key, lv in copy_state:
+                        if key not in self._boxes:
+                            self._boxes[key] = _clip(lv.bbox(size), size)
+                            damage.append(self._boxes[key])
+                    damage = _merge(damage)
+                self._state.reset()
+                if not damage:
+                    return
+
+                try:
+                    self._redraw(copy_state, damage, full)
+                except Exception:
+                    self._drawn = None  # start over with the next frame
+                    raise
 
+                box = (min(b[0] for b in damage), min(b[1] for b in damage),
+                       max(b[2] for b in damage), max(b[3] for b in damage))
                 if th_opt['color_web'] == 'full':
                     #logging.warning('The web UI is full color')
                     web.update_frame(self._canvas)
@@ -483,15 +573,60 @@ class View(object):
 
                 if th_opt['color_display'] == 'full':
                     #logging.warning('The display is full color')
-                    for cb in self._render_cbs:
-                        cb(self._canvas)
+                    self._render(self._canvas, box)
                 elif th_opt['color_display'] == '2':
                     #logging.warning('The display is 1bit')
-                    for cb in self._render_cbs:
-                        cb(self._canvas_2)
+                    # the dithering error spreads right and down, so the rows below the box
+                    # may change as well
+                    self._render(self._canvas_2, (0, box[1], self._width, self._height))
                 elif th_opt['color_display'] == '3':
                     #logging.warning('The display is grayscale')
-                    for cb in self._render_cbs:
-                        cb(self._canvas_3)
+                    self._render(self._canvas_3, box)
+
+    def _redraw(self, copy_state, damage, full):
+        """
+        Draws the widgets in the damaged boxes again and puts them on the background of new
+        frames; the frames that went out before are left as they are
+        """
+        th_opt = pwnagotchi._theme['theme']['options']
+        size = (self._width, self._height)
+        color_modes = (th_opt['color_web'], th_opt['color_display'])
+        canvas = canvas_l = None
+        if 'full' in color_modes:
+            canvas = Image.new('RGB', size) if full else self._canvas.copy()
+        if '2' in color_modes or '3' in color_modes:
+            # the 1bit frame is dithered from the whole grayscale one, dithering it box by box
+            # leaves seams at the box edges
+            canvas_l = Image.new('L', size) if full else self._canvas_l.copy()
+
+        drawer = ImageDraw.Draw(self._scratch)
+        for box in damage:
+            # overlapping widgets are drawn whole on the scratch canvas in their order, only
+            # the damaged box of it is used
+            self._scratch.paste((255, 255, 255), box)
+            for key, lv in copy_state:
+                widget_box = self._boxes.get(key)
+                if widget_box is not None and _overlaps(widget_box, box):
+                    lv.draw(self._scratch, drawer)
+            drawn = self._scratch.crop(box)
+            self._drawn.paste(drawn, box[:2])
+
+            # the widgets are drawn on white, everything else shows the background
+            mask = _drawn_mask(drawn)
+            if canvas is not None:
+                #logging.warning('A full color image is created')
+                part = self._background.get('RGB', box)
+                part.paste(drawn, (0, 0), mask)
+                canvas.paste(part, box[:2])
+            if canvas_l is not None:
+                # switch the text to black or white if not into full color
+                low = _paste_text(self._background.get('L', box), drawn, mask, th_opt['color_text'])
+                canvas_l.paste(low, box[:2])
+
+        self._canvas = canvas if canvas is not None else self._drawn
+        self._canvas_l = canvas_l
+        #logging.warning('A 1bit image is created')
+        self._canvas_2 = canvas_l.convert('1') if '2' in color_modes else None
+        #logging.warning('A grayscale image is created')
+        self._canvas_3 = canvas_l if '3' in color_modes else None
 
-                self._state.reset()
@@ -1,19 +1,126 @@
+import io
 import os
+import uuid
 import pwnagotchi
 import logging
-from threading import Lock
-
-from PIL import Image, ImageOps
+from threading import Condition, Lock
 
 frame_path = '/var/tmp/pwnagotchi/pwnagotchi.png'
 frame_format = 'PNG'
 frame_ctype = 'image/png'
-frame_lock = Lock()
+
+# the newest frame is kept in memory with a version, and only encoded when someone asks for it
+FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+JPEG_QUALITY = 85
+# longest a client waits for the next frame, in seconds
+MAX_WAIT = 30
+# the versions start over with every process, clients get it in the ETag of a frame
+BOOT_ID = uuid.uuid4().hex[:8]
+
+_frame = None
+_version = 0
+_encoded = {}  # format -> bytes of the frame of _version
+_frame_cond = Condition()
+_encode_lock = Lock()
 
 
 def update_frame(img):
-    global frame_lock, frame_path, frame_format
-    if not os.path.exists(os.path.dirname(frame_path)):
-        os.makedirs(os.path.dirname(frame_path))
-    with frame_lock:
-        img.save(frame_path, format=frame_format)
+    """
+    Makes img the newest frame; img must not be changed after that
+    """
+    global _frame, _version, _encoded
+    with _frame_cond:
+        _frame = img
+        _version += 1
+        _encoded = {}
+        _frame_cond.notify_all()
+
+
+def latest():
+    """
+    Returns (version, image) of the newest frame, (0, None) before the first one
+    """
+    with _frame_cond:
+        return _version, _frame
+
+
+def get_frame(fmt='png'):
+    """
+    Returns (version, bytes) of the newest frame encoded as fmt ('png' or 'jpeg'), each version
+    is encoded once per format; (0, None) before the first frame
+    """
+    with _frame_cond:
+        version, img, encoded = _version, _frame, _encoded
+    if img is None:
+        return 0, None
+    with _encode_lock:
+        data = encoded.get(fmt)
+        if data is None:
+            data = encoded[fmt] = _encode(img, fmt)
+    return version, data
+
+
+def wait_frame(version, timeout=MAX_WAIT):
+    """
+    Waits up to timeout seconds for a frame newer than version, returns the newest version
+    """
+    with _frame_cond:
+        _frame_cond.wait_for(lambda: _version > version, timeout=min(timeout, MAX_WAIT))
+        return _version
+
+
+def _encode(img, fmt):
+    image_format, ctype = FORMATS[fmt]
+    buf = io.BytesIO()
+    if image_format == 'JPEG':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('L' if img.mode == '1' else 'RGB')
+        img.save(buf, format=image_format, quality=JPEG_QUALITY)
+    else:
+        img.save(buf, format=image_format)
+    return buf.getvalue()
+
+
+class _FrameFile:
+    """
+    frame_lock of the stock web module: the /ui route of the web ui sends frame_path while it
+    holds it, so the newest frame is written to the file right before it is read, and nothing
+    is encoded or written while no client asks for it
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._written = 0
+
+    def acquire(self, *args, **kwargs):
+        return self._lock.acquire(*args, **kwargs)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._write()
+        except OSError as os_e:
+            logging.warning('can\'t write %s: %s' % (frame_path, os_e))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+    def _write(self):
+        version, data = get_frame(frame_format.lower())
+        if data is None or (version == self._written and os.path.exists(frame_path)):
+            return
+        if not os.path.exists(os.path.dirname(frame_path)):
+            os.makedirs(os.path.dirname(frame_path))
+        with open(frame_path, 'wb') as frame_file:
+            frame_file.write(data)
+        self._written = version
+
+
+frame_lock = _FrameFile()
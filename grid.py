@@ -1,13 +1,21 @@
 import os
+import sys
 import logging
 import time
-import glob
 import re
 
 import pwnagotchi.grid as grid
 import pwnagotchi.plugins as plugins
-from pwnagotchi.utils import StatusFile, WifiInfo, extract_from_pcap
+from pwnagotchi.utils import StatusFile, WifiInfo
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import pcap_metadata
+import upload_state
 
 
 def parse_pcap(filename):
@@ -35,16 +43,59 @@ def parse_pcap(filename):
     }
 
     try:
-        info = extract_from_pcap(filename, [WifiInfo.BSSID, WifiInfo.ESSID])
+        # streamed and cached, only falls back to the file name if there is no beacon
+        meta = pcap_metadata.get().read(filename)
+        if meta['bssid'] and meta['essid'] is not None:
+            info = {
+                WifiInfo.ESSID: meta['essid'],
+                WifiInfo.BSSID: meta['bssid'],
+            }
     except Exception as e:
         logging.error("grid: %s" % e)
 
     return info[WifiInfo.ESSID], info[WifiInfo.BSSID]
 
 
+class TokenBucket:
+    """
+    Hands out rate tokens per second, up to burst at once; the rate halves whenever the api
+    refuses a report and creeps back up while reports go through
+    """
+
+    def __init__(self, rate, burst=1, min_rate=0.1):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Waits for a token
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # go into debt, concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def feedback(self, ok):
+        with self.lock:
+            if ok:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+            else:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+
+
 class Grid(plugins.Plugin):
     __author__ = 'evilsocket@gmail.com'
-    __version__ = '1.0.1'
+    __version__ = '1.1.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin signals the unit cryptographic identity and list of pwned networks and list of pwned ' \
                       'networks to api.pwnagotchi.ai '
@@ -57,31 +108,65 @@ class Grid(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'exclude': [],
+        'reported_log': '/root/.api-report.log',
+        'rate': 5,
+        'burst': 5,
+        'workers': 4,
     }
 
     def __init__(self):
         self.options = dict()
         self.report = StatusFile('/root/.api-report.json', data_format='json')
+        self.reported = None
+        self.bucket = None
+        self.exclude_re = None
 
         self.unread_messages = 0
         self.total_messages = 0
         self.lock = Lock()
 
-    def is_excluded(self, what):
+    def _compile_filters(self):
+        """
+        Compiles the exclusion filters into one case-insensitive regex, None if there are none
+        """
+        patterns = set()
         for skip in self.options['exclude']:
             skip = skip.lower()
-            what = what.lower()
-            if skip in what or skip.replace(':', '') in what:
-                return True
-        return False
+            patterns.update(re.escape(pattern) for pattern in (skip, skip.replace(':', '')) if pattern)
+        # longest first, so a filter that contains another one still matches as a whole
+        self.exclude_re = re.compile('|'.join(sorted(patterns, key=len, reverse=True))) if patterns else None
+
+    def is_excluded(self, what):
+        if self.exclude_re is None:
+            return False
+        return self.exclude_re.search(what.lower()) is not None
 
     def on_loaded(self):
+        for opt in ('exclude', 'reported_log', 'rate', 'burst', 'workers'):
+            self.options.setdefault(opt, self.__defaults__[opt])
+        self._compile_filters()
+        self.reported = upload_state.ReportedLog(self.options['reported_log'],
+                                                 legacy=self.report.data_field_or('reported', default=list()))
+        self.bucket = TokenBucket(self.options['rate'], self.options['burst'])
         logging.info("grid plugin loaded.")
 
-    def set_reported(self, reported, net_id):
-        if net_id not in reported:
-            reported.append(net_id)
-        self.report.update(data={'reported': reported})
+    def _report_network(self, pcap_file):
+        """
+        Reports the network of one capture; returns True if it is done with (reported or
+        excluded), False if the api refused it and None if the capture has no bssid
+        """
+        essid, bssid = parse_pcap(pcap_file)
+        if not bssid:
+            logging.warning("no bssid found?!")
+            return None
+        if self.is_excluded(essid) or self.is_excluded(bssid):
+            logging.debug("not reporting %s due to exclusion filter" % pcap_file)
+            return True
+        self.bucket.acquire()
+        ok = grid.report_ap(essid, bssid)
+        self.bucket.feedback(ok)
+        return ok
 
     def check_inbox(self, agent):
         logging.debug("checking mailbox ...")
@@ -97,37 +182,34 @@ class Grid(plugins.Plugin):
     def check_handshakes(self, agent):
         logging.debug("checking pcaps")
 
-        pcap_files = glob.glob(os.path.join(agent.config()['bettercap']['handshakes'], "*.pcap"))
-        num_networks = len(pcap_files)
-        reported = self.report.data_field_or('reported', default=[])
-        num_reported = len(reported)
-        num_new = num_networks - num_reported
+        handshake_dir = agent.config()['bettercap']['handshakes']
+        pcap_files = handshake_index.get(handshake_dir).files('.pcap')
+        new = dict()  # net id -> pcap
+        for pcap_file in pcap_files:
+            net_id = os.path.basename(pcap_file).replace('.pcap', '')
+            if net_id not in self.reported:
+                new[net_id] = pcap_file
 
-        if num_new > 0:
+        if new:
             if self.options['report']:
-                logging.info("grid: %d new networks to report" % num_new)
+                logging.info("grid: %d new networks to report" % len(new))
                 logging.debug("self.options: %s" % self.options)
                 logging.debug("  exclude: %s" % self.options['exclude'])
 
-                for pcap_file in pcap_files:
-                    net_id = os.path.basename(pcap_file).replace('.pcap', '')
-                    if net_id not in reported:
-                        if self.is_excluded(net_id):
-                            logging.debug("skipping %s due to exclusion filter" % pcap_file)
-                            self.set_reported(reported, net_id)
-                            continue
-
-                        essid, bssid = parse_pcap(pcap_file)
-                        if bssid:
-                            if self.is_excluded(essid) or self.is_excluded(bssid):
-                                logging.debug("not reporting %s due to exclusion filter" % pcap_file)
-                                self.set_reported(reported, net_id)
-                            else:
-                                if grid.report_ap(essid, bssid):
-                                    self.set_reported(reported, net_id)
-                                time.sleep(1.5)
-                        else:
-                            logging.warning("no bssid found?!")
+                excluded = [net_id for net_id in new if self.is_excluded(net_id)]
+                if excluded:
+                    logging.debug("skipping %d networks due to exclusion filter" % len(excluded))
+                    self.reported.add(*excluded)
+                    for net_id in excluded:
+                        del new[net_id]
+
+                # the workers parse the pcaps ahead, the bucket paces the reports
+                with ThreadPoolExecutor(max_workers=self.options['workers']) as pool:
+                    futures = {pool.submit(self._report_network, pcap_file): net_id
+                               for net_id, pcap_file in new.items()}
+                    for future in as_completed(futures):
+                        if future.result():
+                            self.reported.add(futures[future])
             else:
                 logging.debug("grid: reporting disabled")
 
@@ -0,0 +1,274 @@
+'''
+    handshake_index keeps an in-memory index of the bettercap handshakes directory
+
+    it is not a plugin, but a helper module shared by the plugins that walk the handshakes
+    (wpa-sec, onlinehashcrack, wigle, nextcloud, dropbox_ul, grid, net-pos, hashie, discohash,
+    webgpsmap and handshakes-dl). all of them get the same index per directory:
+
+        import handshake_index
+        index = handshake_index.get(config['bettercap']['handshakes'])
+        index.missing('.22000')                       # pcaps without .22000
+        index.having('.gps.json', '.geo.json')        # pcaps with position data
+        paths, cursor = index.changed_since(cursor)   # files created/changed after cursor
+
+    the directory is scanned once, after that the index is kept current by draining inotify
+    events (linux only, no extra dependency) on every query. if inotify is not available it
+    falls back to re-scanning the directory whenever its mtime changed; in that mode a file
+    that is rewritten in place is not reported by changed_since.
+
+    the plugin loader only imports modules that are enabled in config.toml, so having this
+    file in the custom plugins directory is harmless.
+'''
+import os
+import struct
+import select
+import logging
+import threading
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+# extensions the plugins ask for, longest first so '.pcap.cracked' wins over '.pcap'
+KNOWN_EXTENSIONS = ('.pcap.cracked', '.paw-gps.json', '.net-pos.json', '.gps.json', '.geo.json',
+                    '.pcapng', '.22000', '.16800', '.2500', '.pcap')
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def get(directory):
+    """
+    Returns the shared index of directory, scanning it on first use
+    """
+    directory = os.path.normpath(directory)
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            index = _indexes[directory] = HandshakeIndex(directory)
+        return index
+
+
+def split_name(name):
+    """
+    Splits a handshake file name into (base, extension) on the known extensions
+    """
+    for ext in KNOWN_EXTENSIONS:
+        if name.endswith(ext) and len(name) > len(ext):
+            return name[:-len(ext)], ext
+    return os.path.splitext(name)
+
+
+class Inotify:
+    """
+    Minimal non-blocking inotify watch on one directory through libc
+    """
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {directory}")
+
+    def read(self):
+        """
+        Returns every queued (mask, name) event without blocking
+        """
+        events = list()
+        while select.select([self.fd], [], [], 0)[0]:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HandshakeIndex:
+    """
+    In-memory view of one handshake directory: file names, siblings per base name and a
+    change sequence for cursors
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.RLock()
+        # name -> sequence of its last change, ordered by that sequence
+        self.entries = OrderedDict()
+        # base name -> set of extensions
+        self.bases = dict()
+        self.sequence = 0
+        self.dir_mtime = None
+        self.watch = None
+        try:
+            self.watch = Inotify(directory)
+        except (OSError, AttributeError) as error:
+            logging.info(f"[handshake_index] inotify not available ({error}), polling {directory}")
+        self._scan()
+
+    def _touch(self, name):
+        self.sequence += 1
+        if name not in self.entries:
+            base, ext = split_name(name)
+            self.bases.setdefault(base, set()).add(ext)
+        self.entries[name] = self.sequence
+        self.entries.move_to_end(name)
+
+    def _forget(self, name):
+        if self.entries.pop(name, None) is None:
+            return
+        base, ext = split_name(name)
+        extensions = self.bases.get(base)
+        if extensions is not None:
+            extensions.discard(ext)
+            if not extensions:
+                del self.bases[base]
+
+    def _scan(self):
+        """
+        Full scan; keeps the sequence of files that are still there
+        """
+        try:
+            self.dir_mtime = os.stat(self.directory).st_mtime_ns
+            with os.scandir(self.directory) as entries:
+                names = {entry.name for entry in entries if not entry.is_dir()}
+        except FileNotFoundError:
+            names = set()
+        for name in [name for name in self.entries if name not in names]:
+            self._forget(name)
+        for name in names:
+            if name not in self.entries:
+                self._touch(name)
+
+    def refresh(self):
+        """
+        Applies the changes since the last query
+        """
+        with self.lock:
+            if self.watch is None:
+                try:
+                    mtime = os.stat(self.directory).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                if mtime != self.dir_mtime:
+                    self._scan()
+                return
+
+            for mask, name in self.watch.read():
+                if mask & IN_Q_OVERFLOW:
+                    logging.debug(f"[handshake_index] event queue overflow, rescanning {self.directory}")
+                    self._scan()
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    logging.info(f"[handshake_index] lost watch on {self.directory}, polling from now on")
+                    self.watch.close()
+                    self.watch = None
+                    self._scan()
+                    return
+                elif not name or mask & IN_ISDIR:
+                    continue
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget(name)
+                else:
+                    self._touch(name)
+
+    def names(self):
+        """
+        Returns the names of all files in the directory
+        """
+        with self.lock:
+            self.refresh()
+            return list(self.entries)
+
+    def isfile(self, path):
+        """
+        os.path.isfile answered from the index for paths inside the directory
+        """
+        head, name = os.path.split(path)
+        if os.path.normpath(head) != self.directory:
+            return os.path.isfile(path)
+        with self.lock:
+            self.refresh()
+            return name in self.entries
+
+    def groups(self):
+        """
+        Returns {base name: set of extensions}
+        """
+        with self.lock:
+            self.refresh()
+            return {base: set(extensions) for base, extensions in self.bases.items()}
+
+    def files(self, *extensions):
+        """
+        Returns the paths of all files with one of the extensions
+        """
+        with self.lock:
+            self.refresh()
+            return [os.path.join(self.directory, base + ext)
+                    for base, found in self.bases.items() for ext in extensions if ext in found]
+
+    def having(self, *extensions, source='.pcap'):
+        """
+        Returns the source files that have a sibling with one of the extensions
+        """
+        with self.lock:
+            self.refresh()
+            return [os.path.join(self.directory, base + source) for base, found in self.bases.items()
+                    if source in found and not found.isdisjoint(extensions)]
+
+    def missing(self, *extensions, source='.pcap'):
+        """
+        Returns the source files that have no sibling with any of the extensions
+        """
+        with self.lock:
+            self.refresh()
+            return [os.path.join(self.directory, base + source) for base, found in self.bases.items()
+                    if source in found and found.isdisjoint(extensions)]
+
+    def changed_since(self, cursor=0, extensions=()):
+        """
+        Returns (paths, cursor) of the files created or changed after cursor, limited to
+        extensions if given; pass the returned cursor to the next call
+        """
+        with self.lock:
+            self.refresh()
+            paths = list()
+            for name in reversed(self.entries):
+                if self.entries[name] <= cursor:
+                    break
+                if not extensions or split_name(name)[1] in extensions:
+                    paths.append(os.path.join(self.directory, name))
+            paths.reverse()
+            return paths, self.sequence
@@ -5,10 +5,15 @@ from pwnagotchi import plugins
 
 import logging
 import os
-import glob
+import sys
 
 import pwnagotchi
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+
 
 TEMPLATE = """
 {% extends "base.html" %}
@@ -98,8 +103,8 @@ class HandshakesDL(plugins.Plugin):
             return "Plugin not ready"
 
         if path == "/" or not path:
-            handshakes = glob.glob(os.path.join(
-                self.config['bettercap']['handshakes'], "*.pcap"))
+            handshake_dir = self.config['bettercap']['handshakes']
+            handshakes = handshake_index.get(handshake_dir).files('.pcap')
             handshakes = [os.path.basename(path)[:-5] for path in handshakes]
             return render_template_string(TEMPLATE,
                                           title="Handshakes | " + pwnagotchi.name(),
@@ -2,12 +2,21 @@ import logging
 import requests, uuid, linecache
 import subprocess
 import os
+import sys
 import json
 import pwnagotchi.plugins as plugins
-from threading import Lock
+from threading import Lock, Thread
+from flask import jsonify
 from pwnagotchi.ui.components import LabeledValue
 from pwnagotchi.utils import StatusFile, remove_whitelisted
 from json.decoder import JSONDecodeError
+
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import hcx_convert
+import handshake_index
+
 '''
 hcxpcapngtool needed, to install:
 > git clone https://github.com/ZerBea/hcxtools.git
@@ -20,7 +29,7 @@ hcxpcapngtool needed, to install:
 
 class hashespwnagotchi(plugins.Plugin):
     __author__ = 'meow@hashes.pw'
-    __version__ = '0.0.1'
+    __version__ = '0.1.0'
     __license__ = 'GPL3'
     __description__ = 'uploads handshakes to https://hashes.pw'
     __name__ = 'hashespwnagotchi'
@@ -32,6 +41,10 @@ class hashespwnagotchi(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'workers': 0,
+        'nice': 10,
+        'ionice_class': 3,
+        'batch_size': 100,
     }
 
     @property
@@ -41,6 +54,10 @@ class hashespwnagotchi(plugins.Plugin):
     def __init__(self):
         self.ready = False
         self.lock = Lock()
+        # guards pending and reporting, a report asked for while one runs is done by that one
+        self.report_lock = Lock()
+        self.pending = False
+        self.reporting = False
         try:
             self.report = StatusFile('/root/.hashespw_uploads', data_format='json')
         except JSONDecodeError:
@@ -50,6 +67,9 @@ class hashespwnagotchi(plugins.Plugin):
         self.skip = list()
         self.token = None
         self.uuid = None
+        self.pool = None
+        self.prefix = ''
+        self.status = StatusFile('/root/.hashespwnagotchi')
 
     def on_loaded(self):
         """
@@ -78,10 +98,17 @@ class hashespwnagotchi(plugins.Plugin):
             os.remove("/root/.hashespw_uploads")
             self.report = StatusFile('/root/.hashespw_uploads', data_format='json')
 
+        # 0 workers: one per cpu core
+        workers = self.options.get('workers', 0) or os.cpu_count() or 1
+        # run hcxpcapngtool and tcpdump with low cpu and io priority so live captures do not stall
+        self.prefix = 'nice -n {} ionice -c {} '.format(self.options.get('nice', 10), self.options.get('ionice_class', 3))
+        # the workers outlive config changes, they pick the new prefix up with the next pcap
+        if self.pool is None:
+            self.pool = hcx_convert.ConversionPool(self._convert, workers, name='hashespwnagotchi')
+
         if 'interval' not in self.options or not (self.status.newer_then_hours(self.options['interval'])):
-            logging.info('[hashie] Starting batch conversion of pcap files')
-            with self.lock:
-                self._process_stale_pcaps(handshake_dir)
+            logging.info('[hashie] Starting batch conversion of pcap files with {} workers'.format(workers))
+            Thread(target=self._process_stale_pcaps, args=(handshake_dir,), daemon=True).start()
 
     def on_bored(self, agent):
         self._report_handshakes(agent)
@@ -90,29 +117,47 @@ class hashespwnagotchi(plugins.Plugin):
         self._report_handshakes(agent)
 
     def on_handshake(self, agent, filename, access_point, client_station):
-        with self.lock:
-            handshake_status = []
-            fullpathNoExt = filename.split('.')[0]
-            name = filename.split('/')[-1:][0].split('.')[0]
+        if self.pool is not None:
+            self.pool.submit(filename, access_point, urgent=True,
+                             on_done=lambda pcap, success: self._report_handshakes(agent) if success else None)
+
+    def on_unload(self, ui):
+        if self.pool is not None:
+            self.pool.stop()
+
+    def on_webhook(self, path, request):
+        # /plugins/hashespwnagotchi/ returns the progress of the conversions as json
+        if self.pool is None:
+            return jsonify({'total': 0, 'done': 0, 'failed': 0, 'queued': 0, 'running': []})
+        return jsonify(self.pool.progress())
+
+    def _convert(self, filename, access_point):
+        if isinstance(filename, tuple):
+            converted = set(hcx_convert.batch_hcxpcapngtool(filename, self.prefix))
+            logging.info('[hashie] Batch job: {} of {} pcaps converted to 22000 in one run'.format(len(converted), len(filename)))
+            return {pcap: pcap in converted for pcap in filename}
+        handshake_status = []
+        fullpathNoExt = filename.split('.')[0]
+        name = filename.split('/')[-1:][0].split('.')[0]
 
-            if os.path.isfile(fullpathNoExt +  '.22000'):
-                handshake_status.append('Already have {}.22000 (EAPOL)'.format(name))
-            elif self._writeEAPOL(filename):
-                handshake_status.append('Created {}.22000 (EAPOL) from pcap'.format(name))
-                self._report_handshakes(agent)
+        if os.path.isfile(fullpathNoExt +  '.22000'):
+            handshake_status.append('Already have {}.22000 (EAPOL)'.format(name))
+        elif self._writeEAPOL(filename):
+            handshake_status.append('Created {}.22000 (EAPOL) from pcap'.format(name))
 
-            if os.path.isfile(fullpathNoExt +  '.16800'):
-                handshake_status.append('Already have {}.16800 (PMKID)'.format(name))
-            elif self._writePMKID(filename, access_point):
-                handshake_status.append('Created {}.16800 (PMKID) from pcap'.format(name))
+        if os.path.isfile(fullpathNoExt +  '.16800'):
+            handshake_status.append('Already have {}.16800 (PMKID)'.format(name))
+        elif self._writePMKID(filename, access_point):
+            handshake_status.append('Created {}.16800 (PMKID) from pcap'.format(name))
 
-            if handshake_status:
-                logging.info('[hashie] Good news:\n\t' + '\n\t'.join(handshake_status))
+        if handshake_status:
+            logging.info('[hashie] Good news:\n\t' + '\n\t'.join(handshake_status))
+        return os.path.isfile(fullpathNoExt + '.22000') or os.path.isfile(fullpathNoExt + '.16800')
 
     def _writeEAPOL(self, fullpath):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
-        result = subprocess.getoutput('hcxpcapngtool -o {}.22000 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+        result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -o {}.22000 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
         if os.path.isfile(fullpathNoExt +  '.22000'):
             logging.debug('[hashie] [+] EAPOL Success: {}.22000 created'.format(filename))
             return True
@@ -122,12 +167,12 @@ class hashespwnagotchi(plugins.Plugin):
     def _writePMKID(self, fullpath, apJSON):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
-        result = subprocess.getoutput('hcxpcapngtool -k {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+        result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -k {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
         if os.path.isfile(fullpathNoExt + '.16800'):
             logging.debug('[hashie] [+] PMKID Success: {}.16800 created'.format(filename))
             return True
         else: #make a raw dump
-            result = subprocess.getoutput('hcxpcapngtool -K {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+            result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -K {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
             if os.path.isfile(fullpathNoExt + '.16800'):
                 if self._repairPMKID(fullpath, apJSON) == False:
                     logging.debug('[hashie] [-] PMKID Fail: {}.16800 could not be repaired'.format(filename))
@@ -151,7 +196,7 @@ class hashespwnagotchi(plugins.Plugin):
             clientString.append('{}:{}'.format(apJSON['mac'].replace(':',''), apJSON['hostname'].encode('hex')))
         else:
             #attempt to extract the AP's name via hcxpcapngtool
-            result = subprocess.getoutput('hcxpcapngtool -X /tmp/{} {} >/dev/null 2>&1'.format(filename,fullpath))
+            result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -X /tmp/{} {} >/dev/null 2>&1'.format(filename,fullpath))
             if os.path.isfile('/tmp/' + filename):
                 with open('/tmp/' + filename,'r') as tempFileB:
                     temp = tempFileB.read().splitlines()
@@ -159,7 +204,7 @@ class hashespwnagotchi(plugins.Plugin):
                         clientString.append(line.split(':')[0] + ':' + line.split(':')[1].strip('\n').encode().hex())
                 os.remove('/tmp/{}'.format(filename))
             #attempt to extract the AP's name via tcpdump
-            tcpCatOut = subprocess.check_output("tcpdump -ennr " + fullpath  + " \"(type mgt subtype beacon) || (type mgt subtype probe-resp) || (type mgt subtype reassoc-resp) || (type mgt subtype assoc-req)\" 2>/dev/null | sed -E 's/.*BSSID:([0-9a-fA-F:]{17}).*\\((.*)\\).*/\\1\t\\2/g'",shell=True).decode('utf-8')
+            tcpCatOut = subprocess.check_output(self.prefix + "tcpdump -ennr " + fullpath  + " \"(type mgt subtype beacon) || (type mgt subtype probe-resp) || (type mgt subtype reassoc-resp) || (type mgt subtype assoc-req)\" 2>/dev/null | sed -E 's/.*BSSID:([0-9a-fA-F:]{17}).*\\((.*)\\).*/\\1\t\\2/g'",shell=True).decode('utf-8')
             if ":" in tcpCatOut:
                 for i in tcpCatOut.split('\n'):
                     if ":" in i:
@@ -180,30 +225,30 @@ class hashespwnagotchi(plugins.Plugin):
             return False
 
     def _process_stale_pcaps(self, handshake_dir):
-        handshakes_list = [os.path.join(handshake_dir, filename) for filename in os.listdir(handshake_dir) if filename.endswith('.pcap')]
-        failed_jobs = []
-        successful_jobs = []
-        lonely_pcaps = []
-        for num, handshake in enumerate(handshakes_list):
+        index = handshake_index.get(handshake_dir)
+        handshakes_list = index.files('.pcap')
+        isfile = index.isfile
+        batch_size = self.options.get('batch_size', 100)
+        self.pool.lonely = []
+        if batch_size > 1:
+            # one hcxpcapngtool run per chunk of pcaps, the 22000 files include the PMKIDs
+            # so only pcaps still without one get the single file conversion and PMKID repair
+            missing = index.missing('.22000')
+            for start in range(0, len(missing), batch_size):
+                self.pool.submit(tuple(missing[start:start + batch_size]), "")
+            logging.info('[hashie] Batch job: {} pcaps queued in {} chunks'.format(len(missing), self.pool.progress()['queued']))
+            self.pool.join()
+            handshakes_list = [handshake for handshake in missing if not isfile(handshake.split('.')[0] + '.22000')]
+        for handshake in handshakes_list:
             fullpathNoExt = handshake.split('.')[0]
-            pcapFileName = handshake.split('/')[-1:][0]
-            if not os.path.isfile(fullpathNoExt + '.22000'): #if no 22000, try
-                if self._writeEAPOL(handshake):
-                    successful_jobs.append('22000: ' + pcapFileName)
-                else:
-                    failed_jobs.append('22000: ' + pcapFileName)
-            if not os.path.isfile(fullpathNoExt + '.16800'): #if no 16800, try
-                if self._writePMKID(handshake, ""):
-                    successful_jobs.append('16800: ' + pcapFileName)
-                else:
-                    failed_jobs.append('16800: ' + pcapFileName)
-                    if not os.path.isfile(fullpathNoExt + '.22000'): #if no 16800 AND no 22000
-                        lonely_pcaps.append(handshake)
-                        logging.debug('[hashie] Batch job: added {} to lonely list'.format(pcapFileName))
-            if ((num + 1) % 50 == 0) or (num + 1 == len(handshakes_list)): #report progress every 50, or when done
-                logging.info('[hashie] Batch job: {}/{} done ({} fails)'.format(num + 1,len(handshakes_list),len(lonely_pcaps)))
-        if successful_jobs:
-            logging.info('[hashie] Batch job: {} new handshake files created'.format(len(successful_jobs)))
+            if not isfile(fullpathNoExt + '.22000') or not isfile(fullpathNoExt + '.16800'):
+                self.pool.submit(handshake, "")
+        logging.info('[hashie] Batch job: {} pcaps queued'.format(self.pool.progress()['queued']))
+        self.pool.join()
+        progress = self.pool.progress()
+        lonely_pcaps = list(self.pool.lonely)
+        self.status.update()
+        logging.info('[hashie] Batch job: {}/{} done ({} fails)'.format(progress['done'] + progress['failed'], progress['total'], len(lonely_pcaps)))
         if lonely_pcaps:
             logging.info('[hashie] Batch job: {} networks without enough packets to create a hash'.format(len(lonely_pcaps)))
             self._getLocations(lonely_pcaps)
@@ -272,9 +317,31 @@ class hashespwnagotchi(plugins.Plugin):
 
 
     def _report_handshakes(self, agent):
-        if not self.ready or self.lock.locked() or not self._connected_to_internet():
+        """
+        Uploads the new hashes; called from the main loop and from the conversion workers, only
+        one call uploads at a time and runs again for the calls that came in meanwhile
+        """
+        if not self.ready or not self._connected_to_internet():
             return
+        with self.report_lock:
+            self.pending = True
+            if self.reporting:
+                return
+            self.reporting = True
+        while True:
+            with self.report_lock:
+                if not self.pending:
+                    self.reporting = False
+                    return
+                self.pending = False
+            try:
+                self._upload_new(agent)
+            except Exception:
+                with self.report_lock:
+                    self.reporting = False
+                raise
 
+    def _upload_new(self, agent):
         with self.lock:
             config = agent.config()
             display = agent.view()
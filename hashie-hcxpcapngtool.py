@@ -2,13 +2,22 @@ import logging
 import io
 import subprocess
 import os
+import sys
 import json
 import pwnagotchi.plugins as plugins
-from threading import Lock
+from threading import Lock, Thread
+from flask import jsonify
 from pwnagotchi.ui.components import LabeledValue
 from pwnagotchi.ui.view import BLACK
+from pwnagotchi.utils import StatusFile
 import pwnagotchi.ui.fonts as fonts
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import hcx_convert
+import handshake_index
+
 '''
 hcxpcapngtool needed, to install:
 > git clone https://github.com/ZerBea/hcxtools.git
@@ -21,7 +30,7 @@ hcxpcapngtool needed, to install:
 
 class hashie(plugins.Plugin):
     __author__ = 'junohea.mail@gmail.com'
-    __version__ = '1.0.3'
+    __version__ = '1.1.0'
     __license__ = 'GPL3'
     __description__ = '''
                         Attempt to automatically convert pcaps to a crackable format.
@@ -97,46 +106,75 @@ class hashie(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'workers': 0,
+        'nice': 10,
+        'ionice_class': 3,
+        'batch_size': 100,
     }
 
     def __init__(self):
         logging.info("[hashie] plugin loaded")
         self.lock = Lock()
+        self.pool = None
+        self.prefix = ''
+        self.status = StatusFile('/root/.hashie')
 
     # called when everything is ready and the main loop is about to start
     def on_config_changed(self, config):
         handshake_dir = config['bettercap']['handshakes']
-        self.uuid = str(uuid.uuid5(uuid.NAMESPACE_OID, config['main']['name']))
-
+        # 0 workers: one per cpu core
+        workers = self.options.get('workers', 0) or os.cpu_count() or 1
+        # run hcxpcapngtool and tcpdump with low cpu and io priority so live captures do not stall
+        self.prefix = 'nice -n {} ionice -c {} '.format(self.options.get('nice', 10), self.options.get('ionice_class', 3))
+        # the workers outlive config changes, they pick the new prefix up with the next pcap
+        if self.pool is None:
+            self.pool = hcx_convert.ConversionPool(self._convert, workers, name='hashie')
 
         if 'interval' not in self.options or not (self.status.newer_then_hours(self.options['interval'])):
-            logging.info('[hashie] Starting batch conversion of pcap files')
-            with self.lock:
-                self._process_stale_pcaps(handshake_dir)
+            logging.info('[hashie] Starting batch conversion of pcap files with {} workers'.format(workers))
+            Thread(target=self._process_stale_pcaps, args=(handshake_dir,), daemon=True).start()
 
     def on_handshake(self, agent, filename, access_point, client_station):
-        with self.lock:
-            handshake_status = []
-            fullpathNoExt = filename.split('.')[0]
-            name = filename.split('/')[-1:][0].split('.')[0]
+        if self.pool is not None:
+            self.pool.submit(filename, access_point, urgent=True)
+
+    def on_unload(self, ui):
+        if self.pool is not None:
+            self.pool.stop()
+
+    def on_webhook(self, path, request):
+        # /plugins/hashie/ returns the progress of the conversions as json
+        if self.pool is None:
+            return jsonify({'total': 0, 'done': 0, 'failed': 0, 'queued': 0, 'running': []})
+        return jsonify(self.pool.progress())
 
-            if os.path.isfile(fullpathNoExt +  '.22000'):
-                handshake_status.append('Already have {}.22000 (EAPOL)'.format(name))
-            elif self._writeEAPOL(filename):
-                handshake_status.append('Created {}.22000 (EAPOL) from pcap'.format(name))
+    def _convert(self, filename, access_point):
+        if isinstance(filename, tuple):
+            converted = set(hcx_convert.batch_hcxpcapngtool(filename, self.prefix))
+            logging.info('[hashie] Batch job: {} of {} pcaps converted to 22000 in one run'.format(len(converted), len(filename)))
+            return {pcap: pcap in converted for pcap in filename}
+        handshake_status = []
+        fullpathNoExt = filename.split('.')[0]
+        name = filename.split('/')[-1:][0].split('.')[0]
 
-            if os.path.isfile(fullpathNoExt +  '.16800'):
-                handshake_status.append('Already have {}.16800 (PMKID)'.format(name))
-            elif self._writePMKID(filename, access_point):
-                handshake_status.append('Created {}.16800 (PMKID) from pcap'.format(name))
+        if os.path.isfile(fullpathNoExt +  '.22000'):
+            handshake_status.append('Already have {}.22000 (EAPOL)'.format(name))
+        elif self._writeEAPOL(filename):
+            handshake_status.append('Created {}.22000 (EAPOL) from pcap'.format(name))
+
+        if os.path.isfile(fullpathNoExt +  '.16800'):
+            handshake_status.append('Already have {}.16800 (PMKID)'.format(name))
+        elif self._writePMKID(filename, access_point):
+            handshake_status.append('Created {}.16800 (PMKID) from pcap'.format(name))
 
-            if handshake_status:
-                logging.info('[hashie] Good news:\n\t' + '\n\t'.join(handshake_status))
+        if handshake_status:
+            logging.info('[hashie] Good news:\n\t' + '\n\t'.join(handshake_status))
+        return os.path.isfile(fullpathNoExt + '.22000') or os.path.isfile(fullpathNoExt + '.16800')
 
     def _writeEAPOL(self, fullpath):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
-        result = subprocess.getoutput('hcxpcapngtool -o {}.22000 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+        result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -o {}.22000 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
         if os.path.isfile(fullpathNoExt +  '.22000'):
             logging.debug('[hashie] [+] EAPOL Success: {}.22000 created'.format(filename))
             return True
@@ -146,12 +184,12 @@ class hashie(plugins.Plugin):
     def _writePMKID(self, fullpath, apJSON):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
-        result = subprocess.getoutput('hcxpcapngtool -k {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+        result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -k {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
         if os.path.isfile(fullpathNoExt + '.16800'):
             logging.debug('[hashie] [+] PMKID Success: {}.16800 created'.format(filename))
             return True
         else: #make a raw dump
-            result = subprocess.getoutput('hcxpcapngtool -K {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
+            result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -K {}.16800 {} >/dev/null 2>&1'.format(fullpathNoExt,fullpath))
             if os.path.isfile(fullpathNoExt + '.16800'):
                 if self._repairPMKID(fullpath, apJSON) == False:
                     logging.debug('[hashie] [-] PMKID Fail: {}.16800 could not be repaired'.format(filename))
@@ -175,7 +213,7 @@ class hashie(plugins.Plugin):
             clientString.append('{}:{}'.format(apJSON['mac'].replace(':',''), apJSON['hostname'].encode('hex')))
         else:
             #attempt to extract the AP's name via hcxpcapngtool
-            result = subprocess.getoutput('hcxpcapngtool -X /tmp/{} {} >/dev/null 2>&1'.format(filename,fullpath))
+            result = subprocess.getoutput(self.prefix + 'hcxpcapngtool -X /tmp/{} {} >/dev/null 2>&1'.format(filename,fullpath))
             if os.path.isfile('/tmp/' + filename):
                 with open('/tmp/' + filename,'r') as tempFileB:
                     temp = tempFileB.read().splitlines()
@@ -183,7 +221,7 @@ class hashie(plugins.Plugin):
                         clientString.append(line.split(':')[0] + ':' + line.split(':')[1].strip('\n').encode().hex())
                 os.remove('/tmp/{}'.format(filename))
             #attempt to extract the AP's name via tcpdump
-            tcpCatOut = subprocess.check_output("tcpdump -ennr " + fullpath  + " \"(type mgt subtype beacon) || (type mgt subtype probe-resp) || (type mgt subtype reassoc-resp) || (type mgt subtype assoc-req)\" 2>/dev/null | sed -E 's/.*BSSID:([0-9a-fA-F:]{17}).*\\((.*)\\).*/\\1\t\\2/g'",shell=True).decode('utf-8')
+            tcpCatOut = subprocess.check_output(self.prefix + "tcpdump -ennr " + fullpath  + " \"(type mgt subtype beacon) || (type mgt subtype probe-resp) || (type mgt subtype reassoc-resp) || (type mgt subtype assoc-req)\" 2>/dev/null | sed -E 's/.*BSSID:([0-9a-fA-F:]{17}).*\\((.*)\\).*/\\1\t\\2/g'",shell=True).decode('utf-8')
             if ":" in tcpCatOut:
                 for i in tcpCatOut.split('\n'):
                     if ":" in i:
@@ -204,30 +242,31 @@ class hashie(plugins.Plugin):
             return False
 
     def _process_stale_pcaps(self, handshake_dir):
-        handshakes_list = [os.path.join(handshake_dir, filename) for filename in os.listdir(handshake_dir) if filename.endswith('.pcap')]
-        failed_jobs = []
-        successful_jobs = []
-        lonely_pcaps = []
-        for num, handshake in enumerate(handshakes_list):
-            fullpathNoExt = handshake.split('.')[0]
-            pcapFileName = handshake.split('/')[-1:][0]
-            if not os.path.isfile(fullpathNoExt + '.22000'): #if no 22000, try
-                if self._writeEAPOL(handshake):
-                    successful_jobs.append('22000: ' + pcapFileName)
-                else:
-                    failed_jobs.append('22000: ' + pcapFileName)
-            if not os.path.isfile(fullpathNoExt + '.16800'): #if no 16800, try
-                if self._writePMKID(handshake, ""):
-                    successful_jobs.append('16800: ' + pcapFileName)
-                else:
-                    failed_jobs.append('16800: ' + pcapFileName)
-                    if not os.path.isfile(fullpathNoExt + '.22000'): #if no 16800 AND no 22000
-                        lonely_pcaps.append(handshake)
-                        logging.debug('[hashie] Batch job: added {} to lonely list'.format(pcapFileName))
-            if ((num + 1) % 50 == 0) or (num + 1 == len(handshakes_list)): #report progress every 50, or when done
-                logging.info('[hashie] Batch job: {}/{} done ({} fails)'.format(num + 1,len(handshakes_list),len(lonely_pcaps)))
-        if successful_jobs:
-            logging.info('[hashie] Batch job: {} new handshake files created'.format(len(successful_jobs)))
+        index = handshake_index.get(handshake_dir)
+        handshakes_list = index.files('.pcap')
+        isfile = index.isfile
+        batch_size = self.options.get('batch_size', 100)
+        with self.lock:
+            self.pool.lonely = []
+            if batch_size > 1:
+                # one hcxpcapngtool run per chunk of pcaps, the 22000 files include the PMKIDs
+                # so only pcaps still without one get the single file conversion and PMKID repair
+                missing = index.missing('.22000')
+                for start in range(0, len(missing), batch_size):
+                    self.pool.submit(tuple(missing[start:start + batch_size]), "")
+                logging.info('[hashie] Batch job: {} pcaps queued in {} chunks'.format(len(missing), self.pool.progress()['queued']))
+                self.pool.join()
+                handshakes_list = [handshake for handshake in missing if not isfile(handshake.split('.')[0] + '.22000')]
+            for handshake in handshakes_list:
+                fullpathNoExt = handshake.split('.')[0]
+                if not isfile(fullpathNoExt + '.22000') or not isfile(fullpathNoExt + '.16800'):
+                    self.pool.submit(handshake, "")
+            logging.info('[hashie] Batch job: {} pcaps queued'.format(self.pool.progress()['queued']))
+            self.pool.join()
+            progress = self.pool.progress()
+            lonely_pcaps = list(self.pool.lonely)
+            self.status.update()
+        logging.info('[hashie] Batch job: {}/{} done ({} fails)'.format(progress['done'] + progress['failed'], progress['total'], len(lonely_pcaps)))
         if lonely_pcaps:
             logging.info('[hashie] Batch job: {} networks without enough packets to create a hash'.format(len(lonely_pcaps)))
             self._getLocations(lonely_pcaps)
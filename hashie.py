@@ -1,14 +1,202 @@
 from threading import Lock
 from pwnagotchi import plugins
+from pwnagotchi.utils import StatusFile
 import logging
 import subprocess
 import os
+import sys
 import json
+import struct
+
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import pcap_metadata
+
+EAPOL_SNAP = b'\xaa\xaa\x03\x00\x00\x00\x88\x8e'
+PMKID_KDE = b'\xdd\x14\x00\x0f\xac\x04'
+
+# eapol key information bits
+KEY_INFO_ACK = 0x0080
+KEY_INFO_MIC = 0x0100
+KEY_INFO_INSTALL = 0x0040
+KEY_INFO_SECURE = 0x0200
+
+
+class HandshakeExtractor:
+    """
+    Collects ESSIDs, EAPOL messages and PMKIDs from 802.11 frames in a single pass
+    and builds hashcat 22000 lines from them, replaces hcxpcaptool/hcxpcapngtool and tcpdump
+    """
+
+    def __init__(self):
+        self.essids = dict()  # ap mac -> essid bytes
+        self.messages = dict()  # (ap, sta) -> {message number: (replay counter, nonce, eapol, mic)}
+        self.pmkids = dict()  # (ap, sta) -> pmkid
+
+    def read(self, path):
+        for linktype, packet in pcap_metadata.iter_packets(path):
+            frame, _, _ = pcap_metadata.strip_link_header(linktype, packet)
+            if frame:
+                self.feed(frame)
+        return self
+
+    def feed(self, frame):
+        """
+        Inspects one 802.11 frame
+        """
+        if len(frame) < 24:
+            return
+        frame_type = (frame[0] >> 2) & 0x03
+        subtype = frame[0] >> 4
+        flags = frame[1]
+        if frame_type == 0:
+            if subtype in (8, 5):  # beacon, probe response
+                self._read_essid(frame[16:22], frame[36:])
+            elif subtype == 0:  # association request
+                self._read_essid(frame[16:22], frame[28:])
+            elif subtype == 2:  # reassociation request
+                self._read_essid(frame[16:22], frame[34:])
+        elif frame_type == 2 and not flags & 0x40:  # unprotected data
+            offset = 24
+            if flags & 0x03 == 0x03:
+                offset += 6
+            if subtype & 0x08:  # qos
+                offset += 2
+                if flags & 0x80:  # +htc
+                    offset += 4
+            if frame[offset:offset + 8] == EAPOL_SNAP:
+                self._read_eapol(frame[4:10], frame[10:16], frame[offset + 8:])
+
+    def _read_essid(self, bssid, tags):
+        if len(tags) >= 2 and tags[0] == 0:
+            essid = tags[2:2 + tags[1]]
+            if essid and len(essid) == tags[1] and len(essid) <= 32 and essid.strip(b'\x00'):
+                self.essids.setdefault(bytes(bssid), bytes(essid))
+
+    def _read_eapol(self, addr1, addr2, eapol):
+        if len(eapol) < 99 or eapol[1] != 3:
+            return
+        eapol_length = 4 + struct.unpack('>H', eapol[2:4])[0]
+        if eapol_length > len(eapol) or eapol_length < 99:
+            return
+        eapol = bytes(eapol[:eapol_length])
+        key_info = struct.unpack('>H', eapol[5:7])[0]
+        if key_info & 0x0007 not in (1, 2, 3):
+            return
+        replay_counter = struct.unpack('>Q', eapol[9:17])[0]
+        nonce = eapol[17:49]
+        mic = eapol[81:97]
+        if key_info & KEY_INFO_ACK:
+            ap, sta = bytes(addr2), bytes(addr1)
+            if key_info & KEY_INFO_MIC:
+                message = 3 if key_info & KEY_INFO_INSTALL else None
+            else:
+                message = 1
+                key_data = eapol[99:]
+                found = key_data.find(PMKID_KDE)
+                if found != -1:
+                    pmkid = key_data[found + 6:found + 22]
+                    if len(pmkid) == 16 and pmkid.strip(b'\x00'):
+                        self.pmkids.setdefault((ap, sta), pmkid)
+        else:
+            ap, sta = bytes(addr1), bytes(addr2)
+            if not key_info & KEY_INFO_MIC:
+                return
+            message = 4 if key_info & KEY_INFO_SECURE else 2
+        if message is None:
+            return
+        messages = self.messages.setdefault((ap, sta), dict())
+        # keep the first of each message, it is the one most likely to belong to one exchange
+        messages.setdefault(message, (replay_counter, nonce, eapol, mic))
+
+    def hashes(self, essid_hints=None):
+        """
+        Returns the hashcat 22000 lines: one PMKID and one EAPOL hash per AP/client pair at most
+        essid_hints: {ap mac bytes: essid bytes} used when no ESSID was seen in the capture
+        """
+        lines = list()
+        essids = dict(essid_hints or {})
+        essids.update(self.essids)
+        for (ap, sta), pmkid in self.pmkids.items():
+            if ap in essids:
+                lines.append('WPA*01*{}*{}*{}*{}***'.format(
+                    pmkid.hex(), ap.hex(), sta.hex(), essids[ap].hex()))
+        for (ap, sta), messages in self.messages.items():
+            if ap not in essids or 2 not in messages:
+                continue
+            replay_counter, _, eapol, mic = messages[2]
+            if 1 in messages and messages[1][0] == replay_counter:
+                anonce, message_pair = messages[1][1], 0x00  # M1 + M2, eapol from M2
+            elif 3 in messages and messages[3][0] == replay_counter + 1:
+                anonce, message_pair = messages[3][1], 0x02  # M2 + M3, eapol from M2
+            else:
+                continue
+            eapol = eapol[:81] + b'\x00' * 16 + eapol[97:]
+            lines.append('WPA*02*{}*{}*{}*{}*{}*{}*{:02x}'.format(
+                mic.hex(), ap.hex(), sta.hex(), essids[ap].hex(), anonce.hex(), eapol.hex(), message_pair))
+        return lines
+
+
+class ConversionManifest:
+    """
+    Append-only jsonl log of conversion attempts, keyed by pcap path, size and mtime,
+    so unchanged pcaps are not converted again on every start
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()  # pcap path -> [size, mtime_ns, outcome]
+        self.lines = 0
+        try:
+            with open(path, 'r') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['pcap']] = [entry['size'], entry['mtime'], entry['outcome']]
+                        self.lines += 1
+                    except (ValueError, KeyError):
+                        continue  # torn write at power loss
+        except FileNotFoundError:
+            pass
+
+    def outcome(self, pcap, stat):
+        """
+        Returns the recorded outcome if the pcap did not change since, else None
+        """
+        entry = self.entries.get(pcap)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def record(self, pcap, stat, outcome):
+        self.entries[pcap] = [stat.st_size, stat.st_mtime_ns, outcome]
+        with open(self.path, 'a') as manifest:
+            manifest.write(json.dumps({'pcap': pcap, 'size': stat.st_size,
+                                       'mtime': stat.st_mtime_ns, 'outcome': outcome}) + '\n')
+        self.lines += 1
+
+    def compact(self, existing_pcaps):
+        """
+        Rewrites the log with one line per existing pcap, if it grew twice as large or has deleted pcaps
+        """
+        existing_pcaps = set(existing_pcaps)
+        stale = [pcap for pcap in self.entries if pcap not in existing_pcaps]
+        if not stale and self.lines <= 2 * len(self.entries):
+            return
+        for pcap in stale:
+            del self.entries[pcap]
+        with open(self.path + '.tmp', 'w') as manifest:
+            for pcap, (size, mtime, outcome) in self.entries.items():
+                manifest.write(json.dumps({'pcap': pcap, 'size': size, 'mtime': mtime, 'outcome': outcome}) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.lines = len(self.entries)
 
 
 class hashie(plugins.Plugin):
     __author__ = 'junohea.mail@gmail.com'
-    __version__ = '2.0.0'
+    __version__ = '2.2.0'
     __license__ = 'GPL3'
     __description__ = '''
                         Attempt to automatically convert pcaps to a crackable format.
@@ -38,10 +226,10 @@ class hashie(plugins.Plugin):
                             - When access_point data is available (on_handshake), we leverage
                                 the reported AP name and MAC to complete the hash
                             - The repair is very basic and could certainly be improved!
+                          - With native = true (the default) hashes are extracted in python,
+                              no hcxpcaptool or tcpdump needed, and saved as *.22000
+                              (EAPOL and PMKID lines in the hashcat 22000 format)
                         Todo:
-                          Make it so users dont need hcxpcaptool (unless it gets added to the base image)
-          Phase 1: Extract/construct 2500/16800 hashes through tcpdump commands
-                              Phase 2: Extract/construct 2500/16800 hashes entirely in python
                           Improve the code, a lot
                         '''
     __name__ = 'hashie'
@@ -73,10 +261,10 @@ class hashie(plugins.Plugin):
                     - When access_point data is available (on_handshake), we leverage
                         the reported AP name and MAC to complete the hash
                     - The repair is very basic and could certainly be improved!
+                    - With native = true (the default) hashes are extracted in python,
+                        no hcxpcaptool or tcpdump needed, and saved as *.22000
+                        (EAPOL and PMKID lines in the hashcat 22000 format)
                 Todo:
-                    Make it so users dont need hcxpcaptool (unless it gets added to the base image)
-    Phase 1: Extract/construct 2500/16800 hashes through tcpdump commands
-                        Phase 2: Extract/construct 2500/16800 hashes entirely in python
                     Improve the code, a lot
                 '''
     __dependencies__ = {
@@ -85,22 +273,26 @@ class hashie(plugins.Plugin):
     __defaults__ = {
         'enabled': False,
         'interval': 1,
+        'native': True,
+        'manifest': '/root/.hashie_manifest.jsonl',
     }
 
     def __init__(self):
         logging.info("[hashie] plugin loaded")
         self.lock = Lock()
+        self.manifest = None
+        self.status = StatusFile('/root/.hashie')
 
     # called when everything is ready and the main loop is about to start
     def on_config_changed(self, config):
         handshake_dir = config['bettercap']['handshakes']
-        self.uuid = str(uuid.uuid5(uuid.NAMESPACE_OID, config['main']['name']))
-
+        self.manifest = ConversionManifest(self.options.get('manifest', '/root/.hashie_manifest.jsonl'))
 
         if 'interval' not in self.options or not (self.status.newer_then_hours(self.options['interval'])):
             logging.info('[hashie] Starting batch conversion of pcap files')
             with self.lock:
                 self._process_stale_pcaps(handshake_dir)
+                self.status.update()
 
     def on_handshake(self, agent, filename, access_point, client_station):
         with self.lock:
@@ -108,22 +300,66 @@ class hashie(plugins.Plugin):
             fullpathNoExt = filename.split('.')[0]
             name = filename.split('/')[-1:][0].split('.')[0]
 
-            if os.path.isfile(fullpathNoExt + '.2500'):
-                handshake_status.append(
-                    'Already have {}.2500 (EAPOL)'.format(name))
-            elif self._writeEAPOL(filename):
-                handshake_status.append(
-                    'Created {}.2500 (EAPOL) from pcap'.format(name))
+            if self.options.get('native', True):
+                if os.path.isfile(fullpathNoExt + '.22000'):
+                    handshake_status.append(
+                        'Already have {}.22000'.format(name))
+                elif self._writeHashes(filename, access_point):
+                    handshake_status.append(
+                        'Created {}.22000 (EAPOL/PMKID) from pcap'.format(name))
+            else:
+                if os.path.isfile(fullpathNoExt + '.2500'):
+                    handshake_status.append(
+                        'Already have {}.2500 (EAPOL)'.format(name))
+                elif self._writeEAPOL(filename):
+                    handshake_status.append(
+                        'Created {}.2500 (EAPOL) from pcap'.format(name))
 
-            if os.path.isfile(fullpathNoExt + '.16800'):
-                handshake_status.append(
-                    'Already have {}.16800 (PMKID)'.format(name))
-            elif self._writePMKID(filename, access_point):
-                handshake_status.append(
-                    'Created {}.16800 (PMKID) from pcap'.format(name))
+                if os.path.isfile(fullpathNoExt + '.16800'):
+                    handshake_status.append(
+                        'Already have {}.16800 (PMKID)'.format(name))
+                elif self._writePMKID(filename, access_point):
+                    handshake_status.append(
+                        'Created {}.16800 (PMKID) from pcap'.format(name))
 
             if handshake_status:
                 logging.info('[hashie] Good news:\n\t\n\t'.join(handshake_status))
+            if self.manifest is not None and os.path.isfile(filename):
+                self.manifest.record(filename, os.stat(filename),
+                                     'converted' if self._is_converted(fullpathNoExt) else 'lonely')
+
+    def _is_converted(self, fullpathNoExt):
+        if self.options.get('native', True):
+            return os.path.isfile(fullpathNoExt + '.22000')
+        return os.path.isfile(fullpathNoExt + '.2500') or os.path.isfile(fullpathNoExt + '.16800')
+
+    def _writeHashes(self, fullpath, apJSON):
+        fullpathNoExt = fullpath.split('.')[0]
+        filename = fullpath.split('/')[-1:][0].split('.')[0]
+        essid_hints = dict()
+        if apJSON:
+            try:
+                mac = bytes.fromhex(apJSON['mac'].replace(':', ''))
+                if len(mac) != 6:
+                    raise ValueError('mac {!r} is not 6 bytes'.format(apJSON['mac']))
+                essid_hints[mac] = apJSON['hostname'].encode()
+            except (KeyError, AttributeError, ValueError) as error:
+                # the pcap is converted without the hint, the ESSID comes from its beacons
+                logging.debug(
+                    '[hashie] [-] No ESSID hint for {}: {}'.format(filename, error))
+        try:
+            lines = HandshakeExtractor().read(fullpath).hashes(essid_hints)
+        except (OSError, ValueError, struct.error) as error:
+            logging.debug(
+                '[hashie] [-] Could not read {}: {}'.format(filename, error))
+            return False
+        if not lines:
+            return False
+        with open(fullpathNoExt + '.22000', 'w') as hashFile:
+            hashFile.write('\n'.join(lines) + '\n')
+        logging.debug(
+            '[hashie] [+] Success: {}.22000 created ({} hashes)'.format(filename, len(lines)))
+        return True
 
     def _writeEAPOL(self, fullpath):
         fullpathNoExt = fullpath.split('.')[0]
@@ -213,33 +449,59 @@ class hashie(plugins.Plugin):
             return False
 
     def _process_stale_pcaps(self, handshake_dir):
-        handshakes_list = [os.path.join(handshake_dir, filename) for filename in os.listdir(
-            handshake_dir) if filename.endswith('.pcap')]
+        index = handshake_index.get(handshake_dir)
+        handshakes_list = index.files('.pcap')
+        isfile = index.isfile
         failed_jobs = []
         successful_jobs = []
         lonely_pcaps = []
+        skipped = 0
         for num, handshake in enumerate(handshakes_list):
             fullpathNoExt = handshake.split('.')[0]
             pcapFileName = handshake.split('/')[-1:][0]
-            if not os.path.isfile(fullpathNoExt + '.2500'):  # if no 2500, try
-                if self._writeEAPOL(handshake):
-                    successful_jobs.append('2500: ' + pcapFileName)
-                else:
-                    failed_jobs.append('2500: ' + pcapFileName)
-            if not os.path.isfile(fullpathNoExt + '.16800'):  # if no 16800, try
-                if self._writePMKID(handshake, ""):
-                    successful_jobs.append('16800: ' + pcapFileName)
-                else:
-                    failed_jobs.append('16800: ' + pcapFileName)
-                    # if no 16800 AND no 2500
-                    if not os.path.isfile(fullpathNoExt + '.2500'):
+            try:
+                stat = os.stat(handshake)
+            except OSError:
+                continue
+            # only retry pcaps that are new or changed since the last attempt
+            outcome = self.manifest.outcome(handshake, stat) if self.manifest is not None else None
+            if outcome is not None:
+                skipped += 1
+                if outcome == 'lonely':
+                    lonely_pcaps.append(handshake)
+            elif self.options.get('native', True):
+                if not isfile(fullpathNoExt + '.22000'):  # if no 22000, try
+                    if self._writeHashes(handshake, ""):
+                        successful_jobs.append('22000: ' + pcapFileName)
+                    else:
+                        failed_jobs.append('22000: ' + pcapFileName)
                         lonely_pcaps.append(handshake)
                         logging.debug(
                             '[hashie] Batch job: added {} to lonely list'.format(pcapFileName))
+            else:
+                if not isfile(fullpathNoExt + '.2500'):  # if no 2500, try
+                    if self._writeEAPOL(handshake):
+                        successful_jobs.append('2500: ' + pcapFileName)
+                    else:
+                        failed_jobs.append('2500: ' + pcapFileName)
+                if not isfile(fullpathNoExt + '.16800'):  # if no 16800, try
+                    if self._writePMKID(handshake, ""):
+                        successful_jobs.append('16800: ' + pcapFileName)
+                    else:
+                        failed_jobs.append('16800: ' + pcapFileName)
+                        # if no 16800 AND no 2500
+                        if not os.path.isfile(fullpathNoExt + '.2500'):
+                            lonely_pcaps.append(handshake)
+                            logging.debug(
+                                '[hashie] Batch job: added {} to lonely list'.format(pcapFileName))
+            if outcome is None and self.manifest is not None:
+                self.manifest.record(handshake, stat, 'converted' if self._is_converted(fullpathNoExt) else 'lonely')
             # report progress every 50, or when done
             if ((num + 1) % 50 == 0) or (num + 1 == len(handshakes_list)):
-                logging.info('[hashie] Batch job: {}/{} done ({} fails)'.format(
-                    num + 1, len(handshakes_list), len(lonely_pcaps)))
+                logging.info('[hashie] Batch job: {}/{} done ({} fails, {} unchanged since the last attempt)'.format(
+                    num + 1, len(handshakes_list), len(lonely_pcaps), skipped))
+        if self.manifest is not None:
+            self.manifest.compact(handshakes_list)
         if successful_jobs:
             logging.info('[hashie] Batch job: {} new handshake files created'.format(
                 len(successful_jobs)))
@@ -249,14 +511,22 @@ class hashie(plugins.Plugin):
             self._getLocations(lonely_pcaps)
 
     def _getLocations(self, lonely_pcaps):
-        # export a file for webgpsmap to load
+        # export a file for webgpsmap to load, unless it already lists exactly these pcaps
+        try:
+            with open('/root/.incompletePcaps', 'r') as isIncomplete:
+                if set(isIncomplete.read().splitlines()) == set(pcapFile.split('/')[-1:][0] for pcapFile in lonely_pcaps):
+                    logging.debug('[hashie] /root/.incompletePcaps is up to date')
+                    return
+        except OSError:
+            pass
+        isfile = handshake_index.get(os.path.dirname(lonely_pcaps[0])).isfile
         with open('/root/.incompletePcaps', 'w') as isIncomplete:
             count = 0
             for pcapFile in lonely_pcaps:
                 filename = pcapFile.split('/')[-1:][0]  # keep extension
                 fullpathNoExt = pcapFile.split('.')[0]
                 isIncomplete.write(filename + '\n')
-                if os.path.isfile(fullpathNoExt + '.gps.json') or os.path.isfile(fullpathNoExt + '.geo.json') or os.path.isfile(fullpathNoExt + '.paw-gps.json'):
+                if isfile(fullpathNoExt + '.gps.json') or isfile(fullpathNoExt + '.geo.json') or isfile(fullpathNoExt + '.paw-gps.json'):
                     count += 1
             if count != 0:
                 logging.info('[hashie] Used {} GPS/GEO/PAW-GPS files to find lonely networks, go check webgpsmap! ;)'.format(str(count)))
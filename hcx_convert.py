@@ -0,0 +1,213 @@
+'''
+    hcx_convert runs the pcap to hashcat conversions of the plugins that use hcxpcapngtool
+
+    it is not a plugin, but a helper module shared by hashie-hcxpcapngtool, hashespwnagotchi
+    and discohash:
+
+        import hcx_convert
+        pool = hcx_convert.ConversionPool(convert, workers, name='hashie')
+        pool.submit(filename, access_point, urgent=True)   # in on_handshake
+        pool.submit(pcap)                                   # backlog, behind the urgent ones
+        pool.submit(tuple(pcaps))                           # several pcaps in one job
+        pool.join()
+        pool.progress()                                     # for on_webhook
+
+        converted = hcx_convert.batch_hcxpcapngtool(pcaps, prefix)
+
+    convert(pcap, access_point) runs on one of the worker threads and returns whether the pcap
+    got a hash, or for a tuple of pcaps a dict of pcap -> whether it got one. a pcap submitted
+    while it is being converted, on its own or in a batch, is converted once more when the
+    running conversion is over, bettercap appends new handshakes to the capture it already has.
+
+    the plugin loader only imports modules that are enabled in config.toml, so having this
+    file in the custom plugins directory is harmless.
+'''
+import os
+import shlex
+import logging
+import tempfile
+import subprocess
+from collections import deque
+from threading import Condition, Thread
+
+
+def hashes_by_capture(lines, pcaps):
+    """
+    Sorts 22000 hash lines to the captures they came from: bettercap names captures
+    <essid>_<ap mac>.pcap, so the AP MAC of a line (and its ESSID if several captures
+    share the MAC) points to the capture
+    """
+    captures = dict()  # ap mac -> [(essid from filename, pcap)]
+    for pcap in pcaps:
+        name = os.path.basename(pcap)[:-len('.pcap')]
+        mac = name[-12:].lower()
+        captures.setdefault(mac, []).append((name[:-13], pcap))
+    hashes = dict()
+    for line in lines:
+        fields = line.split('*')
+        if len(fields) < 6 or fields[3].lower() not in captures:
+            continue
+        candidates = captures[fields[3].lower()]
+        if len(candidates) > 1:
+            try:
+                essid = bytes.fromhex(fields[5]).decode('utf-8', errors='replace')
+            except ValueError:
+                essid = None
+            matching = [candidate for candidate in candidates if candidate[0] == essid]
+            candidates = matching or candidates
+        for _, pcap in candidates:
+            hashes.setdefault(pcap, []).append(line)
+    return hashes
+
+
+def batch_hcxpcapngtool(pcaps, prefix=''):
+    """
+    Converts several pcaps with one hcxpcapngtool run into a temporary 22000 file, then
+    writes every line to the .22000 file of its capture; returns the pcaps that got one
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, 'batch.22000')
+        subprocess.run(shlex.split(prefix) + ['hcxpcapngtool', '-o', output] + list(pcaps),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not os.path.isfile(output):
+            return []
+        with open(output, 'r') as batch_file:
+            lines = [line.strip() for line in batch_file if line.strip()]
+    hashes = hashes_by_capture(lines, pcaps)
+    for pcap, pcap_lines in hashes.items():
+        with open(pcap.split('.')[0] + '.22000', 'w') as hash_file:
+            hash_file.write('\n'.join(pcap_lines) + '\n')
+    return list(hashes)
+
+
+class ConversionPool:
+    """
+    Runs pcap conversions on a bounded pool of worker threads.
+    Live handshakes are queued in front of the batch backlog.
+    """
+
+    def __init__(self, convert, workers, name='hashie'):
+        self.convert = convert  # convert(pcap, access_point) -> True if a hash was created, {pcap: bool} for a tuple
+        self.name = name
+        self.queue = deque()  # (pcap, access_point, on_done)
+        self.queued = set()
+        self.running = set()
+        self.running_pcaps = set()  # the pcaps of the running jobs, batch jobs count each of their pcaps
+        self.rerun = dict()  # pcap -> (access_point, urgent, on_done) submitted while running
+        self.lonely = list()  # pcaps without a hash
+        self.converted = set()  # pcaps with a hash
+        self.pcaps = set()  # every pcap submitted, batch jobs count each of their pcaps
+        self.stopped = False
+        self.cond = Condition()
+        for num in range(max(1, workers)):
+            Thread(target=self._work, name='{}-{}'.format(name, num), daemon=True).start()
+
+    def submit(self, pcap, access_point="", urgent=False, on_done=None):
+        with self.cond:
+            pcap = self._defer_running(pcap, access_point, urgent, on_done)
+            if pcap:
+                self._enqueue(pcap, access_point, urgent, on_done)
+
+    def _defer_running(self, pcap, access_point, urgent, on_done):
+        """
+        Sends the pcaps of a job that are being converted, on their own or in a batch, to rerun;
+        returns the job with the others, None or an empty tuple if nothing is left
+        """
+        names = pcap if isinstance(pcap, tuple) else (pcap,)
+        for name in names:
+            # the running conversion may miss what was just appended to the capture
+            if name in self.running_pcaps and (urgent or name not in self.rerun):
+                self.rerun[name] = (access_point, urgent, on_done if name == pcap else None)
+        rest = tuple(name for name in names if name not in self.running_pcaps)
+        if isinstance(pcap, tuple):
+            return rest
+        return pcap if rest else None
+
+    def _enqueue(self, pcap, access_point, urgent, on_done):
+        if pcap in self.queued:
+            if not urgent:
+                return
+            for job in self.queue:
+                if job[0] == pcap:
+                    self.queue.remove(job)
+                    break
+        else:
+            self.queued.add(pcap)
+            self.pcaps.update(pcap if isinstance(pcap, tuple) else (pcap,))
+        if urgent:
+            self.queue.appendleft((pcap, access_point, on_done))
+        else:
+            self.queue.append((pcap, access_point, on_done))
+        self.cond.notify()
+
+    def join(self):
+        """
+        Blocks until the queue is empty and no conversion is running
+        """
+        with self.cond:
+            while (self.queue or self.running) and not self.stopped:
+                self.cond.wait()
+
+    def stop(self):
+        """
+        Lets the workers end after their running conversion, queued pcaps are dropped
+        """
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.queued.clear()
+            self.rerun.clear()
+            self.cond.notify_all()
+
+    def progress(self):
+        with self.cond:
+            return {
+                'total': len(self.pcaps),
+                'done': len(self.converted),
+                'failed': len(self.lonely),
+                'queued': len(self.queue),
+                'running': sorted(os.path.basename(job) if isinstance(job, str) else '{} pcaps'.format(len(job))
+                                  for job in self.running),
+            }
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                pcap, access_point, on_done = self.queue.popleft()
+                self.queued.discard(pcap)
+                # a pcap queued before a batch with it started waits for that batch
+                pcap = self._defer_running(pcap, access_point, False, on_done)
+                if not pcap:
+                    continue
+                self.running.add(pcap)
+                self.running_pcaps.update(pcap if isinstance(pcap, tuple) else (pcap,))
+            try:
+                success = self.convert(pcap, access_point)
+            except Exception as error:
+                logging.error('[{}] Conversion of {} failed: {}'.format(self.name, pcap, error))
+                success = False
+            if isinstance(pcap, tuple) and not isinstance(success, dict):
+                success = dict.fromkeys(pcap, bool(success))
+            with self.cond:
+                self.running.discard(pcap)
+                self.running_pcaps.difference_update(pcap if isinstance(pcap, tuple) else (pcap,))
+                for name, converted in (success.items() if isinstance(success, dict) else ((pcap, success),)):
+                    if converted:
+                        self.converted.add(name)
+                        if name in self.lonely:
+                            self.lonely.remove(name)
+                    else:
+                        self.converted.discard(name)
+                        if name not in self.lonely:
+                            self.lonely.append(name)
+                for name in (pcap if isinstance(pcap, tuple) else (pcap,)):
+                    rerun = self.rerun.pop(name, None)
+                    if rerun is not None and not self.stopped:
+                        self._enqueue(name, *rerun)
+                self.cond.notify_all()
+            if on_done is not None:
+                on_done(pcap, success)
@@ -1,16 +1,117 @@
 import logging
 import json
 import os
+import sys
 import threading
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pwnagotchi import plugins
 from pwnagotchi.utils import StatusFile
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import upload_outbox
+import upload_state
+
+OUTBOX = 'net-pos'
+
+
+def _fingerprint(netpos):
+    """
+    Normalized bssid set of a net-pos scan: lower case hex without separators
+    """
+    return frozenset(access_point['macAddress'].lower().replace(':', '').replace('-', '')
+                     for access_point in netpos.get('wifiAccessPoints', ()))
+
+
+def _similarity(fingerprint, other):
+    """
+    Share of access points two scans have in common (jaccard index)
+    """
+    if not fingerprint or not other:
+        return 0.0
+    return len(fingerprint & other) / len(fingerprint | other)
+
+
+class ScanIndex:
+    """
+    Scans by fingerprint, with an inverted index bssid -> scans to find nearly identical ones
+    """
+
+    def __init__(self, similarity):
+        self.similarity = similarity
+        self.items = dict()  # fingerprint -> value
+        self.by_bssid = dict()  # bssid -> set of fingerprints
+
+    def __len__(self):
+        return len(self.items)
+
+    def find(self, fingerprint):
+        """
+        Returns the indexed fingerprint that is the same or most similar (and similar enough), or None
+        """
+        if fingerprint in self.items:
+            return fingerprint
+        best, best_similarity = None, self.similarity
+        candidates = set()
+        for bssid in fingerprint:
+            candidates.update(self.by_bssid.get(bssid, ()))
+        for candidate in candidates:
+            similarity = _similarity(fingerprint, candidate)
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return best
+
+    def add(self, fingerprint, value):
+        self.items[fingerprint] = value
+        for bssid in fingerprint:
+            self.by_bssid.setdefault(bssid, set()).add(fingerprint)
+
+
+class GeoCache(ScanIndex):
+    """
+    Geolocation results by scan fingerprint, persisted in an append-only jsonl file
+    """
+
+    def __init__(self, path, similarity):
+        super().__init__(similarity)
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as cache_file:
+                for line in cache_file:
+                    try:
+                        entry = json.loads(line)
+                        super().add(frozenset(entry['bssids']), entry['geo'])
+                    except (ValueError, KeyError):
+                        continue  # torn write at power loss
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, fingerprint):
+        """
+        Returns the cached geolocation of the same or a nearly identical scan, or None
+        """
+        with self.lock:
+            match = self.find(fingerprint)
+            return self.items[match] if match is not None else None
+
+    def add(self, fingerprint, geo):
+        with self.lock:
+            super().add(fingerprint, geo)
+            try:
+                with open(self.path, 'a') as cache_file:
+                    cache_file.write(json.dumps({'bssids': sorted(fingerprint), 'geo': geo}) + '\n')
+            except OSError as os_e:
+                logging.debug('[net-pos] can\'t write %s: %s', self.path, os_e)
+
 
 class NetPos(plugins.Plugin):
     __author__ = 'zenzen san'
-    __version__ = '3.0.0'
+    __version__ = '3.2.0'
     __license__ = 'GPL3'
     __description__ = (
         "Saves a json file with the access points with more signal whenever a handshake is captured."
@@ -28,14 +129,20 @@ class NetPos(plugins.Plugin):
         'enabled': False,
         'api_key': 'test',
         'api_url': 'https://location.services.mozilla.com/v1/geolocate?key={api}',
+        'cache': '/root/.net_pos_cache.jsonl',
+        'reported_log': '/root/.net_pos_reported.log',
+        'similarity': 0.5,
+        'workers': 4,
     }
 
     def __init__(self):
         self.report = StatusFile('/root/.net_pos_saved', data_format='json')
-        self.skip = list()
         self.ready = False
         self.lock = threading.Lock()
         self.shutdown = False
+        self.session = None
+        self.cache = None
+        self.reported = None
 
     def on_before_shutdown(self):
         self.shutdown = True
@@ -44,6 +151,17 @@ class NetPos(plugins.Plugin):
         if 'api_key' not in self.options or ('api_key' in self.options and not self.options['api_key']):
             logging.error('[net-pos] api_key isn\'t set. Can\'t use mozilla\'s api.')
             return
+
+        for opt in ('api_url', 'cache', 'reported_log', 'similarity', 'workers'):
+            self.options.setdefault(opt, self.__defaults__[opt])
+        self.cache = GeoCache(self.options['cache'], self.options['similarity'])
+        self.reported = upload_state.ReportedLog(self.options['reported_log'],
+                                                 legacy=self.report.data_field_or('reported', default=list()))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.options['workers'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
         self.ready = True
         logging.info('[net-pos] plugin loaded.')
         logging.debug(f"[net-pos] use api_url: {self.options['api_url']}")
@@ -61,6 +179,16 @@ class NetPos(plugins.Plugin):
             for x in to_save:
                 saved_file.write(x + "\n")
 
+    def _write_geo(self, np_file, scan, geo):
+        """
+        Writes the position of a scan next to it, with the time of the scan
+        """
+        geo = dict(geo)
+        if scan.get('ts'):
+            geo['ts'] = scan['ts']
+        with open(np_file.replace('.net-pos.json', '.geo.json'), 'w+t') as sf:
+            json.dump(geo, sf)
+
     def on_internet_available(self, agent):
         if not self.ready or self.lock.locked() or self.shutdown:
             return
@@ -68,54 +196,106 @@ class NetPos(plugins.Plugin):
         with self.lock:
             config = agent.config()
             display = agent.view()
-            reported = self.report.data_field_or('reported', default=list())
             handshake_dir = config['bettercap']['handshakes']
 
-            all_files = os.listdir(handshake_dir)
-            all_np_files = [os.path.join(handshake_dir, filename)
-                            for filename in all_files
-                            if filename.endswith('.net-pos.json')]
-            new_np_files = set(all_np_files) - set(reported) - set(self.skip)
-
-            if new_np_files:
-                logging.debug('[net-pos] Found %d new net-pos files. Fetching positions ...', len(new_np_files))
-                display.set('status', f"Found {len(new_np_files)} new net-pos files. Fetching positions ...")
-                display.update(force=True)
-                for idx, np_file in enumerate(new_np_files):
-                    if self.shutdown:
-                        return
-
-                    geo_file = np_file.replace('.net-pos.json', '.geo.json')
-                    if os.path.exists(geo_file):
-                        # got already the position
-                        reported.append(np_file)
-                        self.report.update(data={'reported': reported})
-                        continue
+            geo_exists = handshake_index.get(handshake_dir).isfile
 
-                    try:
-                        geo_data = self._get_geo_data(np_file)  # returns json obj
-                    except requests.exceptions.RequestException as req_e:
-                        logging.error('[net-pos] %s - RequestException: %s', np_file, req_e)
-                        self.skip += np_file
-                        continue
-                    except json.JSONDecodeError as js_e:
-                        logging.error('[net-pos] %s - JSONDecodeError: %s, removing it...', np_file, js_e)
-                        os.remove(np_file)
-                        continue
-                    except OSError as os_e:
-                        logging.error('[net-pos] %s - OSError: %s', np_file, os_e)
-                        self.skip += np_file
+            outbox = upload_outbox.get(config)
+            outbox.sync(OUTBOX, handshake_dir, ('.net-pos.json',), done=self.reported)
+            new_np_files = outbox.due(OUTBOX)
+
+            if not new_np_files:
+                return
+
+            logging.debug('[net-pos] Found %d new net-pos files. Fetching positions ...', len(new_np_files))
+            display.set('status', f"Found {len(new_np_files)} new net-pos files. Fetching positions ...")
+            display.update(force=True)
+
+            resolved = list()
+            failed = list()
+            # scans of one place are looked up once: fingerprint -> [(np_file, scan)]
+            pending = ScanIndex(self.options['similarity'])
+            for np_file in new_np_files:
+                if self.shutdown:
+                    return
+                if geo_exists(np_file.replace('.net-pos.json', '.geo.json')):
+                    # got already the position
+                    resolved.append(np_file)
+                    continue
+                try:
+                    scan = self._read_scan(np_file)
+                    fingerprint = _fingerprint(scan)
+                    geo = self.cache.lookup(fingerprint)
+                    if geo is not None:
+                        self._write_geo(np_file, scan, geo)
+                        resolved.append(np_file)
                         continue
+                except json.JSONDecodeError as js_e:
+                    logging.error('[net-pos] %s - JSONDecodeError: %s, removing it...', np_file, js_e)
+                    os.remove(np_file)
+                    outbox.forget(OUTBOX, [np_file])
+                    continue
+                except (KeyError, TypeError) as key_e:
+                    # an access point without macAddress, no point in trying it again
+                    logging.error('[net-pos] %s - malformed scan: %r', np_file, key_e)
+                    outbox.failed(OUTBOX, [np_file], key_e, permanent=True)
+                    continue
+                except OSError as os_e:
+                    logging.error('[net-pos] %s - OSError: %s', np_file, os_e)
+                    failed.append((np_file, os_e))
+                    continue
+                match = pending.find(fingerprint)
+                if match is None:
+                    pending.add(fingerprint, [(np_file, scan)])
+                else:
+                    pending.items[match].append((np_file, scan))
 
-                    with open(geo_file, 'w+t') as sf:
-                        json.dump(geo_data, sf)
+            logging.debug('[net-pos] %d files resolved from the cache, %d lookups for %d files left',
+                          len(resolved), len(pending), len(new_np_files) - len(resolved) - len(failed))
+            self._record(resolved, failed, outbox)
 
-                    reported.append(np_file)
-                    self.report.update(data={'reported': reported})
+            done = 0
+            with outbox.budget() as budget, ThreadPoolExecutor(max_workers=self.options['workers']) as pool:
+                futures = dict()
+                for fingerprint, members in pending.items.items():
+                    scan = members[0][1]
+                    if not budget.consume(len(json.dumps(scan))):
+                        logging.debug('[net-pos] outbox budget used up, the rest waits for the next round')
+                        break
+                    futures[pool.submit(self._geolocate, scan)] = (fingerprint, members)
+                for future in as_completed(futures):
+                    fingerprint, members = futures[future]
+                    resolved, failed = list(), list()
+                    try:
+                        geo = future.result()
+                        self.cache.add(fingerprint, geo)
+                        for np_file, scan in members:
+                            self._write_geo(np_file, scan, geo)
+                            resolved.append(np_file)
+                    except (requests.exceptions.RequestException, ValueError) as req_e:
+                        logging.error('[net-pos] %s - lookup failed: %s', members[0][0], req_e)
+                        failed += [(np_file, req_e) for np_file, scan in members]
+                    except OSError as os_e:
+                        logging.error('[net-pos] OSError: %s', os_e)
+                        failed += [(np_file, os_e) for np_file, scan in members]
+                    self._record(resolved, failed, outbox)
 
-                    display.set('status', f"Fetching positions ({idx + 1}/{len(new_np_files)})")
+                    done += 1
+                    display.set('status', f"Fetching positions ({done}/{len(futures)})")
                     display.update(force=True)
 
+    def _record(self, resolved, failed, outbox):
+        """
+        Saves which net-pos files got their position and which failed
+        """
+        self.reported.add(*resolved)
+        outbox.done(OUTBOX, resolved)
+        for np_file, error in failed:
+            if isinstance(error, FileNotFoundError):
+                outbox.forget(OUTBOX, [np_file])
+            else:
+                outbox.failed(OUTBOX, [np_file], error)
+
     def on_handshake(self, agent, filename, access_point, client_station):
         netpos = self._get_netpos(agent)
         if not netpos['wifiAccessPoints']:
@@ -130,6 +310,11 @@ class NetPos(plugins.Plugin):
                 json.dump(netpos, net_pos_file)
         except OSError as os_e:
             logging.error('[net-pos] %s', os_e)
+            return
+
+        # queue it right away, so the position is fetched even after a restart
+        if self.ready:
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [netpos_filename])
 
     def _get_netpos(self, agent):
         aps = agent.get_access_points()
@@ -141,24 +326,18 @@ class NetPos(plugins.Plugin):
                                                'signalStrength': access_point['rssi']})
         return netpos
 
-    def _get_geo_data(self, path, timeout=30):
-        geourl = self.options['api_url'].format(api=self.options['api_key'])
+    def _read_scan(self, path):
+        with open(path, "r") as json_file:
+            return json.load(json_file)
 
-        try:
-            with open(path, "r") as json_file:
-                data = json.load(json_file)
-        except json.JSONDecodeError as js_e:
-            raise js_e
-        except OSError as os_e:
-            raise os_e
-
-        try:
-            result = requests.post(geourl,
-                                   json=data,
-                                   timeout=timeout)
-            return_geo = result.json()
-            if data["ts"]:
-                return_geo["ts"] = data["ts"]
-            return return_geo
-        except requests.exceptions.RequestException as req_e:
-            raise req_e
+    def _geolocate(self, scan, timeout=30):
+        """
+        Looks the position of a scan up, raises ValueError if the service doesn't know it
+        """
+        geourl = self.options['api_url'].format(api=self.options['api_key'])
+        data = {'wifiAccessPoints': scan['wifiAccessPoints']}
+        result = self.session.post(geourl, json=data, timeout=timeout)
+        geo = result.json()
+        if 'location' not in geo:
+            raise ValueError(f"no position for this scan: {geo.get('error', geo)}")
+        return geo
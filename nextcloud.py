@@ -1,16 +1,32 @@
 import os
+import sys
 import logging
 import threading
 import requests
 import json
 
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pwnagotchi.utils import StatusFile
 from pwnagotchi import plugins
 from json.decoder import JSONDecodeError
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import upload_outbox
+
+OUTBOX = 'nextcloud'
+
+# ask only for what the sync needs: collections and file sizes
+PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<d:propfind xmlns:d="DAV:"><d:prop><d:resourcetype/><d:getcontentlength/></d:prop></d:propfind>')
+
+
 class nextcloud(plugins.Plugin):
     __author__ = 'github@disterhoft.de'
-    __version__ = '0.0.1'
+    __version__ = '0.2.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin automatically uploads handshakes to a nextcloud webdav endpoint.'
     __name__ = 'nextcloud'
@@ -22,6 +38,7 @@ class nextcloud(plugins.Plugin):
     }
     __defaults__ = {
         'enabled': False,
+        'workers': 4,
     }
 
     def __init__(self):
@@ -34,7 +51,6 @@ class nextcloud(plugins.Plugin):
             self.report = StatusFile('/root/.nextcloud_uploads', data_format='json')
 
         self.options = dict()
-        self.skip = list()
 
         self.session = None
         self.full_url = None
@@ -45,6 +61,9 @@ class nextcloud(plugins.Plugin):
     def _make_session(self):
         s = requests.Session()
         s.auth = (self.options["user"], self.options["pass"])
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.options['workers'])
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
 
         logging.info("[nextcloud] >> send first req!")
 
@@ -61,6 +80,7 @@ class nextcloud(plugins.Plugin):
                 return False
 
             self.session = s
+            return True
         except requests.exceptions.RequestException as e:
             logging.error("nextcloud: Got an exception checking credentials!")
             raise e
@@ -78,28 +98,100 @@ class nextcloud(plugins.Plugin):
             logging.error("nextcloud: Got an exception while creating a dir.")
             raise e
 
-    def _exists_dir(self, path):
+    def _list_dir(self, path, timeout=30):
+        """
+        Returns {file name: size} of a remote directory from one depth-1 PROPFIND,
+        or None if it does not exist
+        """
         try:
-            r = self.session.request("PROPFIND", path)
-
+            r = self.session.request("PROPFIND", path, data=PROPFIND_BODY, timeout=timeout,
+                                     headers={'Depth': '1', 'Content-Type': 'application/xml; charset=utf-8'})
             if r.status_code == 404:
-                return False
-            else:
-                return True
+                return None
+            r.raise_for_status()
         except requests.exceptions.RequestException as e:
-            logging.error("nextcloud: Got an exception while checking if a dir exists.")
+            logging.error("nextcloud: Got an exception while listing a dir.")
             raise e
 
-    def _upload_to_nextcloud(self, path, timeout=30):
+        files = dict()
+        for response in ElementTree.fromstring(r.content).iter('{DAV:}response'):
+            href = response.findtext('{DAV:}href', default='')
+            if href.endswith('/') or response.find('.//{DAV:}collection') is not None:
+                continue  # the directory itself or a sub directory
+            length = response.findtext('.//{DAV:}getcontentlength')
+            files[unquote(href.rsplit('/', 1)[-1])] = int(length) if length else -1
+        return files
+
+    def _upload_to_nextcloud(self, path, timeout=30, budget=None):
+        """
+        Uploads the file, returns False if it doesn't fit into the outbox budget
+        """
         head, tail = os.path.split(path)
-        destFile = self.full_url + '/' + tail
+        destFile = self.full_url.rstrip('/') + '/' + quote(tail)
 
         with open(path, 'rb') as fp:
+            if budget is not None and not budget.consume(os.fstat(fp.fileno()).st_size):
+                return False
             try:
-                r = self.session.put(destFile, data=fp.read())
+                r = self.session.put(destFile, data=fp, timeout=timeout)
+                r.raise_for_status()
             except requests.exceptions.RequestException as e:
                 logging.error(f"nextcloud: Got an exception while uploading {path} -> {e}")
                 raise e
+        return True
+
+    def _sync(self, handshakes, reported, display, outbox):
+        """
+        Uploads the handshakes the remote directory does not have with the same size,
+        on a pool of workers sharing the session; the results go to the outbox queue and
+        the uploads draw from its budget
+        """
+        remote = self._list_dir(self.full_url)
+        if remote is None:
+            if not self._make_dir(self.full_url):
+                logging.error("nextcloud: couldn't create necessary directory")
+                return
+            remote = dict()
+
+        uploads = list()
+        gone = list()
+        there = list()
+        for handshake in handshakes:
+            try:
+                stat = os.stat(handshake)
+            except FileNotFoundError:
+                gone.append(handshake)
+                continue
+            if remote.get(os.path.basename(handshake)) == stat.st_size:
+                reported[handshake] = stat.st_mtime  # already there
+                there.append(handshake)
+            else:
+                uploads.append((handshake, stat.st_mtime))
+        outbox.forget(OUTBOX, gone)
+        outbox.done(OUTBOX, there)
+        logging.info(f"nextcloud: {len(uploads)} of {len(handshakes)} new handshakes are missing on the server")
+
+        done = 0
+        with outbox.budget() as budget, ThreadPoolExecutor(max_workers=self.options['workers']) as pool:
+            futures = {pool.submit(self._upload_to_nextcloud, handshake, budget=budget): (handshake, mtime)
+                       for handshake, mtime in uploads}
+            for future in as_completed(futures):
+                handshake, mtime = futures[future]
+                done += 1
+                try:
+                    if future.result():
+                        reported[handshake] = mtime
+                        outbox.done(OUTBOX, [handshake])
+                        logging.debug("nextcloud: Successfully uploaded %s", handshake)
+                except (requests.exceptions.RequestException, OSError) as e:
+                    outbox.failed(OUTBOX, [handshake], e)
+                    logging.error("nextcloud: %s", e)
+                # save the progress now and then, so an interrupted sync resumes where it stopped
+                if done % 25 == 0 or done == len(uploads):
+                    self.report.update(data={'reported': reported})
+                    display.set('status', f"Uploading handshakes to nextcloud ({done}/{len(uploads)})")
+                    display.update(force=True)
+        self.report.update(data={'reported': reported})
 
     def on_loaded(self):
         for opt in ['baseurl', 'user', 'pass', 'path']:
@@ -107,9 +199,16 @@ class nextcloud(plugins.Plugin):
                 logging.error(f"NEXTCLOUD: Option {opt} is not set.")
                 return
 
+        self.options.setdefault('workers', self.__defaults__['workers'])
+
         self.ready = True
         logging.info("NEXTCLOUD: Successfully loaded.")
 
+    def on_handshake(self, agent, filename, access_point, client_station):
+        # queue the new handshake right away, so it is uploaded even after a restart
+        if self.ready:
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [filename], requeue=True)
+
     def on_internet_available(self, agent):
         with self.lock:
             if self.ready:
@@ -119,61 +218,21 @@ class nextcloud(plugins.Plugin):
                 reported = self.report.data_field_or('reported', default=dict())
 
                 handshake_dir = config['bettercap']['handshakes']
-                handshake_filenames = os.listdir(handshake_dir)
-                handshake_paths = [os.path.join(handshake_dir, filename) for filename in handshake_filenames if
-                                   filename.endswith('.pcap')]
-
-                handshake_new = set(handshake_paths) - set(reported) - set(self.skip)
-
-                # filter for new files
-                handshake_new = []
-                for hs in set(handshake_paths) - set(self.skip):
-                    if hs not in reported:
-                        handshake_new.append(hs)
-                    else:
-                        if os.path.getmtime(hs) > reported[hs]:
-                            handshake_new.append(hs)
+                # the outbox keeps the attempts and the backoff, files that change are queued again,
+                # also the ones that grew while the plugin wasn't running
+                outbox = upload_outbox.get(config)
+                outbox.sync(OUTBOX, handshake_dir, ('.pcap',), done=reported, changed=True)
+                handshake_new = outbox.due(OUTBOX)
 
                 logging.info(f"[nx]: found {len(handshake_new)} new handshakes")
 
                 if handshake_new:
                     logging.info("nextcloud: Internet connectivity detected. Uploading new handshakes")
-
-                    logging.info("[nextcloud] create session START")
-
-                    self._make_session()
-
-                    logging.info("[nextcloud] check for dir Half")
-
-                    self.full_url = self._make_path(f"{self.options['path']}/")
-
-                    logging.info("[nextcloud] create session DONE")
-                    logging.info("[nextcloud] check for dir START")
-
-                    if not self._exists_dir(self.full_url):
-                        if not self._make_dir(self.full_url):
-                            logging.info("[nextcloud] check for dir Fail")
-                            logging.error("nextcloud: couldn't create necessary directory")
+                    try:
+                        if self.session is None and not self._make_session():
                             return
-
-                    logging.info("[nextcloud] check for dir DONE")
-
-                    for idx, handshake in enumerate(handshake_new):
-                        logging.info(f"[nextcloud] uploading hs {handshake}, nr {idx + 1} out of {len(handshake_new)}")
-                        display.set('status', f"Uploading handshake to nextcloud ({idx + 1}/{len(handshake_new)})")
-                        display.update(force=True)
-                        try:
-                            logging.info("[nx] upload 1")
-                            self._upload_to_nextcloud(handshake)
-                            logging.info("[nx] upload 2")
-                            reported[handshake] = os.path.getmtime(handshake)
-                            logging.info("[nx] upload 3")
-                            self.report.update(data={'reported': reported})
-                            logging.info("nextcloud: Successfully uploaded %s", handshake)
-                        except requests.exceptions.RequestException as req_e:
-                            self.skip.append(handshake)
-                            logging.error("nextcloud: %s", req_e)
-                            continue
-                        except OSError as os_e:
-                            logging.error("nextcloud: %s", os_e)
-                            continue
+                        self.full_url = self._make_path(f"{self.options['path']}/")
+                        self._sync(handshake_new, reported, display, outbox)
+                    except requests.exceptions.RequestException as req_e:
+                        self.session = None
+                        logging.error("nextcloud: %s", req_e)
@@ -1,18 +1,28 @@
 import os
+import sys
 import csv
+import hashlib
 import logging
 import re
 import requests
-from datetime import datetime
 from threading import Lock
 from pwnagotchi.utils import StatusFile, remove_whitelisted
 from pwnagotchi import plugins
 from json.decoder import JSONDecodeError
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import upload_outbox
+import upload_state
+
+OUTBOX = 'onlinehashcrack'
+
 
 class OnlineHashCrack(plugins.Plugin):
     __author__ = '33197631+dadav@users.noreply.github.com'
-    __version__ = '2.1.5'
+    __version__ = '2.3.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin automatically uploads handshakes to https://onlinehashcrack.com'
     __name__ = 'OnlineHashCrack'
@@ -28,6 +38,9 @@ class OnlineHashCrack(plugins.Plugin):
         'dashboard': '',
         'single_files': False,
         'whitelist': [],
+        'export_url': 'https://www.onlinehashcrack.com/wpa-exportcsv',
+        'reported_log': '/root/.ohc_uploads.log',
+        'download_state': '/root/.ohc_download',
     }
 
     def __init__(self):
@@ -37,9 +50,10 @@ class OnlineHashCrack(plugins.Plugin):
         except JSONDecodeError:
             os.remove('/root/.ohc_uploads')
             self.report = StatusFile('/root/.ohc_uploads', data_format='json')
-        self.skip = list()
         self.lock = Lock()
         self.shutdown = False
+        self.reported = None
+        self.download_state = None
 
     def on_config_changed(self, config):
         with self.lock:
@@ -56,6 +70,16 @@ class OnlineHashCrack(plugins.Plugin):
             logging.error("[ohc] Email isn't set. Can't upload to onlinehashcrack.com")
             return
 
+        for option in ('export_url', 'reported_log', 'download_state'):
+            self.options.setdefault(option, self.__defaults__[option])
+        try:
+            self.download_state = StatusFile(self.options['download_state'], data_format='json')
+        except JSONDecodeError:
+            os.remove(self.options['download_state'])
+            self.download_state = StatusFile(self.options['download_state'], data_format='json')
+        self.reported = upload_state.ReportedLog(self.options['reported_log'],
+                                                 legacy=self.report.data_field_or('reported', default=list()))
+
         self.ready = True
         logging.info("[ohc] OnlineHashCrack plugin loaded.")
 
@@ -80,22 +104,69 @@ class OnlineHashCrack(plugins.Plugin):
 
     def _download_cracked(self, save_file, timeout=120):
         """
-        Downloads the cracked passwords and saves them
+        Downloads the cracked passwords and saves them, if they changed
 
-        returns the number of downloaded passwords
+        returns True if save_file was rewritten
         """
         try:
             s = requests.Session()
             s.get(self.options['dashboard'], timeout=timeout)
-            result = s.get('https://www.onlinehashcrack.com/wpa-exportcsv', timeout=timeout)
-            result.raise_for_status()
-            with open(save_file, 'wb') as output_file:
-                output_file.write(result.content)
+            return upload_state.download_if_changed(s, self.options['export_url'], save_file, self.download_state, timeout=timeout)
         except requests.exceptions.RequestException as req_e:
             raise req_e
         except OSError as os_e:
             raise os_e
 
+    def _write_single_files(self, cracked_file, handshake_dir, only=None):
+        """
+        Writes a .pcap.cracked next to every cracked pcap; rows already handled by an earlier
+        run (by digest) are skipped and files that already hold the password are not touched.
+        rows without a pcap are kept as unresolved, with only just these digests are looked at
+        """
+        known = set(self.download_state.data_field_or('rows', default=list()))
+        unresolved_before = set(self.download_state.data_field_or('unresolved', default=list()))
+        # a full run drops the digests of rows that left the export
+        handled = set(known) if only is not None else set()
+        unresolved = set()
+        written = 0
+        pcap_exists = handshake_index.get(handshake_dir).isfile
+        with open(cracked_file, 'r') as cracked_list:
+            for row in csv.DictReader(cracked_list):
+                if not row['password']:
+                    continue
+                digest = hashlib.sha1('\0'.join((row['ESSID'], row['BSSID'], row['password'])).encode()).hexdigest()
+                if only is not None and digest not in only:
+                    continue
+                if digest in known:
+                    handled.add(digest)
+                    continue
+                filename = re.sub(r'[^a-zA-Z0-9]', '', row['ESSID']) + '_' + row['BSSID'].replace(':', '')
+                if not pcap_exists(os.path.join(handshake_dir, filename + '.pcap')):
+                    unresolved.add(digest)  # not ours (yet), looked at again on the next run
+                    continue
+                handled.add(digest)
+                password_file = os.path.join(handshake_dir, filename + '.pcap.cracked')
+                try:
+                    with open(password_file, 'r') as f:
+                        if f.read() == row['password']:
+                            continue
+                except OSError:
+                    pass
+                with open(password_file, 'w') as f:
+                    f.write(row['password'])
+                written += 1
+        if handled != known or unresolved != unresolved_before:
+            self.download_state.update(data=dict(self.download_state.data or dict(), rows=sorted(handled),
+                                                 unresolved=sorted(unresolved)))
+        logging.debug(f"[ohc] Wrote {written} new .pcap.cracked files")
+
+    def on_handshake(self, agent, filename, access_point, client_station):
+        """
+        Queues the new handshake right away, so it is uploaded even after a restart
+        """
+        if self.ready:
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [filename])
+
     def on_webhook(self, path, request):
         import requests
         from flask import redirect
@@ -115,54 +186,59 @@ class OnlineHashCrack(plugins.Plugin):
         with self.lock:
             display = agent.view()
             config = agent.config()
-            reported = self.report.data_field_or('reported', default=list())
             handshake_dir = config['bettercap']['handshakes']
-            handshake_filenames = os.listdir(handshake_dir)
-            handshake_paths = [os.path.join(handshake_dir, filename) for filename in handshake_filenames if
-                               filename.endswith('.pcap')]
+            outbox = upload_outbox.get(config)
+            outbox.sync(OUTBOX, handshake_dir, ('.pcap',), done=self.reported)
             # pull out whitelisted APs
-            handshake_paths = remove_whitelisted(handshake_paths, self.options['whitelist'])
-            handshake_new = set(handshake_paths) - set(reported) - set(self.skip)
+            handshake_new = remove_whitelisted(outbox.due(OUTBOX), self.options['whitelist'])
             if handshake_new:
                 logging.info("[ohc] Internet connectivity detected. Uploading new handshakes to onlinehashcrack.com")
-                for idx, handshake in enumerate(handshake_new):
-                    if self.shutdown:
-                        return
-                    display.set('status',
-                                f"Uploading handshake to onlinehashcrack.com ({idx + 1}/{len(handshake_new)})")
-                    display.update(force=True)
-                    try:
-                        self._upload_to_ohc(handshake)
-                        if handshake not in reported:
-                            reported.append(handshake)
-                            self.report.update(data={'reported': reported})
+                with outbox.budget() as budget:
+                    for idx, handshake in enumerate(handshake_new):
+                        if self.shutdown:
+                            return
+                        display.set('status',
+                                    f"Uploading handshake to onlinehashcrack.com ({idx + 1}/{len(handshake_new)})")
+                        display.update(force=True)
+                        try:
+                            if not budget.consume(os.path.getsize(handshake)):
+                                logging.debug("[ohc] outbox budget used up, the rest waits for the next round")
+                                break
+                            self._upload_to_ohc(handshake)
+                            outbox.done(OUTBOX, [handshake])
+                            self.reported.add(handshake)
                             logging.debug(f"[ohc] Successfully uploaded {handshake}")
-                    except requests.exceptions.RequestException as req_e:
-                        self.skip.append(handshake)
-                        logging.debug("[ohc] %s", req_e)
-                        continue
-                    except OSError as os_e:
-                        self.skip.append(handshake)
-                        logging.debug("[ohc] %s", os_e)
-                        continue
+                        except requests.exceptions.RequestException as req_e:
+                            outbox.failed(OUTBOX, [handshake], req_e)
+                            logging.debug("[ohc] %s", req_e)
+                            continue
+                        except FileNotFoundError as os_e:
+                            outbox.forget(OUTBOX, [handshake])
+                            logging.debug("[ohc] %s", os_e)
+                            continue
+                        except OSError as os_e:
+                            outbox.failed(OUTBOX, [handshake], os_e)
+                            logging.debug("[ohc] %s", os_e)
+                            continue
             if 'dashboard' in self.options and self.options['dashboard']:
                 cracked_file = os.path.join(handshake_dir, 'onlinehashcrack.cracked')
-                if os.path.exists(cracked_file):
-                    last_check = datetime.fromtimestamp(os.path.getmtime(cracked_file))
-                    if last_check is not None and ((datetime.now() - last_check).seconds / (60 * 60)) < 1:
-                        return
+                if os.path.exists(cracked_file) and self.download_state.newer_then_hours(1):
+                    return
+                changed = False
                 try:
-                    self._download_cracked(cracked_file)
-                    logging.info("[ohc] Downloaded cracked passwords.")
+                    changed = self._download_cracked(cracked_file)
+                    if changed:
+                        logging.info("[ohc] Downloaded cracked passwords.")
+                    else:
+                        logging.debug("[ohc] Cracked passwords did not change.")
                 except requests.exceptions.RequestException as req_e:
                     logging.debug("[ohc] %s", req_e)
                 except OSError as os_e:
                     logging.debug("[ohc] %s", os_e)
-                if 'single_files' in self.options and self.options['single_files']:
-                    with open(cracked_file, 'r') as cracked_list:
-                        for row in csv.DictReader(cracked_list):
-                            if row['password']:
-                                filename = re.sub(r'[^a-zA-Z0-9]', '', row['ESSID']) + '_' + row['BSSID'].replace(':', '')
-                                if os.path.exists(os.path.join(handshake_dir, filename + '.pcap')):
-                                    with open(os.path.join(handshake_dir, filename + '.pcap.cracked'), 'w') as f:
-                                        f.write(row['password'])
+                single_files = 'single_files' in self.options and self.options['single_files']
+                if single_files and os.path.exists(cracked_file):
+                    unresolved = self.download_state.data_field_or('unresolved', default=list())
+                    if changed:
+                        self._write_single_files(cracked_file, handshake_dir)
+                    elif unresolved:
+                        self._write_single_files(cracked_file, handshake_dir, only=set(unresolved))
@@ -0,0 +1,316 @@
+'''
+    pcap_metadata reads the access point details of a handshake capture without scapy
+
+    it is not a plugin, but a helper module shared by the plugins that need the bssid, essid,
+    encryption, channel or rssi of a pcap (wigle, grid), and its packet reader is the one
+    hashie extracts handshakes with:
+
+        import pcap_metadata
+        meta = pcap_metadata.get().read(pcap_path)
+        meta['essid'], meta['bssid'], meta['encryption'], meta['channel'], meta['rssi']
+
+        for linktype, packet in pcap_metadata.iter_packets(pcap_path):
+            frame, channel, rssi = pcap_metadata.strip_link_header(linktype, packet)
+
+    the reader streams the capture and stops at the first beacon or probe response of the
+    access point named in the file name (<essid>_<bssid>.pcap), fields it can't find are None;
+    a truncated or malformed capture raises ValueError. results are cached in an append-only
+    /root/.pcap_metadata.jsonl, keyed by path, size and mtime, so a capture is only parsed
+    again after it changed.
+
+    the plugin loader only imports modules that are enabled in config.toml, so having this
+    file in the custom plugins directory is harmless.
+'''
+import os
+import re
+import json
+import struct
+import logging
+import threading
+
+STORE_PATH = '/root/.pcap_metadata.jsonl'
+
+# pcap / pcapng link types we can find 802.11 frames in
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_PRISM = 119
+LINKTYPE_RADIOTAP = 127
+LINKTYPE_AVS = 163
+
+# (alignment, size) of the radiotap fields up to the antenna signal
+RADIOTAP_FIELDS = ((8, 8), (1, 1), (1, 1), (2, 4), (1, 2), (1, 1))
+RADIOTAP_FLAGS_FCS = 0x10
+
+# akm suite names as scapy prints them
+AKM_SUITES = {1: '802.1X', 2: 'PSK', 3: 'FT-802.1X', 4: 'FT-PSK', 5: '802.1X-SHA256', 6: 'PSK-SHA256',
+              8: 'SAE', 9: 'FT-SAE'}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get():
+    """
+    Returns the shared metadata store
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MetadataStore(STORE_PATH)
+        return _store
+
+
+def iter_packets(path):
+    """
+    Yields (linktype, packet) of a pcap or pcapng file, reading one record at a time
+    """
+    with open(path, 'rb') as pcap:
+        magic = pcap.read(4)
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian = '<' if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+            header = pcap.read(20)
+            if len(header) < 20:
+                return
+            linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0x0fffffff
+            while True:
+                record = pcap.read(16)
+                if len(record) < 16:
+                    return
+                caplen = struct.unpack(endian + 'IIII', record)[2]
+                packet = pcap.read(caplen)
+                if len(packet) < caplen:
+                    return
+                yield linktype, packet
+        elif magic == b'\x0a\x0d\x0d\x0a':
+            endian = '<'
+            linktypes = list()
+            block_type = 0x0a0d0d0a
+            while True:
+                header = pcap.read(4)
+                if len(header) < 4:
+                    return
+                if block_type == 0x0a0d0d0a:
+                    # section header: its byte order magic sets the endianness of the section
+                    byte_order = pcap.read(4)
+                    endian = '<' if byte_order == b'\x4d\x3c\x2b\x1a' else '>'
+                    linktypes = list()
+                    block_length = struct.unpack(endian + 'I', header)[0]
+                    body = byte_order + pcap.read(block_length - 12)
+                else:
+                    block_length = struct.unpack(endian + 'I', header)[0]
+                    body = pcap.read(block_length - 8)
+                if block_length < 12 or len(body) < block_length - 8:
+                    return
+                if block_type == 1:  # interface description
+                    linktypes.append(struct.unpack(endian + 'H', body[:2])[0])
+                elif block_type == 6 and len(body) >= 20:  # enhanced packet
+                    interface, _, _, caplen = struct.unpack(endian + 'IIII', body[:16])
+                    if interface < len(linktypes):
+                        yield linktypes[interface], body[20:20 + caplen]
+                elif block_type == 3 and linktypes:  # simple packet
+                    yield linktypes[0], body[4:-4]
+                elif block_type == 2 and len(body) >= 20:  # obsolete packet
+                    interface, _, _, _, caplen = struct.unpack(endian + 'HHIII', body[:16])
+                    if interface < len(linktypes):
+                        yield linktypes[interface], body[20:20 + caplen]
+                block = pcap.read(4)
+                if len(block) < 4:
+                    return
+                block_type = struct.unpack(endian + 'I', block)[0]
+
+
+def freq_to_channel(freq):
+    """
+    Returns the wifi channel of a frequency in MHz, or None
+    """
+    if freq == 2484:
+        return 14
+    if 2412 <= freq < 2484:
+        return (freq - 2407) // 5
+    if 5955 <= freq <= 7115:
+        return (freq - 5950) // 5
+    if 5000 <= freq < 5955:
+        return (freq - 5000) // 5
+    return None
+
+
+def _parse_radiotap(packet):
+    """
+    Returns (802.11 frame, channel, rssi) of a radiotap packet
+    """
+    if len(packet) < 8:
+        return None, None, None
+    length = struct.unpack('<H', packet[2:4])[0]
+    present = struct.unpack('<I', packet[4:8])[0]
+    offset = 8
+    word = present
+    while word & 0x80000000 and offset + 4 <= length:  # extended presence bitmaps
+        word = struct.unpack('<I', packet[offset:offset + 4])[0]
+        offset += 4
+    channel = rssi = None
+    fcs = False
+    for bit, (align, size) in enumerate(RADIOTAP_FIELDS):
+        if not present & (1 << bit):
+            continue
+        offset = (offset + align - 1) & ~(align - 1)
+        if offset + size > length:
+            break
+        if bit == 1:
+            fcs = bool(packet[offset] & RADIOTAP_FLAGS_FCS)
+        elif bit == 3:
+            channel = freq_to_channel(struct.unpack('<H', packet[offset:offset + 2])[0])
+        elif bit == 5:
+            rssi = struct.unpack('b', packet[offset:offset + 1])[0]
+        offset += size
+    frame = packet[length:]
+    return (frame[:-4] if fcs else frame), channel, rssi
+
+
+def strip_link_header(linktype, packet):
+    """
+    Returns (802.11 frame, channel, rssi) of a packet; frame is None for other link types
+    """
+    if linktype == LINKTYPE_IEEE802_11:
+        return packet, None, None
+    if linktype == LINKTYPE_RADIOTAP:
+        return _parse_radiotap(packet)
+    if linktype == LINKTYPE_PRISM and len(packet) >= 8:
+        return packet[struct.unpack('<I', packet[4:8])[0]:], None, None
+    if linktype == LINKTYPE_AVS and len(packet) >= 8:
+        return packet[struct.unpack('>I', packet[4:8])[0]:], None, None
+    return None, None, None
+
+
+def _akm(data, offset, oui):
+    """
+    Returns the name of the first akm suite in a RSN/WPA element body, starting at the pairwise count
+    """
+    if offset + 2 > len(data):
+        return None
+    offset += 2 + 4 * struct.unpack('<H', data[offset:offset + 2])[0]
+    if offset + 6 > len(data) or struct.unpack('<H', data[offset:offset + 2])[0] == 0:
+        return None
+    suite = data[offset + 2:offset + 6]
+    if suite[:3] != oui:
+        return None
+    return AKM_SUITES.get(suite[3])
+
+
+def _parse_beacon(frame):
+    """
+    Returns (essid, encryption, ds channel) of a beacon or probe response body
+    """
+    essid = None
+    ds_channel = None
+    crypto = set()
+    capability = struct.unpack('<H', frame[34:36])[0]
+    offset = 36
+    while offset + 2 <= len(frame):
+        element, length = frame[offset], frame[offset + 1]
+        data = frame[offset + 2:offset + 2 + length]
+        if len(data) < length:
+            break
+        if element == 0 and essid is None:
+            essid = data.rstrip(b'\0').decode('utf-8', errors='replace')
+        elif element == 3 and length == 1:
+            ds_channel = data[0]
+        elif element == 48:
+            auth = _akm(data, 6, b'\x00\x0f\xac')
+            crypto.add('WPA2/' + auth if auth else 'WPA2')
+        elif element == 221 and data[:4] == b'\x00\x50\xf2\x01':
+            auth = _akm(data, 10, b'\x00\x50\xf2')
+            crypto.add('WPA/' + auth if auth else 'WPA')
+        offset += 2 + length
+    if not crypto:
+        crypto.add('WEP' if capability & 0x0010 else 'OPN')
+    return essid, sorted(crypto), ds_channel
+
+
+def read_metadata(path):
+    """
+    Reads bssid, essid, encryption, channel and rssi of the access point of a capture; stops at
+    the first beacon or probe response of the bssid in the file name (any, if it has none)
+
+    raises ValueError if the capture is truncated or malformed
+    """
+    match = re.search(r'([0-9a-fA-F]{12})\.pcap(?:ng)?$', os.path.basename(path))
+    target = bytes.fromhex(match.group(1)) if match else None
+    meta = {'bssid': None, 'essid': None, 'encryption': None, 'channel': None, 'rssi': None}
+    if target is not None:
+        meta['bssid'] = ':'.join('%02x' % octet for octet in target)
+    try:
+        for linktype, packet in iter_packets(path):
+            frame, channel, rssi = strip_link_header(linktype, packet)
+            if frame is None or len(frame) < 36:
+                continue
+            if (frame[0] >> 2) & 0x03 != 0 or frame[0] >> 4 not in (8, 5):  # beacon, probe response
+                continue
+            bssid = frame[16:22]
+            if target is not None and bssid != target:
+                continue
+            essid, encryption, ds_channel = _parse_beacon(frame)
+            meta.update(bssid=':'.join('%02x' % octet for octet in bssid), essid=essid, encryption=encryption,
+                        channel=channel if channel is not None else ds_channel, rssi=rssi)
+            break
+    except struct.error as st_e:
+        raise ValueError(f"{path} is truncated or malformed: {st_e}")
+    return meta
+
+
+class MetadataStore:
+    """
+    read_metadata results of the captures, cached in an append-only jsonl file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = dict()  # pcap path -> [size, mtime_ns, meta]
+        self.lines = 0
+        try:
+            with open(self.path, 'r') as store:
+                for line in store:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['path']] = [entry['size'], entry['mtime'], entry['meta']]
+                        self.lines += 1
+                    except (ValueError, KeyError):
+                        continue  # torn write at power loss
+        except FileNotFoundError:
+            pass
+
+    def read(self, pcap):
+        """
+        Returns the metadata of pcap, parsing it only if it is new or changed
+        """
+        pcap = os.path.abspath(pcap)
+        stat = os.stat(pcap)
+        with self.lock:
+            entry = self.entries.get(pcap)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                return entry[2]
+
+        meta = read_metadata(pcap)
+        with self.lock:
+            self.entries[pcap] = [stat.st_size, stat.st_mtime_ns, meta]
+            try:
+                with open(self.path, 'a') as store:
+                    store.write(json.dumps({'path': pcap, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                            'meta': meta}) + '\n')
+                self.lines += 1
+                if self.lines > 2 * len(self.entries) + 100:
+                    self._compact()
+            except OSError as os_e:
+                logging.debug(f"[pcap_metadata] can't write {self.path}: {os_e}")
+        return meta
+
+    def _compact(self):
+        """
+        Rewrites the store with one line per capture that still exists
+        """
+        for pcap in [pcap for pcap in self.entries if not os.path.exists(pcap)]:
+            del self.entries[pcap]
+        with open(self.path + '.tmp', 'w') as store:
+            for pcap, (size, mtime, meta) in self.entries.items():
+                store.write(json.dumps({'path': pcap, 'size': size, 'mtime': mtime, 'meta': meta}) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.lines = len(self.entries)
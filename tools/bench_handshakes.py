@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+'''
+    bench_handshakes times the plugins that walk the handshakes directory at growing directory sizes
+
+    it generates a synthetic handshakes directory (see gen_handshakes.py) per size and times
+        - webgpsmap   Webgpsmap.load_gps_from_dir
+        - hashie      hashie._process_stale_pcaps with a converter that never finds a hash
+        - wpa-sec     WpaSec.on_internet_available diffing, uploads are a no-op
+        - grid        Grid.check_handshakes, pcap parsing and the api call are a no-op
+        - handshakes-dl  the "/" listing of HandshakesDL.on_webhook, without rendering
+    every case is run once on a fresh plugin ("first") and then --repeat times on the same
+    plugin ("best"), so caches and manifests show up in the second column.
+
+    it needs the same python environment the plugins run in (pwnagotchi, flask, requests, ...),
+    e.g. on the unit itself:
+
+        python3 tools/bench_handshakes.py --sizes 1000,10000,100000
+
+    the upload_outbox database of wpa-sec goes to the work directory
+'''
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib.util
+from types import SimpleNamespace
+
+from gen_handshakes import generate
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def load_plugin(filename):
+    """
+    Imports a plugin file of this repo as a module
+    """
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeAgent:
+    """
+    Just enough of the agent for the plugin callbacks
+    """
+
+    def __init__(self, handshake_dir, work_dir=None):
+        self._config = {'bettercap': {'handshakes': handshake_dir}, 'main': {'whitelist': []}}
+        if work_dir is not None:
+            self._config['main']['upload_outbox'] = {'path': os.path.join(work_dir, 'upload_outbox.db')}
+        self._view = SimpleNamespace(set=lambda key, value: None, update=lambda force=False: None,
+                                     on_unread_messages=lambda unread, total: None)
+
+    def config(self):
+        return self._config
+
+    def view(self):
+        return self._view
+
+
+def pcap_paths(handshake_dir):
+    return sorted(os.path.join(handshake_dir, name) for name in os.listdir(handshake_dir) if name.endswith('.pcap'))
+
+
+def bench_webgpsmap(handshake_dir, work_dir, args):
+    module = load_plugin('webgpsmap.py')
+    plugin = module.Webgpsmap()
+    plugin.options = dict(module.Webgpsmap.__defaults__)
+    plugin.on_config_changed(FakeAgent(handshake_dir).config())
+    return lambda: plugin.load_gps_from_dir(handshake_dir), None
+
+
+def bench_hashie(handshake_dir, work_dir, args):
+    module = load_plugin('hashie.py')
+    manifest = os.path.join(work_dir, 'hashie_manifest.jsonl')
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    plugin = module.hashie()
+    plugin.options = {'native': True, 'manifest': manifest}
+    plugin.manifest = module.ConversionManifest(manifest)
+    # no conversion, every pcap ends up on the lonely list; no /root/.incompletePcaps either
+    plugin._writeHashes = lambda fullpath, apJSON: False
+    plugin._getLocations = lambda lonely_pcaps: None
+    return lambda: plugin._process_stale_pcaps(handshake_dir), None
+
+
+def bench_wpasec(handshake_dir, work_dir, args):
+    module = load_plugin('wpa-sec.py')
+    paths = pcap_paths(handshake_dir)
+    reported, new = paths[args.new:], paths[:args.new]
+    plugin = module.WpaSec()
+    plugin.options = dict(module.WpaSec.__defaults__, api_key='bench')
+    plugin.on_loaded()
+    plugin._upload_to_wpasec = lambda path, timeout=30: None
+    agent = FakeAgent(handshake_dir, work_dir)
+
+    def reset():
+        outbox = module.upload_outbox.get(agent.config())
+        outbox.done(module.OUTBOX, reported)
+        outbox.enqueue(module.OUTBOX, new, requeue=True)
+    return lambda: plugin.on_internet_available(agent), reset
+
+
+def bench_grid(handshake_dir, work_dir, args):
+    module = load_plugin('grid.py')
+    log = os.path.join(work_dir, 'api-report.log')
+    reported = [os.path.basename(path)[:-len('.pcap')] for path in pcap_paths(handshake_dir)][args.new:]
+    module.parse_pcap = lambda filename: tuple(os.path.basename(filename)[:-len('.pcap')].split('_'))
+    module.grid = SimpleNamespace(report_ap=lambda essid, bssid: True)
+    plugin = module.Grid()
+    # no api to wait for, the bucket never runs dry
+    plugin.options = {'report': True, 'exclude': [], 'reported_log': log, 'rate': 1e9, 'burst': 1e9}
+    plugin.on_loaded()
+    agent = FakeAgent(handshake_dir)
+
+    def reset():
+        with open(log, 'w') as log_file:
+            log_file.writelines(net_id + '\n' for net_id in reported)
+        plugin.reported = module.upload_state.ReportedLog(log)
+    return lambda: plugin.check_handshakes(agent), reset
+
+
+def bench_handshakes_dl(handshake_dir, work_dir, args):
+    module = load_plugin('handshakes-dl.py')
+    module.render_template_string = lambda template, **kwargs: kwargs['handshakes']
+    plugin = module.HandshakesDL()
+    plugin.on_config_changed(FakeAgent(handshake_dir).config())
+    return lambda: plugin.on_webhook('/', None), None
+
+
+BENCHMARKS = {
+    'webgpsmap': bench_webgpsmap,
+    'hashie': bench_hashie,
+    'wpa-sec': bench_wpasec,
+    'grid': bench_grid,
+    'handshakes-dl': bench_handshakes_dl,
+}
+
+
+def timed(run, reset):
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time the handshake-dir plugins at growing directory sizes')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated numbers of captures')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs after the first one')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma separated benchmarks')
+    parser.add_argument('--new', type=int, default=10, help='captures wpa-sec and grid have not reported yet')
+    parser.add_argument('--workdir', help='keep the generated directories here instead of a temp dir')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_root = args.workdir or tempfile.mkdtemp(prefix='bench_handshakes_')
+    print(f"{'benchmark':<15}{'captures':>10}{'files':>10}{'first':>12}{'best':>12}")
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            handshake_dir = os.path.join(work_root, f"handshakes_{size}")
+            if not os.path.isdir(handshake_dir):
+                generate(handshake_dir, size)
+            files = len(os.listdir(handshake_dir))
+            for name in args.only.split(','):
+                work_dir = tempfile.mkdtemp(prefix=f"{name}_", dir=work_root)
+                run, reset = BENCHMARKS[name](handshake_dir, work_dir, args)
+                first = timed(run, reset)
+                best = min([timed(run, reset) for _ in range(args.repeat)], default=first)
+                print(f"{name:<15}{size:>10}{files:>10}{first:>11.3f}s{best:>11.3f}s", flush=True)
+                shutil.rmtree(work_dir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(work_root)
+
+
+if __name__ == '__main__':
+    main()
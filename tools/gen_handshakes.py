@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''
+    gen_handshakes writes a synthetic bettercap handshakes directory for benchmarks
+
+    for every capture it writes
+        - <essid>_<bssid>.pcap with one radiotap beacon frame (a valid pcap that scapy and
+          hashie can parse)
+        - a .gps.json, .geo.json or .paw-gps.json position file in the formats
+          webgpsmap's PositionFile understands (some captures get no position)
+        - a .pcap.cracked file for a share of the captures
+    plus wpa-sec.cracked.potfile and onlinehashcrack.cracked for the cracked ones.
+
+    usage: gen_handshakes.py <directory> <count> [--cracked 0.3] [--seed 0]
+'''
+import os
+import json
+import random
+import struct
+import argparse
+
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 127)  # radiotap
+RADIOTAP_HEADER = struct.pack('<BBHI', 0, 0, 8, 0)
+POSITION_FORMATS = ('.gps.json', '.geo.json', '.paw-gps.json')
+
+
+def beacon_pcap(essid, bssid, timestamp=1680350400):
+    """
+    Returns a pcap with a single beacon frame of essid/bssid (bssid as 6 bytes)
+    """
+    frame = (b'\x80\x00\x00\x00' + b'\xff' * 6 + bssid + bssid + b'\x00\x00'
+             + b'\x00' * 8 + struct.pack('<HH', 100, 0x0411)
+             + bytes([0, len(essid)]) + essid + b'\x03\x01\x06')
+    packet = RADIOTAP_HEADER + frame
+    return PCAP_HEADER + struct.pack('<IIII', timestamp, 0, len(packet), len(packet)) + packet
+
+
+def position_json(ext, lat, lng, rng):
+    """
+    Returns the content of a position file in the format of its extension
+    """
+    if ext == '.gps.json':
+        # gps plugin
+        return {'Latitude': lat, 'Longitude': lng, 'Altitude': round(rng.uniform(0, 500), 1),
+                'Updated': '2023-04-01T12:%02d:%02d.000000+00:00' % (rng.randrange(60), rng.randrange(60))}
+    if ext == '.geo.json':
+        # net-pos
+        return {'location': {'lat': lat, 'lng': lng}, 'accuracy': rng.randrange(10, 150),
+                'ts': 1680350400 + rng.randrange(86400)}
+    # paw-gps
+    return {'lat': lat, 'long': lng}
+
+
+def generate(directory, count, cracked=0.3, positions=0.9, seed=0):
+    """
+    Writes count captures to directory, returns the number of files written
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    files = 0
+    potfile = list()
+    ohc = ['ESSID,BSSID,password']
+    for num in range(count):
+        essid = 'net%d' % num
+        bssid = struct.pack('>HI', 0x02aa, num)  # locally administered, unique per capture
+        mac = bssid.hex()
+        base = os.path.join(directory, f"{essid}_{mac}")
+        with open(base + '.pcap', 'wb') as pcap:
+            pcap.write(beacon_pcap(essid.encode(), bssid))
+        files += 1
+
+        if rng.random() < positions:
+            ext = POSITION_FORMATS[num % len(POSITION_FORMATS)]
+            lat = round(rng.uniform(47.0, 55.0), 6)
+            lng = round(rng.uniform(6.0, 15.0), 6)
+            with open(base + ext, 'w') as position:
+                json.dump(position_json(ext, lat, lng, rng), position)
+            files += 1
+
+        if rng.random() < cracked:
+            password = 'pass%06d' % rng.randrange(1000000)
+            with open(base + '.pcap.cracked', 'w') as cracked_file:
+                cracked_file.write(password)
+            files += 1
+            potfile.append(f"{mac}:{rng.getrandbits(48):012x}:{essid}:{password}")
+            ohc.append(f"{essid},{':'.join(mac[i:i + 2] for i in range(0, 12, 2))},{password}")
+
+    with open(os.path.join(directory, 'wpa-sec.cracked.potfile'), 'w') as pot:
+        pot.write('\n'.join(potfile) + '\n')
+    with open(os.path.join(directory, 'onlinehashcrack.cracked'), 'w') as csv_file:
+        csv_file.write('\n'.join(ohc) + '\n')
+    return files + 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write a synthetic handshakes directory')
+    parser.add_argument('directory')
+    parser.add_argument('count', type=int, help='number of captures')
+    parser.add_argument('--cracked', type=float, default=0.3, help='share of cracked captures')
+    parser.add_argument('--positions', type=float, default=0.9, help='share of captures with position data')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    files = generate(args.directory, args.count, args.cracked, args.positions, args.seed)
+    print(f"wrote {files} files for {args.count} captures to {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+'''
+    upload_outbox is a durable queue of the files the cloud plugins still have to upload
+
+    it is not a plugin, but a helper module shared by the plugins that upload handshakes or
+    position files (wpa-sec, onlinehashcrack, nextcloud, dropbox_ul, wigle, net-pos). all of
+    them use the same sqlite database (WAL mode), with one queue per destination:
+
+        import upload_outbox
+        outbox = upload_outbox.get(agent.config())
+        outbox.enqueue('wpa-sec', [filename])                 # in on_handshake
+        outbox.sync('wpa-sec', handshake_dir, ('.pcap',))     # catch up on files from elsewhere
+        with outbox.budget() as budget:                       # in on_internet_available
+            for path in outbox.due('wpa-sec'):
+                if not budget.consume(os.path.getsize(path)):
+                    break
+                ... upload ...
+                outbox.done('wpa-sec', [path])                # or outbox.failed(...)
+
+    the queue survives restarts: failed uploads are retried with an exponential backoff
+    (attempts and next try are kept per file and destination) and given up after max_attempts.
+    sync takes the whole directory on the first call of a process and after that only what the
+    shared handshake_index saw changing, so a short connectivity window goes to uploading
+    instead of rescanning.
+
+    the plugins drain their destinations concurrently (every plugin callback runs in its own
+    thread), budget() hands all of them the same round: a deadline of time_budget seconds and a
+    shared bandwidth limit in bytes per second (0 means no limit for both). a round lasts while
+    any destination still drains in it, the first budget() after all of them are done starts
+    the next one, so every on_internet_available pass gets a round of its own. with
+    time_budget = 0 the round has no deadline and just ends with the pass. a file that doesn't
+    fit into the rest of the round stays queued for the next one.
+
+    settings go to config.toml, all optional:
+
+        main.upload_outbox.path = "/root/.upload_outbox.db"
+        main.upload_outbox.time_budget = 300
+        main.upload_outbox.bandwidth = 0
+        main.upload_outbox.max_attempts = 10
+        main.upload_outbox.backoff = 60
+
+    the plugin loader only imports modules that are enabled in config.toml, so having this
+    file in the custom plugins directory is harmless.
+'''
+import os
+import sys
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+
+DEFAULTS = {
+    'path': '/root/.upload_outbox.db',
+    'time_budget': 300,
+    'bandwidth': 0,
+    'max_attempts': 10,
+    'backoff': 60,
+}
+# longest wait between two attempts, however often a file failed
+MAX_BACKOFF = 6 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    destination TEXT NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (destination, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (destination, state, next_try);
+'''
+
+_outboxes = dict()
+_outboxes_lock = threading.Lock()
+
+
+def get(config=None):
+    """
+    Returns the shared outbox, with the settings of config['main']['upload_outbox'] if given
+    """
+    settings = dict(DEFAULTS)
+    if config is not None:
+        settings.update(config.get('main', dict()).get('upload_outbox', dict()))
+    path = os.path.normpath(settings['path'])
+    with _outboxes_lock:
+        outbox = _outboxes.get(path)
+        if outbox is None:
+            outbox = _outboxes[path] = Outbox(path)
+        outbox.settings.update(settings)
+        return outbox
+
+
+class Budget:
+    """
+    Deadline and bandwidth of one drain round, shared by all destinations
+    """
+
+    def __init__(self, seconds=0, bandwidth=0):
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.available = bandwidth
+        self.stamp = time.monotonic()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def consume(self, size):
+        """
+        Waits until size more bytes may be sent; returns False if the round ends before that
+        """
+        if not self.bandwidth:
+            return not self.expired()
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.bandwidth, self.available + (now - self.stamp) * self.bandwidth)
+            self.stamp = now
+            # go into debt and wait it off, so files bigger than one second of bandwidth pass too
+            wait = max(0.0, (size - self.available) / self.bandwidth)
+            if self.deadline is not None and now + wait > self.deadline:
+                return False
+            self.available -= size
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class Outbox:
+    """
+    Upload queues per destination in one sqlite database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.settings = dict(DEFAULTS, path=path)
+        self.lock = threading.Lock()
+        self.round = None
+        self.draining = 0  # destinations inside the current round
+        # (destination, directory) -> handshake_index cursor of the last sync
+        self.cursors = dict()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def _execute_many(self, sql, rows):
+        with self.lock, self.db:
+            self.db.executemany(sql, rows)
+
+    def enqueue(self, destination, paths, requeue=False):
+        """
+        Queues paths for destination; with requeue paths that were done or given up are queued again
+        """
+        now = time.time()
+        if requeue:
+            sql = ("INSERT INTO outbox (destination, path, updated) VALUES (?, ?, ?) "
+                   "ON CONFLICT (destination, path) DO UPDATE SET state = 'pending', attempts = 0, "
+                   "next_try = 0, error = NULL, updated = excluded.updated")
+        else:
+            sql = "INSERT OR IGNORE INTO outbox (destination, path, updated) VALUES (?, ?, ?)"
+        self._execute_many(sql, [(destination, path, now) for path in paths])
+
+    def sync(self, destination, directory, extensions, done=(), changed=False):
+        """
+        Queues the files of directory with one of extensions that are new to destination;
+        paths in done are recorded as uploaded if they are new to the outbox (migration from the
+        plugins' own lists, a dict maps them to the time of their upload), with changed files
+        that were already done are queued again
+        """
+        key = (destination, os.path.normpath(directory))
+        cursor = self.cursors.get(key)
+        paths, self.cursors[key] = handshake_index.get(directory).changed_since(cursor or 0, extensions)
+
+        if cursor is None:
+            uploaded = done if isinstance(done, dict) else dict.fromkeys(done)
+            now = time.time()
+            self._execute_many("INSERT OR IGNORE INTO outbox (destination, path, state, updated) VALUES (?, ?, ?, ?)",
+                               [(destination, path, 'done' if path in uploaded else 'pending', uploaded.get(path) or now)
+                                for path in paths])
+            if changed:
+                # files that changed while no process watched them, done before their last change
+                self.enqueue(destination, self._changed_after_done(destination, paths), requeue=True)
+        else:
+            self.enqueue(destination, paths, requeue=changed)
+
+    def _changed_after_done(self, destination, paths):
+        with self.lock:
+            updated = dict(self.db.execute("SELECT path, updated FROM outbox WHERE destination = ? AND state = 'done'",
+                                           (destination,)))
+        changed = list()
+        for path in paths:
+            if path not in updated:
+                continue
+            try:
+                if os.path.getmtime(path) > updated[path]:
+                    changed.append(path)
+            except OSError:
+                continue
+        return changed
+
+    def due(self, destination, limit=None):
+        """
+        Returns the queued paths of destination that may be tried now, new ones first
+        """
+        sql = ("SELECT path FROM outbox WHERE destination = ? AND state = 'pending' AND next_try <= ? "
+               "ORDER BY next_try, path")
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            return [row[0] for row in self.db.execute(sql, (destination, time.time()))]
+
+    def pending(self, destination):
+        """
+        Returns the number of queued paths of destination, due or not
+        """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE destination = ? AND state = 'pending'",
+                                   (destination,)).fetchone()[0]
+
+    def done(self, destination, paths):
+        """
+        Records paths as uploaded to destination
+        """
+        now = time.time()
+        self._execute_many("INSERT INTO outbox (destination, path, state, updated) VALUES (?, ?, 'done', ?) "
+                           "ON CONFLICT (destination, path) DO UPDATE SET state = 'done', attempts = 0, "
+                           "next_try = 0, error = NULL, updated = excluded.updated",
+                           [(destination, path, now) for path in paths])
+
+    def failed(self, destination, paths, error=None, permanent=False):
+        """
+        Records a failed attempt; paths are tried again after a backoff, or never if permanent
+        or after max_attempts
+        """
+        now = time.time()
+        error = str(error) if error is not None else None
+        with self.lock, self.db:
+            for path in paths:
+                row = self.db.execute("SELECT attempts FROM outbox WHERE destination = ? AND path = ?",
+                                      (destination, path)).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                state = 'failed' if permanent or attempts >= self.settings['max_attempts'] else 'pending'
+                next_try = now + min(self.settings['backoff'] * 2 ** (attempts - 1), MAX_BACKOFF)
+                self.db.execute("INSERT OR REPLACE INTO outbox (destination, path, state, attempts, next_try, "
+                                "error, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (destination, path, state, attempts, next_try, error, now))
+                if state == 'failed':
+                    logging.debug(f"[upload_outbox] giving up {path} for {destination}: {error}")
+
+    def forget(self, destination, paths):
+        """
+        Removes paths from the queue of destination, e.g. after they were deleted
+        """
+        self._execute_many("DELETE FROM outbox WHERE destination = ? AND path = ?",
+                           [(destination, path) for path in paths])
+
+    @contextmanager
+    def budget(self):
+        """
+        Yields the budget of the current drain round; a new round starts when no destination
+        is draining in the last one any more
+        """
+        with self.lock:
+            if self.round is None or not self.draining:
+                self.round = Budget(self.settings['time_budget'], self.settings['bandwidth'])
+            self.draining += 1
+            current = self.round
+        try:
+            yield current
+        finally:
+            with self.lock:
+                self.draining -= 1
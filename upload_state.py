@@ -0,0 +1,96 @@
+'''
+    upload_state keeps what the cloud plugins already sent and fetched
+
+    it is not a plugin, but a helper module shared by the plugins that report to a service
+    (wpa-sec, onlinehashcrack, grid, net-pos):
+
+        import upload_state
+        reported = upload_state.ReportedLog('/root/.ohc_uploads.log', legacy=old_list)
+        if handshake not in reported:
+            ... upload ...
+            reported.add(handshake)                      # appends one line
+
+        changed = upload_state.download_if_changed(session, url, output, state_file)
+
+    ReportedLog is an append-only file with one entry per line, held as a set in memory, so
+    recording one more upload costs one short write instead of rewriting the whole list.
+    download_if_changed sends the stored ETag/Last-Modified and only rewrites output when the
+    content changed, the state is a json StatusFile.
+
+    the plugin loader only imports modules that are enabled in config.toml, so having this
+    file in the custom plugins directory is harmless.
+'''
+import os
+import hashlib
+from threading import Lock
+
+
+class ReportedLog:
+    """
+    Append-only log of uploaded entries, one per line, so reporting one more entry
+    appends a line instead of rewriting the whole list
+    """
+
+    def __init__(self, path, legacy=None):
+        self.path = path
+        self.lock = Lock()
+        self.reported = set()
+        try:
+            with open(path, 'r') as log:
+                self.reported.update(line.rstrip('\n') for line in log if line.endswith('\n'))
+        except FileNotFoundError:
+            if legacy:
+                # first start after the json status file, take its list over once
+                self.reported.update(legacy)
+                with open(path, 'w') as log:
+                    log.writelines(entry + '\n' for entry in self.reported)
+
+    def __contains__(self, entry):
+        return entry in self.reported
+
+    def __len__(self):
+        return len(self.reported)
+
+    def __iter__(self):
+        return iter(list(self.reported))
+
+    def add(self, *entries):
+        with self.lock:
+            new = [entry for entry in dict.fromkeys(entries) if entry not in self.reported]
+            if not new:
+                return
+            with open(self.path, 'a') as log:
+                log.writelines(entry + '\n' for entry in new)
+            self.reported.update(new)
+
+
+def download_if_changed(session, url, output, state, timeout=30, **kwargs):
+    """
+    Downloads url to output, unless the server answers 304 to the stored ETag/Last-Modified
+    or the content hash equals the one of the last download; other fields of state are kept
+
+    returns True if output was (re)written
+    """
+    headers = dict()
+    if os.path.exists(output):
+        if state.data_field_or('etag', default=None):
+            headers['If-None-Match'] = state.data_field_or('etag')
+        if state.data_field_or('last_modified', default=None):
+            headers['If-Modified-Since'] = state.data_field_or('last_modified')
+    result = session.get(url, headers=headers, timeout=timeout, **kwargs)
+    if result.status_code == 304:
+        state.update(data=state.data)  # remember the time of the check
+        return False
+    result.raise_for_status()
+
+    digest = hashlib.sha256(result.content).hexdigest()
+    changed = digest != state.data_field_or('sha256', default=None) or not os.path.exists(output)
+    if changed:
+        with open(output + '.tmp', 'wb') as output_file:
+            output_file.write(result.content)
+        os.replace(output + '.tmp', output)
+    state.update(data=dict(state.data or dict(),
+                           etag=result.headers.get('ETag'),
+                           last_modified=result.headers.get('Last-Modified'),
+                           sha256=digest))
+    return changed
@@ -9,22 +9,41 @@
               position as green instead of red and the password inside the infopox of the position
     special:
         you can save the html-map as one file for offline use or host on your own webspace with "/plugins/webgpsmap/offlinemap"
+        "/plugins/webgpsmap/newest?since=<cursor>" returns only positions added or changed after <cursor> plus the
+        cursor for the next request
+        "/plugins/webgpsmap/positions?bbox=<west>,<south>,<east>,<north>&zoom=<zoom>&q=<search>" returns the
+        positions of the viewport, pre-clustered on a grid per zoom level, the map page only loads these
 
 '''
 import sys
 import logging
 import os
 import json
+import math
 import re
+import threading
+import zlib
+from collections import OrderedDict
 from pwnagotchi import plugins
 from flask import Response
-from functools import lru_cache
 from dateutil.parser import parse
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+
+# position file extensions in ascending priority, the last found one wins
+POSITION_EXTENSIONS = ('.gps.json', '.geo.json', '.paw-gps.json')
+# every extension load_gps_from_dir cares about
+INDEXED_EXTENSIONS = ('.pcap', '.pcap.cracked') + POSITION_EXTENSIONS
+# grid cells per 256px map tile edge, a cluster covers roughly 64x64 pixels
+CELLS_PER_TILE = 4
+
 
 class Webgpsmap(plugins.Plugin):
     __author__ = 'https://github.com/xenDE and https://github.com/dadav'
-    __version__ = '2.0.2'
+    __version__ = '2.4.0'
     __license__ = 'GPL3'
     __description__ = 'a plugin for pwnagotchi that shows a openstreetmap with positions of ap-handshakes in your webbrowser'
     __name__ = 'webgpsmap'
@@ -37,16 +56,21 @@ class Webgpsmap(plugins.Plugin):
     __assets__ = ['webgpsmap.html']
     __defaults__ = {
         'enabled': False,
+        'position_cache_size': 32768,
+        'cluster_max_zoom': 16,
+        'gzip': True,
     }
 
-    ALREADY_SENT = list()
-    SKIP = list()
-
     def __init__(self):
         self.ready = False
+        self.position_cache = PositionCache()
+        self.position_index = None
+        self.position_cursor = None
+        self.index_lock = threading.Lock()
 
     def on_config_changed(self, config):
         self.config = config
+        self.position_cache = PositionCache(self.options.get('position_cache_size', 32768))
         self.ready = True
 
     def on_loaded(self):
@@ -62,6 +86,7 @@ class Webgpsmap(plugins.Plugin):
         # defaults:
         response_header_contenttype = None
         response_header_contentdisposition = None
+        response_header_contentencoding = None
         response_mimetype = "application/xhtml+xml"
         if not self.ready:
             try:
@@ -81,9 +106,12 @@ class Webgpsmap(plugins.Plugin):
         else:
             if request.method == "GET":
                 if path == '/' or not path:
-                    # returns the html template
-                    self.ALREADY_SENT = list()
+                    # returns the html template and rebuilds the position index on its first request,
+                    # after that the index picks up added, changed and removed positions on its own
                     try:
+                        with self.index_lock:
+                            self.position_index = None
+                            self.position_cursor = None
                         response_data = bytes(self.get_html(), "utf-8")
                     except Exception as error:
                         logging.error(f"[webgpsmap] on_webhook / error: {error}")
@@ -92,10 +120,13 @@ class Webgpsmap(plugins.Plugin):
                     response_mimetype = "application/xhtml+xml"
                     response_header_contenttype = 'text/html'
                 elif path.startswith('all'):
-                    # returns all positions
+                    # returns all positions, streamed
                     try:
-                        self.ALREADY_SENT = list()
-                        response_data = bytes(json.dumps(self.load_gps_from_dir(self.config['bettercap']['handshakes'])), "utf-8")
+                        position_files = self.find_position_files(self.config['bettercap']['handshakes'])
+                        compress = self.accepts_gzip(request)
+                        response_data = self.encode_stream(self.stream_gps_json(position_files), compress)
+                        if compress:
+                            response_header_contentencoding = 'gzip'
                         response_status = 200
                         response_mimetype = "application/json"
                         response_header_contenttype = 'application/json'
@@ -103,13 +134,13 @@ class Webgpsmap(plugins.Plugin):
                         logging.error(f"[webgpsmap] on_webhook all error: {error}")
                         return
                 elif path.startswith('offlinemap'):
-                    # for download an all-in-one html file with positions.json inside
+                    # for download an all-in-one html file with positions.json inside, streamed
                     try:
-                        self.ALREADY_SENT = list()
-                        json_data = json.dumps(self.load_gps_from_dir(self.config['bettercap']['handshakes']))
-                        html_data = self.get_html()
-                        html_data = html_data.replace('var positions = [];', 'var positions = ' + json_data + ';positionsLoaded=true;drawPositions();')
-                        response_data = bytes(html_data, "utf-8")
+                        position_files = self.find_position_files(self.config['bettercap']['handshakes'])
+                        compress = self.accepts_gzip(request)
+                        response_data = self.encode_stream(self.stream_offline_html(position_files), compress)
+                        if compress:
+                            response_header_contentencoding = 'gzip'
                         response_status = 200
                         response_mimetype = "application/xhtml+xml"
                         response_header_contenttype = 'text/html'
@@ -117,12 +148,56 @@ class Webgpsmap(plugins.Plugin):
                     except Exception as error:
                         logging.error(f"[webgpsmap] on_webhook offlinemap: error: {error}")
                         return
-                # elif path.startswith('/newest'):
-                #     # returns all positions newer then timestamp
-                #     response_data = bytes(json.dumps(self.load_gps_from_dir(self.config['bettercap']['handshakes']), newest_only=True), "utf-8")
-                #     response_status = 200
-                #     response_mimetype = "application/json"
-                #     response_header_contenttype = 'application/json'
+                elif path.startswith('positions'):
+                    # returns clustered positions inside ?bbox=west,south,east,north for ?zoom=
+                    # optional ?q= filters like the search field of the map page
+                    try:
+                        bbox = request.args.get('bbox')
+                        bbox = [float(c) for c in bbox.split(',')] if bbox else [-180.0, -90.0, 180.0, 90.0]
+                        if len(bbox) != 4:
+                            raise ValueError("bbox needs 4 values")
+                        zoom = int(request.args.get('zoom', 0))
+                        query = request.args.get('q', '')
+                        index = self.get_position_index(self.config['bettercap']['handshakes'])
+                        if query:
+                            index = index.filtered(query)
+                        clusters, positions = index.query(bbox, zoom)
+                        response_data = bytes(json.dumps({
+                            'count': len(index),
+                            'bounds': index.bounds(),
+                            'clusters': clusters,
+                            'positions': positions,
+                        }), "utf-8")
+                        response_status = 200
+                        response_mimetype = "application/json"
+                        response_header_contenttype = 'application/json'
+                    except ValueError:
+                        response_data = bytes(json.dumps({'error': 'bbox must be west,south,east,north and zoom an integer'}), "utf-8")
+                        response_status = 400
+                        response_mimetype = "application/json"
+                        response_header_contenttype = 'application/json'
+                    except Exception as error:
+                        logging.error(f"[webgpsmap] on_webhook positions error: {error}")
+                        return
+                elif path.startswith('newest'):
+                    # returns positions added or changed after the cursor given in ?since=
+                    # together with the cursor for the next request
+                    try:
+                        since = request.args.get('since')
+                        since = int(since) if since else None
+                        gps_data, cursor = self.load_gps_delta(self.config['bettercap']['handshakes'], since)
+                        response_data = bytes(json.dumps({'cursor': cursor, 'positions': gps_data}), "utf-8")
+                        response_status = 200
+                        response_mimetype = "application/json"
+                        response_header_contenttype = 'application/json'
+                    except ValueError:
+                        response_data = bytes(json.dumps({'error': 'since must be an integer cursor'}), "utf-8")
+                        response_status = 400
+                        response_mimetype = "application/json"
+                        response_header_contenttype = 'application/json'
+                    except Exception as error:
+                        logging.error(f"[webgpsmap] on_webhook newest error: {error}")
+                        return
                 else:
                     # unknown GET path
                     response_data = bytes('''<html>
@@ -149,112 +224,212 @@ class Webgpsmap(plugins.Plugin):
                 r.headers["Content-Type"] = response_header_contenttype
             if response_header_contentdisposition is not None:
                 r.headers["Content-Disposition"] = response_header_contentdisposition
+            if response_header_contentencoding is not None:
+                r.headers["Content-Encoding"] = response_header_contentencoding
+                r.headers["Vary"] = "Accept-Encoding"
             return r
         except Exception as error:
             logging.error(f"[webgpsmap] on_webhook CREATING_RESPONSE error: {error}")
             return
 
-    # cache 2048 items
-    @lru_cache(maxsize=2048, typed=False)
-    def _get_pos_from_file(self, path):
-        return PositionFile(path)
+    def accepts_gzip(self, request):
+        """
+        True if gzip is enabled and the client accepts a gzip content-encoding
+        """
+        return self.options.get('gzip', True) and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    @staticmethod
+    def _scan_handshake_dir(handshake_dir):
+        """
+        Indexes the handshake dir in one pass: basename -> set of known extensions
+        """
+        return {base: extensions for base, extensions in handshake_index.get(handshake_dir).groups().items()
+                if not extensions.isdisjoint(INDEXED_EXTENSIONS)}
 
-    def load_gps_from_dir(self, gpsdir, newest_only=False):
+    @staticmethod
+    def _load_position(pos_file):
+        """
+        Parses one position file into the dict sent to the map (without password)
+        """
+        pos = PositionFile(pos_file)
+        if pos.type() not in (PositionFile.GPS, PositionFile.GEO, PositionFile.PAWGPS):
+            return None
+
+        ssid, mac = pos.ssid(), pos.mac()
+        ssid = "unknown" if not ssid else ssid
+        # invalid mac is strange and should abort; ssid is ok
+        if not mac:
+            raise ValueError("Mac can't be parsed from filename")
+        pos_type = 'unknown'
+        if pos.type() == PositionFile.GPS:
+            pos_type = 'gps'
+        elif pos.type() == PositionFile.GEO:
+            pos_type = 'geo'
+        elif pos.type() == PositionFile.PAWGPS:
+            pos_type = 'paw'
+        return {
+            'ssid': ssid,
+            'mac': mac,
+            'type': pos_type,
+            'lng': pos.lng(),
+            'lat': pos.lat(),
+            'acc': pos.accuracy(),
+            'ts_first': pos.timestamp_first(),
+            'ts_last': pos.timestamp_last(),
+        }
+
+    def load_gps_from_dir(self, gpsdir):
         """
         Parses the gps-data from disk
         """
+        gps_data, cursor = self.load_gps_delta(gpsdir)
+        return gps_data
 
-        handshake_dir = gpsdir
+    def load_gps_delta(self, gpsdir, since=None):
+        """
+        Parses the gps-data from disk, only returns positions whose position or
+        cracked file changed after the cursor since (all if None).
+        Returns (gps_data, cursor), cursor is the newest change time in microseconds.
+        """
         gps_data = dict()
+        cursor = since or 0
+        for changed, key, entry, pos_file in self.iter_gps_from_dir(self.find_position_files(gpsdir), since):
+            cursor = max(cursor, changed)
+            if entry is not None:
+                gps_data[key] = entry
+        logging.info(f"[webgpsmap] loaded {len(gps_data)} positions")
+        return gps_data, cursor
 
+    def find_position_files(self, gpsdir):
+        """
+        Returns [(position file, cracked file or None)] for every handshake with position data
+        """
+        handshake_dir = gpsdir
         logging.info(f"[webgpsmap] scanning {handshake_dir}")
 
-        all_files = os.listdir(handshake_dir)
-        all_pcap_files = [os.path.join(handshake_dir, filename)
-                          for filename in all_files
-                          if filename.endswith('.pcap')]
+        index = self._scan_handshake_dir(handshake_dir)
+        num_pcap_files = 0
         all_geo_or_gps_files = []
-        for filename_pcap in all_pcap_files:
-            filename_base = filename_pcap[:-5]  # remove ".pcap"
-            logging.debug(f"[webgpsmap] found: {filename_base}")
+        for filename_base, extensions in index.items():
+            if '.pcap' not in extensions:
+                continue
+            num_pcap_files += 1
             filename_position = None
-
-            logging.debug("[webgpsmap] search for .gps.json")
-            check_for = os.path.basename(filename_base) + ".gps.json"
-            if check_for in all_files:
-                filename_position = str(os.path.join(handshake_dir, check_for))
-
-            logging.debug("[webgpsmap] search for .geo.json")
-            check_for = os.path.basename(filename_base) + ".geo.json"
-            if check_for in all_files:
-                filename_position = str(os.path.join(handshake_dir, check_for))
-
-            logging.debug("[webgpsmap] search for .paw-gps.json")
-            check_for = os.path.basename(filename_base) + ".paw-gps.json"
-            if check_for in all_files:
-                filename_position = str(os.path.join(handshake_dir, check_for))
-
-            logging.debug(f"[webgpsmap] end search for position data files and use {filename_position}")
+            for ext in POSITION_EXTENSIONS:
+                if ext in extensions:
+                    filename_position = os.path.join(handshake_dir, filename_base + ext)
+            logging.debug(f"[webgpsmap] {filename_base}: use position data file {filename_position}")
 
             if filename_position is not None:
-                all_geo_or_gps_files.append(filename_position)
+                filename_cracked = None
+                if '.pcap.cracked' in extensions:
+                    filename_cracked = os.path.join(handshake_dir, filename_base + '.pcap.cracked')
+                all_geo_or_gps_files.append((filename_position, filename_cracked))
 
-    #    all_geo_or_gps_files = set(all_geo_or_gps_files) - set(SKIP)   # remove skipped networks? No!
+        logging.info(f"[webgpsmap] Found {len(all_geo_or_gps_files)} position-data files from {num_pcap_files} handshakes. Fetching positions ...")
+        return all_geo_or_gps_files
 
-        if newest_only:
-            all_geo_or_gps_files = set(all_geo_or_gps_files) - set(self.ALREADY_SENT)
-
-        logging.info(f"[webgpsmap] Found {len(all_geo_or_gps_files)} position-data files from {len(all_pcap_files)} handshakes. Fetching positions ...")
-
-        for pos_file in all_geo_or_gps_files:
+    def iter_gps_from_dir(self, all_geo_or_gps_files, since=None):
+        """
+        Yields (changed, key, entry, position file) for every readable position file, one at a time;
+        entry is None if neither position nor cracked file changed after the cursor since
+        """
+        for pos_file, cracked_file in all_geo_or_gps_files:
             try:
-                pos = self._get_pos_from_file(pos_file)
-                if not pos.type() == PositionFile.GPS and not pos.type() == PositionFile.GEO and not pos.type() == PositionFile.PAWGPS:
+                stat = os.stat(pos_file)
+                changed = stat.st_mtime_ns // 1000
+                if cracked_file is not None:
+                    changed = max(changed, os.stat(cracked_file).st_mtime_ns // 1000)
+                if since is not None and changed <= since:
+                    yield changed, None, None, pos_file
                     continue
 
-                ssid, mac = pos.ssid(), pos.mac()
-                ssid = "unknown" if not ssid else ssid
-                # invalid mac is strange and should abort; ssid is ok
-                if not mac:
-                    raise ValueError("Mac can't be parsed from filename")
-                pos_type = 'unknown'
-                if pos.type() == PositionFile.GPS:
-                    pos_type = 'gps'
-                elif pos.type() == PositionFile.GEO:
-                    pos_type = 'geo'
-                elif pos.type() == PositionFile.PAWGPS:
-                    pos_type = 'paw'
-                gps_data[ssid + "_" + mac] = {
-                    'ssid': ssid,
-                    'mac': mac,
-                    'type': pos_type,
-                    'lng': pos.lng(),
-                    'lat': pos.lat(),
-                    'acc': pos.accuracy(),
-                    'ts_first': pos.timestamp_first(),
-                    'ts_last': pos.timestamp_last(),
-                }
+                entry = self.position_cache.get(pos_file, self._load_position, stat)
+                if entry is None:
+                    continue
+                entry = dict(entry)
 
                 # get ap password if exist
-                check_for = os.path.basename(pos_file).split(".")[0] + ".pcap.cracked"
-                if check_for in all_files:
-                    gps_data[ssid + "_" + mac]["pass"] = pos.password()
-
-                self.ALREADY_SENT += pos_file
+                if cracked_file is not None:
+                    entry["pass"] = PositionFile.read_password(cracked_file)
             except json.JSONDecodeError as error:
-                self.SKIP += pos_file
                 logging.error(f"[webgpsmap] JSONDecodeError in: {pos_file} - error: {error}")
                 continue
             except ValueError as error:
-                self.SKIP += pos_file
                 logging.error(f"[webgpsmap] ValueError: {pos_file} - error: {error}")
                 continue
             except OSError as error:
-                self.SKIP += pos_file
                 logging.error(f"[webgpsmap] OSError: {pos_file} - error: {error}")
                 continue
-        logging.info(f"[webgpsmap] loaded {len(gps_data)} positions")
-        return gps_data
+            yield changed, entry['ssid'] + "_" + entry['mac'], entry, pos_file
+
+    def stream_gps_json(self, all_geo_or_gps_files):
+        """
+        Yields the positions as one json object, built entry by entry
+        """
+        yield '{'
+        separator = ''
+        for changed, key, entry, pos_file in self.iter_gps_from_dir(all_geo_or_gps_files):
+            yield separator + json.dumps(key) + ': ' + json.dumps(entry)
+            separator = ', '
+        yield '}'
+
+    def stream_offline_html(self, all_geo_or_gps_files):
+        """
+        Yields the html page with the positions inlined, for the offline map
+        """
+        html_head, html_tail = self.get_html().split('var positions = [];', 1)
+        yield html_head
+        yield 'var positions = '
+        yield from self.stream_gps_json(all_geo_or_gps_files)
+        yield ';positionsLoaded=true;drawPositions();'
+        yield html_tail
+
+    @staticmethod
+    def encode_stream(parts, compress=False, chunk_size=65536):
+        """
+        Joins the yielded strings to utf-8 chunks of about chunk_size bytes, gzip compressed if compress
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        buffer = list()
+        buffered = 0
+        for part in parts:
+            buffer.append(part)
+            buffered += len(part)
+            if buffered >= chunk_size:
+                chunk = ''.join(buffer).encode('utf-8')
+                buffer, buffered = list(), 0
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        chunk = ''.join(buffer).encode('utf-8')
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+    def get_position_index(self, gpsdir):
+        """
+        Returns the spatial index over all positions, only changed position files are merged in
+        and the positions of files that are gone are dropped
+        """
+        with self.index_lock:
+            position_files = self.find_position_files(gpsdir)
+            gps_data = dict()
+            sources = dict()
+            cursor = self.position_cursor or 0
+            for changed, key, entry, pos_file in self.iter_gps_from_dir(position_files, self.position_cursor):
+                cursor = max(cursor, changed)
+                if entry is not None:
+                    gps_data[key] = entry
+                    sources[key] = pos_file
+            if self.position_index is None:
+                self.position_index = PositionIndex(gps_data, self.options.get('cluster_max_zoom', 16), sources)
+            else:
+                self.position_index.update(gps_data, sources, {pos_file for pos_file, cracked_file in position_files})
+            self.position_cursor = cursor
+            return self.position_index
 
     def get_html(self):
         """
@@ -268,6 +443,166 @@ class Webgpsmap(plugins.Plugin):
         return html_data
 
 
+class PositionCache:
+    """
+    Bounded LRU of parsed position data, validated by mtime and size of the file
+    """
+
+    def __init__(self, maxsize=32768):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, loader, stat=None):
+        """
+        Returns loader(path), reusing the cached result while the file is unchanged
+        """
+        if stat is None:
+            stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[0] == key:
+                self._entries.move_to_end(path)
+                return cached[1]
+        value = loader(path)
+        with self._lock:
+            self._entries[path] = (key, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+
+class PositionIndex:
+    """
+    Grid-bucket spatial index over positions, cluster aggregates are built lazily per zoom level
+    """
+
+    def __init__(self, positions, max_zoom=16, sources=None):
+        self.positions = dict(positions)
+        self.sources = dict(sources or dict())  # key -> position file it was read from
+        self.max_zoom = max_zoom
+        self._levels = dict()
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update(self, positions, sources=None, existing=None):
+        """
+        Merges added or changed positions and drops the aggregates; with existing, the set of
+        all position files, the positions read from files that are gone are removed too
+        """
+        sources = sources or dict()
+        # a changed file may name another network now, its old key goes
+        replaced = {source: key for key, source in sources.items()}
+        gone = [key for key, source in self.sources.items()
+                if (existing is not None and source not in existing) or replaced.get(source, key) != key]
+        if not positions and not gone:
+            return
+        for key in gone:
+            self.positions.pop(key, None)
+            self.sources.pop(key, None)
+        self.positions.update(positions)
+        self.sources.update(sources)
+        self._levels = dict()
+        self._bounds = None
+
+    def filtered(self, query):
+        """
+        Returns a new index with the positions matching all words of query,
+        matched like the search field of the map page
+        """
+        words = query.lower().split()
+        matching = dict()
+        for key, pos in self.positions.items():
+            mac = pos['mac']
+            pattern = f"{pos['ssid']} {':'.join(mac[i:i + 2] for i in range(0, len(mac), 2))} {mac}"
+            pattern += f"{pos['pass']} #cracked" if pos.get('pass') else " #notcracked"
+            pattern = pattern.lower()
+            if all(word in pattern for word in words):
+                matching[key] = pos
+        return PositionIndex(matching, self.max_zoom)
+
+    def bounds(self):
+        """
+        Returns [[south, west], [north, east]] of all positions or None
+        """
+        if self._bounds is None and self.positions:
+            lats = [pos['lat'] for pos in self.positions.values()]
+            lngs = [pos['lng'] for pos in self.positions.values()]
+            self._bounds = [[min(lats), min(lngs)], [max(lats), max(lngs)]]
+        return self._bounds
+
+    @staticmethod
+    def cell_size(zoom):
+        return 360.0 / (2 ** zoom) / CELLS_PER_TILE
+
+    def _level(self, zoom):
+        """
+        Returns the grid of a zoom level: cell -> [count, lat sum, lng sum, cracked, keys]
+        keys are only kept for single positions and on the max zoom level
+        """
+        level = self._levels.get(zoom)
+        if level is not None:
+            return level
+        size = PositionIndex.cell_size(zoom)
+        level = dict()
+        for key, pos in self.positions.items():
+            cell = (math.floor(pos['lat'] / size), math.floor(pos['lng'] / size))
+            bucket = level.get(cell)
+            if bucket is None:
+                bucket = level[cell] = [0, 0.0, 0.0, 0, []]
+            bucket[0] += 1
+            bucket[1] += pos['lat']
+            bucket[2] += pos['lng']
+            if pos.get('pass'):
+                bucket[3] += 1
+            if zoom >= self.max_zoom or bucket[0] == 1:
+                bucket[4].append(key)
+            else:
+                bucket[4] = []
+        self._levels[zoom] = level
+        return level
+
+    def query(self, bbox, zoom):
+        """
+        Returns (clusters, positions) inside bbox = [west, south, east, north];
+        cells holding a single position and everything from max zoom on are returned as positions
+        """
+        west, south, east, north = bbox
+        west, east = max(west, -180.0), min(east, 180.0)
+        south, north = max(south, -90.0), min(north, 90.0)
+        zoom = max(0, min(zoom, self.max_zoom))
+        size = PositionIndex.cell_size(zoom)
+        level = self._level(zoom)
+
+        rows = range(math.floor(south / size), math.floor(north / size) + 1)
+        cols = range(math.floor(west / size), math.floor(east / size) + 1)
+        if len(rows) * len(cols) < len(level):
+            cells = ((cell, level.get(cell)) for cell in ((row, col) for row in rows for col in cols))
+        else:
+            cells = level.items()
+
+        clusters = list()
+        positions = dict()
+        for (row, col), bucket in cells:
+            if bucket is None or row not in rows or col not in cols:
+                continue
+            if bucket[4]:
+                for key in bucket[4]:
+                    positions[key] = self.positions[key]
+            else:
+                clusters.append({
+                    'lat': bucket[1] / bucket[0],
+                    'lng': bucket[2] / bucket[0],
+                    'count': bucket[0],
+                    'cracked': bucket[3],
+                })
+        return clusters, positions
+
+
 class PositionFile:
     """
     Wraps gps / net-pos files
@@ -339,10 +674,16 @@ class PositionFile:
         """
         returns the password from file.pcap.cracked or None
         """
-        return_pass = None
         # 2do: make better filename split/remove extension because this one has problems with "." in path
         base_filename, ext1, ext2 = re.split('\.', self._file)
-        password_file_path = base_filename + ".pcap.cracked"
+        return PositionFile.read_password(base_filename + ".pcap.cracked")
+
+    @staticmethod
+    def read_password(password_file_path):
+        """
+        returns the password from the given .pcap.cracked file or None
+        """
+        return_pass = None
         if os.path.isfile(password_file_path):
             try:
                 password_file = open(password_file_path, 'r')
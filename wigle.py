@@ -1,15 +1,26 @@
 import os
+import sys
 import logging
 import json
 import csv
+import gzip
 import requests
 
 from io import StringIO
 from datetime import datetime
-from pwnagotchi.utils import WifiInfo, FieldNotFoundError, extract_from_pcap, StatusFile, remove_whitelisted
+from pwnagotchi.utils import WifiInfo, FieldNotFoundError, StatusFile, remove_whitelisted
 from threading import Lock
 from pwnagotchi import plugins
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import handshake_index
+import pcap_metadata
+import upload_outbox
+
+OUTBOX = 'wigle'
+
 
 def _extract_gps_data(path):
     """
@@ -34,17 +45,19 @@ def _format_auth(data):
     return out
 
 
+def _wigle_header():
+    """
+    The kismet header every wigle csv file starts with
+    """
+    return ("WigleWifi-1.4,appRelease=20190201,model=Kismet,release=2019.02.01.{},device=kismet,display=kismet,board=kismet,brand=kismet\n"
+            "MAC,SSID,AuthMode,FirstSeen,Channel,RSSI,CurrentLatitude,CurrentLongitude,AltitudeMeters,AccuracyMeters,Type\n")
+
+
 def _transform_wigle_entry(gps_data, pcap_data):
     """
-    Transform to wigle entry in file
+    Transform to one csv row of a wigle file (without header)
     """
     dummy = StringIO()
-    # write kismet header
-    dummy.write(
-        "WigleWifi-1.4,appRelease=20190201,model=Kismet,release=2019.02.01.{},device=kismet,display=kismet,board=kismet,brand=kismet\n")
-    dummy.write(
-        "MAC,SSID,AuthMode,FirstSeen,Channel,RSSI,CurrentLatitude,CurrentLongitude,AltitudeMeters,AccuracyMeters,Type")
-
     writer = csv.writer(dummy, delimiter=",", quoting=csv.QUOTE_NONE, escapechar="\\")
     writer.writerow([
         pcap_data[WifiInfo.BSSID],
@@ -62,22 +75,54 @@ def _transform_wigle_entry(gps_data, pcap_data):
     return dummy.getvalue()
 
 
-def _send_to_wigle(lines, api_key, timeout=30):
+def _extract_pcap_info(pcap_filename):
     """
-    Uploads the file to wigle-net
+    BSSID, ESSID, encryption, channel and RSSI of a capture, from the cached metadata reader
     """
+    meta = pcap_metadata.get().read(pcap_filename)
+    pcap_data = {
+        WifiInfo.BSSID: meta['bssid'],
+        WifiInfo.ESSID: meta['essid'],
+        WifiInfo.ENCRYPTION: set(meta['encryption']) if meta['encryption'] is not None else None,
+        WifiInfo.CHANNEL: meta['channel'],
+        WifiInfo.RSSI: meta['rssi'],
+    }
+    for field, value in pcap_data.items():
+        if value is None:
+            raise FieldNotFoundError(f"Could not find field [{field}]")
+    return pcap_data
 
-    dummy = StringIO()
 
-    for line in lines:
-        dummy.write(f"{line}")
+def _chunk_wigle_rows(rows, max_bytes):
+    """
+    Groups (gps file, csv row) pairs into (gps files, csv file) chunks of at most max_bytes,
+    each with a single header; rows are pulled from the iterator only as needed
+    """
+    header = _wigle_header()
+    files, parts, size = list(), [header], len(header)
+    for gps_file, row in rows:
+        row_size = len(row.encode())
+        if files and size + row_size > max_bytes:
+            yield files, ''.join(parts)
+            files, parts, size = list(), [header], len(header)
+        files.append(gps_file)
+        parts.append(row)
+        size += row_size
+    if files:
+        yield files, ''.join(parts)
 
-    dummy.seek(0)
 
+def _send_to_wigle(csv_data, api_key, timeout=30, compress=True):
+    """
+    Uploads one csv file to wigle-net, gzip compressed if compress is set
+    """
     headers = {'Authorization': f"Basic {api_key}",
                'Accept': 'application/json'}
     data = {'donate': 'false'}
-    payload = {'file': dummy, 'type': 'text/csv'}
+    if compress:
+        payload = {'file': ('pwnagotchi.csv.gz', gzip.compress(csv_data.encode()), 'application/gzip')}
+    else:
+        payload = {'file': ('pwnagotchi.csv', csv_data.encode(), 'text/csv')}
 
     try:
         res = requests.post('https://api.wigle.net/api/v2/file/upload',
@@ -94,7 +139,7 @@ def _send_to_wigle(lines, api_key, timeout=30):
 
 class Wigle(plugins.Plugin):
     __author__ = '33197631+dadav@users.noreply.github.com'
-    __version__ = '3.0.1'
+    __version__ = '3.3.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin automatically uploads collected wifis to wigle.net.'
     __name__ = 'Wigle'
@@ -108,14 +153,16 @@ class Wigle(plugins.Plugin):
         'enabled': False,
         'api_key': '',
         'whitelist': [],
+        'chunk_size': 1048576,
+        'compress': True,
     }
 
     def __init__(self):
         self.ready = False
         self.report = StatusFile('/root/.wigle_uploads', data_format='json')
-        self.skip = list()
         self.lock = Lock()
         self.shutdown = False
+        self.outbox = None
 
     def on_config_changed(self, config):
         with self.lock:
@@ -132,8 +179,62 @@ class Wigle(plugins.Plugin):
         if 'whitelist' not in self.options:
             self.options['whitelist'] = list()
 
+        for option in ('chunk_size', 'compress'):
+            self.options.setdefault(option, self.__defaults__[option])
+
         self.ready = True
 
+    def on_handshake(self, agent, filename, access_point, client_station):
+        """
+        Queues the position of the new handshake right away, so it is uploaded even after a restart;
+        positions written later are picked up by the next sync
+        """
+        gps_file = filename.replace('.pcap', '.gps.json')
+        if self.ready and os.path.isfile(gps_file):
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [gps_file])
+
+    def _skip(self, gps_file, error, retry=False):
+        """
+        Gives gps_file up in the outbox, or lets it be tried again later if retry
+        """
+        logging.debug("WIGLE: %s", error)
+        self.outbox.failed(OUTBOX, [gps_file], error, permanent=not retry)
+
+    def _iter_wigle_rows(self, gps_files, pcap_exists):
+        """
+        Yields (gps file, csv row) for every uploadable gps file, reading the pcaps lazily;
+        files that can't be used are skipped
+        """
+        for gps_file in gps_files:
+            if self.shutdown:
+                return
+            pcap_filename = gps_file.replace('.gps.json', '.pcap')
+            if not pcap_exists(pcap_filename):
+                self._skip(gps_file, f"Can't find pcap for {gps_file}")
+                continue
+            try:
+                gps_data = _extract_gps_data(gps_file)
+            except OSError as os_err:
+                self._skip(gps_file, os_err, retry=isinstance(os_err, FileNotFoundError))
+                continue
+            except json.JSONDecodeError as json_err:
+                # the gps plugin may still be writing it
+                self._skip(gps_file, json_err, retry=True)
+                continue
+            if gps_data['Latitude'] == 0 and gps_data['Longitude'] == 0:
+                self._skip(gps_file, f"Not enough gps-information for {gps_file}. Trying again next time.", retry=True)
+                continue
+            try:
+                pcap_data = _extract_pcap_info(pcap_filename)
+            except FieldNotFoundError:
+                self._skip(gps_file, f"Could not extract all information. Skip {gps_file}")
+                continue
+            except (ValueError, OSError) as pcap_e:
+                # a truncated capture only costs its own upload
+                self._skip(gps_file, pcap_e)
+                continue
+            yield gps_file, _transform_wigle_entry(gps_data, pcap_data)
+
     def on_internet_available(self, agent):
         """
         Called in manual mode when there's internet connectivity
@@ -141,73 +242,33 @@ class Wigle(plugins.Plugin):
         if not self.ready or self.lock.locked() or self.shutdown:
             return
 
-        from scapy.all import Scapy_Exception
-
         config = agent.config()
         display = agent.view()
-        reported = self.report.data_field_or('reported', default=list())
         handshake_dir = config['bettercap']['handshakes']
-        all_files = os.listdir(handshake_dir)
-        all_gps_files = [os.path.join(handshake_dir, filename)
-                         for filename in all_files
-                         if filename.endswith('.gps.json')]
+        pcap_exists = handshake_index.get(handshake_dir).isfile
 
-        all_gps_files = remove_whitelisted(all_gps_files, self.options['whitelist'])
-        new_gps_files = set(all_gps_files) - set(reported) - set(self.skip)
+        # the outbox is the only record of the uploads, the old list only seeds it once
+        self.outbox = upload_outbox.get(config)
+        self.outbox.sync(OUTBOX, handshake_dir, ('.gps.json',),
+                         done=self.report.data_field_or('reported', default=list()))
+        new_gps_files = remove_whitelisted(self.outbox.due(OUTBOX), self.options['whitelist'])
         if new_gps_files:
             logging.info("WIGLE: Internet connectivity detected. Uploading new handshakes to wigle.net")
-            csv_entries = list()
-            no_err_entries = list()
-            for gps_file in new_gps_files:
-                if self.shutdown:
-                    return
-                pcap_filename = gps_file.replace('.gps.json', '.pcap')
-                if not os.path.exists(pcap_filename):
-                    logging.debug("WIGLE: Can't find pcap for %s", gps_file)
-                    self.skip.append(gps_file)
-                    continue
-                try:
-                    gps_data = _extract_gps_data(gps_file)
-                except OSError as os_err:
-                    logging.debug("WIGLE: %s", os_err)
-                    self.skip.append(gps_file)
-                    continue
-                except json.JSONDecodeError as json_err:
-                    logging.debug("WIGLE: %s", json_err)
-                    self.skip.append(gps_file)
-                    continue
-                if gps_data['Latitude'] == 0 and gps_data['Longitude'] == 0:
-                    logging.debug("WIGLE: Not enough gps-information for %s. Trying again next time.", gps_file)
-                    self.skip.append(gps_file)
-                    continue
-                try:
-                    pcap_data = extract_from_pcap(pcap_filename, [WifiInfo.BSSID,
-                                                                  WifiInfo.ESSID,
-                                                                  WifiInfo.ENCRYPTION,
-                                                                  WifiInfo.CHANNEL,
-                                                                  WifiInfo.RSSI])
-                except FieldNotFoundError:
-                    logging.debug("WIGLE: Could not extract all information. Skip %s", gps_file)
-                    self.skip.append(gps_file)
-                    continue
-                except Scapy_Exception as sc_e:
-                    logging.debug("WIGLE: %s", sc_e)
-                    self.skip.append(gps_file)
-                    continue
-                new_entry = _transform_wigle_entry(gps_data, pcap_data)
-                csv_entries.append(new_entry)
-                no_err_entries.append(gps_file)
-            if csv_entries:
-                display.set('status', "Uploading gps-data to wigle.net ...")
-                display.update(force=True)
-                try:
-                    _send_to_wigle(csv_entries, self.options['api_key'])
-                    reported += no_err_entries
-                    self.report.update(data={'reported': reported})
-                    logging.info("WIGLE: Successfully uploaded %d files", len(no_err_entries))
-                except requests.exceptions.RequestException as re_e:
-                    self.skip += no_err_entries
-                    logging.debug("WIGLE: Got an exception while uploading %s", re_e)
-                except OSError as os_e:
-                    self.skip += no_err_entries
-                    logging.debug("WIGLE: Got the following error: %s", os_e)
+            rows = self._iter_wigle_rows(new_gps_files, pcap_exists)
+            with self.outbox.budget() as budget:
+                for num, (chunk_files, chunk) in enumerate(_chunk_wigle_rows(rows, self.options['chunk_size'])):
+                    if not budget.consume(len(chunk)):
+                        logging.debug("WIGLE: outbox budget used up, the rest waits for the next round")
+                        break
+                    display.set('status', f"Uploading gps-data to wigle.net ({num + 1}) ...")
+                    display.update(force=True)
+                    try:
+                        _send_to_wigle(chunk, self.options['api_key'], compress=self.options['compress'])
+                        self.outbox.done(OUTBOX, chunk_files)
+                        logging.info("WIGLE: Successfully uploaded %d files", len(chunk_files))
+                    except requests.exceptions.RequestException as re_e:
+                        self.outbox.failed(OUTBOX, chunk_files, re_e)
+                        logging.debug("WIGLE: Got an exception while uploading %s", re_e)
+                    except OSError as os_e:
+                        self.outbox.failed(OUTBOX, chunk_files, os_e)
+                        logging.debug("WIGLE: Got the following error: %s", os_e)
@@ -1,16 +1,26 @@
 import os
+import sys
+import time
 import logging
 import requests
-from datetime import datetime
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pwnagotchi.utils import StatusFile, remove_whitelisted
 from pwnagotchi import plugins
 from json.decoder import JSONDecodeError
 
+PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
+if PLUGIN_DIR not in sys.path:
+    sys.path.append(PLUGIN_DIR)
+import upload_outbox
+import upload_state
+
+OUTBOX = 'wpa-sec'
+
 
 class WpaSec(plugins.Plugin):
     __author__ = '33197631+dadav@users.noreply.github.com'
-    __version__ = '3.0.2'
+    __version__ = '3.2.0'
     __license__ = 'GPL3'
     __description__ = 'This plugin automatically uploads handshakes to https://wpa-sec.stanev.org'
     __name__ = 'WpaSec'
@@ -26,6 +36,10 @@ class WpaSec(plugins.Plugin):
         'api_url': 'https://wpa-sec.stanev.org',
         'download_results': False,
         'whitelist': [],
+        'workers': 4,
+        'retries': 5,
+        'backoff': 2,
+        'download_state': '/root/.wpa_sec_download',
     }
 
     def __init__(self):
@@ -37,8 +51,9 @@ class WpaSec(plugins.Plugin):
             os.remove("/root/.wpa_sec_uploads")
             self.report = StatusFile('/root/.wpa_sec_uploads', data_format='json')
         self.options = dict()
-        self.skip = list()
         self.shutdown = False
+        self.session = None
+        self.download_state = None
 
     def on_config_changed(self, config):
         with self.lock:
@@ -56,20 +71,79 @@ class WpaSec(plugins.Plugin):
             payload = {'file': file_to_upload}
 
             try:
-                result = requests.post(self.options['api_url'],
-                                       cookies=cookie,
-                                       files=payload,
-                                       timeout=timeout)
+                result = self.session.post(self.options['api_url'],
+                                           cookies=cookie,
+                                           files=payload,
+                                           timeout=timeout)
+                if result.status_code == 429 or result.status_code >= 500:
+                    result.raise_for_status()
                 if ' already submitted' in result.text:
                     logging.debug('[wpasec] %s was already submitted.', path)
             except requests.exceptions.RequestException as req_e:
                 raise req_e
 
+    def _upload_with_backoff(self, path, budget=None):
+        """
+        Uploads the file, retrying with exponential backoff on network errors, 429 and 5xx
+
+        returns False if the upload was given up because of shutdown or because it doesn't
+        fit into the outbox budget
+        """
+        if budget is not None and not budget.consume(os.path.getsize(path)):
+            return False
+        delay = self.options['backoff']
+        for attempt in range(self.options['retries'] + 1):
+            if self.shutdown:
+                return False
+            try:
+                self._upload_to_wpasec(path)
+                return True
+            except requests.exceptions.RequestException as req_e:
+                if attempt == self.options['retries']:
+                    raise req_e
+                logging.debug('[wpasec] %s, retrying %s in %ds', req_e, path, delay)
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def _upload_all(self, handshakes, display, outbox):
+        """
+        Uploads the handshakes on a pool of workers sharing one keep-alive session; the results
+        go to the outbox queue and the uploads draw from its budget
+        """
+        done = 0
+        last_update = 0
+        with outbox.budget() as budget, ThreadPoolExecutor(max_workers=self.options['workers']) as pool:
+            uploads = {pool.submit(self._upload_with_backoff, handshake, budget): handshake
+                       for handshake in handshakes}
+            for upload in as_completed(uploads):
+                handshake = uploads[upload]
+                done += 1
+                try:
+                    if upload.result():
+                        outbox.done(OUTBOX, [handshake])
+                        logging.debug('[wpasec] Successfully uploaded %s', handshake)
+                except requests.exceptions.RequestException as req_e:
+                    outbox.failed(OUTBOX, [handshake], req_e)
+                    logging.debug('[wpasec] %s', req_e)
+                except FileNotFoundError as os_e:
+                    outbox.forget(OUTBOX, [handshake])
+                    logging.debug('[wpasec] %s', os_e)
+                except OSError as os_e:
+                    logging.debug('[wpasec] %s', os_e)
+                # the display is slow, refresh it every few seconds only
+                if time.time() - last_update >= 5 or done == len(handshakes):
+                    last_update = time.time()
+                    display.set('status', f"Uploading handshakes to wpa-sec.stanev.org ({done}/{len(handshakes)})")
+                    display.update(force=True)
+
     def _download_from_wpasec(self, output, timeout=30):
         """
-        Downloads the results from wpasec and safes them to output
+        Downloads the results from wpasec and safes them to output, if they changed
 
         Output-Format: bssid, station_mac, ssid, password
+
+        returns True if output was rewritten
         """
         api_url = self.options['api_url']
         if not api_url.endswith('/'):
@@ -78,9 +152,8 @@ class WpaSec(plugins.Plugin):
 
         cookie = {'key': self.options['api_key']}
         try:
-            result = requests.get(api_url, cookies=cookie, timeout=timeout)
-            with open(output, 'wb') as output_file:
-                output_file.write(result.content)
+            return upload_state.download_if_changed(self.session, api_url, output, self.download_state,
+                                        timeout=timeout, cookies=cookie)
         except requests.exceptions.RequestException as req_e:
             raise req_e
         except OSError as os_e:
@@ -101,8 +174,27 @@ class WpaSec(plugins.Plugin):
         if 'whitelist' not in self.options:
             self.options['whitelist'] = list()
 
+        for option in ('workers', 'retries', 'backoff', 'download_state'):
+            self.options.setdefault(option, self.__defaults__[option])
+        try:
+            self.download_state = StatusFile(self.options['download_state'], data_format='json')
+        except JSONDecodeError:
+            os.remove(self.options['download_state'])
+            self.download_state = StatusFile(self.options['download_state'], data_format='json')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.options['workers'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
         self.ready = True
 
+    def on_handshake(self, agent, filename, access_point, client_station):
+        """
+        Queues the new handshake right away, so it is uploaded even after a restart
+        """
+        if self.ready:
+            upload_outbox.get(agent.config()).enqueue(OUTBOX, [filename])
+
     def on_webhook(self, path, request):
         from flask import make_response, redirect
         response = make_response(redirect(self.options['api_url'], code=302))
@@ -119,43 +211,27 @@ class WpaSec(plugins.Plugin):
         with self.lock:
             config = agent.config()
             display = agent.view()
-            reported = self.report.data_field_or('reported', default=list())
             handshake_dir = config['bettercap']['handshakes']
-            handshake_filenames = os.listdir(handshake_dir)
-            handshake_paths = [os.path.join(handshake_dir, filename) for filename in handshake_filenames if
-                               filename.endswith('.pcap')]
-            handshake_paths = remove_whitelisted(handshake_paths, self.options['whitelist'])
-            handshake_new = set(handshake_paths) - set(reported) - set(self.skip)
+            outbox = upload_outbox.get(config)
+            # the outbox is the only record of the uploads, the old list only seeds it once
+            outbox.sync(OUTBOX, handshake_dir, ('.pcap',), done=self.report.data_field_or('reported', default=list()))
+            handshake_new = remove_whitelisted(outbox.due(OUTBOX), self.options['whitelist'])
 
             if handshake_new:
                 logging.info('[wpasec] Internet connectivity detected. Uploading new handshakes to wpa-sec.stanev.org')
-                for idx, handshake in enumerate(handshake_new):
-                    if self.shutdown:
-                        return
-                    display.set('status', f"Uploading handshake to wpa-sec.stanev.org ({idx + 1}/{len(handshake_new)})")
-                    display.update(force=True)
-                    try:
-                        self._upload_to_wpasec(handshake)
-                        reported.append(handshake)
-                        self.report.update(data={'reported': reported})
-                        logging.debug('[wpasec] Successfully uploaded %s', handshake)
-                    except requests.exceptions.RequestException as req_e:
-                        self.skip.append(handshake)
-                        logging.debug('[wpasec] %s', req_e)
-                        continue
-                    except OSError as os_e:
-                        logging.debug('[wpasec] %s', os_e)
-                        continue
+                self._upload_all(handshake_new, display, outbox)
+                if self.shutdown:
+                    return
 
             if 'download_results' in self.options and self.options['download_results']:
                 cracked_file = os.path.join(handshake_dir, 'wpa-sec.cracked.potfile')
-                if os.path.exists(cracked_file):
-                    last_check = datetime.fromtimestamp(os.path.getmtime(cracked_file))
-                    if last_check is not None and ((datetime.now() - last_check).seconds / (60 * 60)) < 1:
-                        return
+                if os.path.exists(cracked_file) and self.download_state.newer_then_hours(1):
+                    return
                 try:
-                    self._download_from_wpasec(os.path.join(handshake_dir, 'wpa-sec.cracked.potfile'))
-                    logging.info('[wpasec] Downloaded cracked passwords.')
+                    if self._download_from_wpasec(cracked_file):
+                        logging.info('[wpasec] Downloaded cracked passwords.')
+                    else:
+                        logging.debug('[wpasec] Cracked passwords did not change.')
                 except requests.exceptions.RequestException as req_e:
                     logging.debug('[wpasec] %s', req_e)
                 except OSError as os_e: